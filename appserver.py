@@ -1,5 +1,6 @@
 import logging
 
+from twidder import media_handler
 from twidder.database_handler import initialize_database
 from twidder.server import app
 
@@ -7,8 +8,11 @@ logger = logging.getLogger("Twidder")
 app.logger.handlers.extend(logger.handlers)
 app.logger.setLevel(logging.DEBUG)
 
-with app.app_context():
-    initialize_database()
+# processes spawned by multiprocessing (e.g. password hashing processes) import this module as __mp_main__, they don't serve the app
+if __name__ != "__mp_main__":
+    with app.app_context():
+        initialize_database()
+        media_handler.start_workers()  # process media queued before the restart
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8080, debug=True)
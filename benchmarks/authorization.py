@@ -0,0 +1,66 @@
+"""
+Benchmark of the per-request overhead of user authorization (util.authorize_user).
+
+Runs in-process against a no-op request handler, so only header decoding, session lookup and body HMAC are measured.
+Requests with invalid sessions are rejected before the body is read, so their overhead doesn't depend on the body size.
+
+Usage:
+    python -m benchmarks.authorization --requests 2000  # from the repository root, so the twidder package is importable
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import http
+import json
+import statistics
+import time
+
+from twidder import session_handler, util
+from twidder.server import app
+
+BODY_SIZES = (0, 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+
+
+@util.authorize_user
+def _handler(email: str):
+    return "", http.HTTPStatus.NO_CONTENT
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the per-request authorization overhead")
+    parser.add_argument("--requests", type=int, default=2000, help="number of requests per body size")
+    args = parser.parse_args()
+
+    app.config["SESSION_BACKEND"] = "memory"
+    email = "benchmark@test.com"
+    with app.app_context():
+        session_id = session_handler.create_session(email)
+
+    print(f"{'body size':>12} {'session':>8} {'p50 [us]':>10} {'p99 [us]':>10}")
+    for body_size in BODY_SIZES:
+        body = b"x" * body_size
+        for valid in (True, False):
+            requests = args.requests if body_size < 1024 * 1024 else max(args.requests // 20, 50)
+            durations = _measure(email, session_id, body, valid, requests)
+            quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+            print(f"{body_size:>12} {'valid' if valid else 'invalid':>8} {quantiles[49] * 1e6:>10.1f} {quantiles[98] * 1e6:>10.1f}")
+
+
+def _measure(email: str, session_id: str, body: bytes, valid: bool, requests: int) -> list[float]:
+    user_hash = hmac.new(session_id.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    authorization = base64.b64encode(json.dumps({"email": email if valid else f"unknown-{email}", "hash": user_hash}).encode("utf-8")).decode("utf-8")
+
+    durations = []
+    for _ in range(requests):
+        with app.test_request_context("/api/v1/benchmark", method="POST", data=body, headers={"Authorization": authorization}):
+            start = time.perf_counter()
+            _, status = _handler()
+            durations.append(time.perf_counter() - start)
+            expected_status = http.HTTPStatus.NO_CONTENT if valid else http.HTTPStatus.UNAUTHORIZED
+            assert status == expected_status, f"unexpected status: {status}"
+    return durations
+
+
+if __name__ == "__main__":
+    main()
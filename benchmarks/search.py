@@ -0,0 +1,80 @@
+"""
+Benchmark of full-text post search (database_handler.search_posts).
+
+Fills a temporary database with synthetic posts, whose words follow a Zipf-like distribution like natural text,
+and measures the latency of the first result page for rare, common and multi-word queries.
+
+Usage:
+    python -m benchmarks.search --posts 1000000  # from the repository root, so the twidder package is importable
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from twidder import database_handler
+from twidder.server import app
+
+VOCABULARY_SIZE = 50000
+WORDS_PER_POST = 20
+USERS = 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of full-text post search")
+    parser.add_argument("--posts", type=int, default=1000000, help="number of synthetic posts")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries of every kind")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config["DATABASE_FILE"] = os.path.join(directory, "database.db")
+        with app.app_context():
+            database_handler.initialize_database()
+            vocabulary = [f"w{i}" for i in range(VOCABULARY_SIZE)]
+            cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY_SIZE)))
+
+            start = time.perf_counter()
+            _fill_database(args.posts, vocabulary, cum_weights)
+            print(f"inserted {args.posts} posts in {time.perf_counter() - start:.1f} s")
+
+            queries = {
+                "rare word": lambda: random.choice(vocabulary[VOCABULARY_SIZE // 2:]),
+                "common word": lambda: random.choice(vocabulary[10:100]),
+                "two words": lambda: " ".join(random.choices(vocabulary[:1000], k=2)),
+                "rare word on wall": lambda: random.choice(vocabulary[VOCABULARY_SIZE // 2:]),
+            }
+            print(f"{'query':>20} {'p50 [ms]':>10} {'p99 [ms]':>10} {'max [ms]':>10}")
+            for name, make_query in queries.items():
+                email = f"user{random.randrange(USERS)}@test.com" if name.endswith("on wall") else None
+                durations = []
+                for _ in range(args.queries):
+                    query = make_query()
+                    start = time.perf_counter()
+                    database_handler.search_posts(query, email, 0, app.config["POSTS_PAGE_SIZE"] + 1, window=app.config["SEARCH_RANK_WINDOW"])
+                    durations.append(time.perf_counter() - start)
+                quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+                print(f"{name:>20} {quantiles[49] * 1e3:>10.2f} {quantiles[98] * 1e3:>10.2f} {max(durations) * 1e3:>10.2f}")
+            database_handler.disconnect_db()
+
+
+def _fill_database(posts: int, vocabulary: list[str], cum_weights: list[float]) -> None:
+    db = database_handler.get_db()
+    db.executemany("insert into user (email, password, firstname, lastname, gender, city, country) values (?, '', 'Peter', 'Parker', 'Male', 'Linkoping', 'Sweden')",
+                   [(f"user{i}@test.com",) for i in range(USERS)])
+    created = datetime.datetime.now(datetime.timezone.utc)
+    batch = 10000
+    for first in range(0, posts, batch):
+        rows = []
+        for _ in range(min(batch, posts - first)):
+            author, user = f"user{random.randrange(USERS)}@test.com", f"user{random.randrange(USERS)}@test.com"
+            rows.append((author, user, " ".join(random.choices(vocabulary, cum_weights=cum_weights, k=WORDS_PER_POST)), created, created))
+        db.executemany("insert into post (author, user, content, created, edited) values (?, ?, ?, ?, ?)", rows)
+        db.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Load test of idle /session WebSockets.
+
+Opens many concurrent session sockets on one server, every one of them logged in as another user, and checks that all of them stay connected,
+and that REST requests are still served quickly while the sockets are open. Users are imported by the admin API with a cheap password hash,
+so that logging them in doesn't take longer than the test itself.
+
+Usage:
+    TWIDDER_ADMIN_TOKEN=secret ./run-gevent.sh  # or: gunicorn --worker-class gevent --workers 1 -b 0.0.0.0:8080 appserver:app
+    python benchmarks/websocket_load.py --sockets 5000 --admin-token secret
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import time
+import uuid
+
+import bcrypt
+import gevent
+import gevent.pool
+import requests
+import simple_websocket
+
+PASSWORD = "secretpassword"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of idle /session WebSockets")
+    parser.add_argument("--host", default="localhost:8080", help="server address")
+    parser.add_argument("--sockets", type=int, default=5000, help="number of concurrent sockets")
+    parser.add_argument("--hold", type=float, default=10.0, help="number of seconds to keep the sockets open")
+    parser.add_argument("--concurrency", type=int, default=200, help="number of sockets being opened at the same time")
+    parser.add_argument("--admin-token", default=os.environ.get("TWIDDER_ADMIN_TOKEN"), help="admin token of the server, to import the users")
+    args = parser.parse_args()
+    if args.admin_token is None:
+        parser.error("the admin token is required, set --admin-token or TWIDDER_ADMIN_TOKEN")
+
+    emails = _import_users(args.host, args.admin_token, args.sockets)
+
+    # log in every user and open its socket
+    sockets: dict[str, tuple[simple_websocket.Client, str]] = dict()
+    failures = 0
+
+    def open_socket(email: str):
+        nonlocal failures
+        try:
+            session_id = _login(args.host, email)
+            ws = simple_websocket.Client.connect(f"ws://{args.host}/session")
+            ws.send(base64.b64encode(json.dumps({"email": email, "session_id": session_id}).encode("utf-8")).decode("utf-8"))
+            if ws.receive(timeout=30) != "ok":
+                raise RuntimeError("session not accepted")
+            sockets[email] = (ws, session_id)
+        except Exception:
+            failures += 1
+
+    start = time.perf_counter()
+    pool = gevent.pool.Pool(args.concurrency)
+    for email in emails:
+        pool.spawn(open_socket, email)
+    pool.join()
+    print(f"opened {len(sockets)} sockets in {time.perf_counter() - start:.2f}s, {failures} failed")
+    if not sockets:
+        return
+
+    # measure REST latency while all sockets are open
+    latencies = []
+    email, (_, session_id) = next(iter(sockets.items()))
+    authorization = _authorization_header(email, session_id)
+    deadline = time.perf_counter() + args.hold
+    while time.perf_counter() < deadline:
+        request_start = time.perf_counter()
+        response = requests.get(f"http://{args.host}/api/v1/users/{email}", headers={"Authorization": authorization}, timeout=30)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - request_start)
+        gevent.sleep(0.05)
+    latencies.sort()
+    print(f"REST latency with {len(sockets)} open sockets: "
+          f"p50={statistics.median(latencies) * 1000:.1f}ms, p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms ({len(latencies)} requests)")
+
+    # all sockets must still be open
+    connected = sum(1 for ws, _ in sockets.values() if ws.connected)
+    print(f"{connected}/{len(sockets)} sockets still connected after {args.hold:.0f}s")
+
+    # logging out invalidates the session of every user, so the server closes all the sockets
+    def logout(email: str, session_id: str):
+        requests.delete(f"http://{args.host}/api/v1/session", headers={"Authorization": _authorization_header(email, session_id)}, timeout=30)
+
+    start = time.perf_counter()
+    for email, (_, session_id) in sockets.items():
+        pool.spawn(logout, email, session_id)
+    pool.join()
+    while any(ws.connected for ws, _ in sockets.values()) and time.perf_counter() - start < 30:
+        gevent.sleep(0.1)
+    closed = sum(1 for ws, _ in sockets.values() if not ws.connected)
+    print(f"{closed}/{len(sockets)} sockets closed by the server in {time.perf_counter() - start:.2f}s after logout")
+
+
+def _import_users(host: str, admin_token: str, count: int) -> list[str]:
+    # the lowest bcrypt cost keeps logins cheap, the benchmark measures sockets, not password hashing
+    password_hash = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds=4)).decode("utf-8")
+    prefix = uuid.uuid4().hex[:8]
+    emails = [f"load-{prefix}-{i}@test.com" for i in range(count)]
+    body = "".join(json.dumps({"type": "user", "email": email, "password_hash": password_hash, "firstname": "Load", "lastname": "Test",
+                               "gender": "Other", "city": "Linkoping", "country": "Sweden"}) + "\n" for email in emails)
+    response = requests.post(f"http://{host}/api/v1/admin/import", data=body, headers={"Authorization": f"Bearer {admin_token}",
+                                                                                      "Content-Type": "application/x-ndjson"})
+    response.raise_for_status()
+    return emails
+
+
+def _login(host: str, email: str) -> str:
+    response = requests.post(f"http://{host}/api/v1/session", json={"email": email, "password": PASSWORD}, timeout=30)
+    response.raise_for_status()
+    return response.headers["Authorization"]
+
+
+def _authorization_header(email: str, session_id: str) -> str:
+    user_hash = hmac.new(session_id.encode("utf-8"), b"", hashlib.sha256).hexdigest()
+    return base64.b64encode(json.dumps({"email": email, "hash": user_hash}).encode("utf-8")).decode("utf-8")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark of concurrent writes (database_handler.create_post), executed directly by request threads or by the writer thread with group commit.
+
+Every thread creates posts one by one in its own app context, like request threads of one worker process do,
+and the throughput, latency and number of failed writes (e.g. 'database is locked') are measured for both modes.
+
+Usage:
+    python -m benchmarks.writes --threads 8 --posts 5000  # from the repository root, so the twidder package is importable
+"""
+import argparse
+import concurrent.futures
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+from twidder import database_handler
+from twidder.server import app
+
+USERS = 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of concurrent writes")
+    parser.add_argument("--threads", type=int, default=8, help="number of writing threads")
+    parser.add_argument("--posts", type=int, default=5000, help="number of posts written by all threads")
+    parser.add_argument("--followers", type=int, default=10, help="number of followers of every user, posts are fanned out to their feeds")
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'posts/s':>10} {'p50 [ms]':>10} {'p99 [ms]':>10} {'failed':>8} {'transactions':>13}")
+    for writer in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config["DATABASE_FILE"] = os.path.join(directory, "database.db")
+            app.config["DATABASE_WRITER"] = writer
+            with app.app_context():
+                database_handler.initialize_database()
+                _fill_database(args.followers)
+
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+                results = list(executor.map(_create_post, range(args.posts)))
+            duration = time.perf_counter() - start
+
+            latencies = [latency for _, latency in results]
+            quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            failed = sum(1 for post_id, _ in results if post_id == -1)
+            transactions = args.posts
+            with app.app_context():
+                if writer:
+                    transactions = database_handler.get_writer().stats()["transactions"]
+                    database_handler.get_writer().stop()
+                database_handler.get_pool().close()
+            print(f"{'writer' if writer else 'direct':>8} {args.posts / duration:>10.0f} {quantiles[49] * 1e3:>10.2f} {quantiles[98] * 1e3:>10.2f} "
+                  f"{failed:>8} {transactions:>13}")
+
+
+def _fill_database(followers: int) -> None:
+    db = database_handler.get_db()
+    db.executemany("insert into user (email, password, firstname, lastname, gender, city, country) values (?, '', 'Peter', 'Parker', 'Male', 'Linkoping', 'Sweden')",
+                   [(f"user{i}@test.com",) for i in range(USERS)])
+    created = datetime.datetime.now(datetime.timezone.utc)
+    db.executemany("insert into follow (follower, followee, created) values (?, ?, ?)",
+                   [(f"user{(i + j + 1) % USERS}@test.com", f"user{i}@test.com", created) for i in range(USERS) for j in range(followers)])
+    db.commit()
+
+
+def _create_post(i: int) -> tuple[int, float]:
+    author = f"user{i % USERS}@test.com"
+    created = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    with app.app_context():
+        post_id = database_handler.create_post(author, author, f"post {i}", created, created, None)
+    return post_id, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
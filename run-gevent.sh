@@ -0,0 +1,6 @@
+# NOTE: gevent workers serve every request and WebSocket in a greenlet instead of an OS thread, so idle /session sockets don't block REST requests
+# NOTE: the database connection pool (DATABASE_POOL_SIZE) still limits the number of concurrent database queries in each worker
+# NOTE: the app is not gevent-aware: sqlite3 queries and Pillow calls (e.g. thumbnails) don't yield to the gevent hub, so all greenlets of a worker wait while one of them runs a slow query or processes an image
+# NOTE: gunicorn starts WEB_CONCURRENCY workers, the app splits CPU cores for password hashing between them (PASSWORD_HASHING_WORKERS)
+export WEB_CONCURRENCY="$(nproc)"
+gunicorn --worker-class gevent --worker-connections 10000 -b 0.0.0.0:8080 appserver:app
@@ -1,2 +1,6 @@
-# NOTE: because of user session implementation, this application requires to run in one process (i.e. using one worker only)
-gunicorn --workers 1 --threads 8 -b 0.0.0.0:8080 appserver:app
+# NOTE: sessions are shared between workers through the session database (SESSION_BACKEND), so we can run one worker per CPU core
+# NOTE: the number of threads should match the size of the database connection pool (DATABASE_POOL_SIZE)
+# NOTE: every open /session WebSocket holds one of the threads (and a reader thread of simple_websocket) until it is closed, use run-gevent.sh for many logged-in users
+# NOTE: gunicorn starts WEB_CONCURRENCY workers, the app splits CPU cores for password hashing between them (PASSWORD_HASHING_WORKERS)
+export WEB_CONCURRENCY="$(nproc)"
+gunicorn --threads 8 -b 0.0.0.0:8080 appserver:app
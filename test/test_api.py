@@ -1,16 +1,27 @@
+import base64
+import hashlib
+import hmac
 import http
+import io
+import json
 import time
 from multiprocessing import Process
 
 import pytest
 import requests
+import simple_websocket
+from PIL import Image
 
-from twidder.database_handler import initialize_database, clear_database
+from twidder.database_handler import initialize_database, clear_database, get_media_by_id, get_read_db
 from twidder.server import app
 
+ADMIN_TOKEN = "secret-admin-token"
+
 
 @pytest.fixture(scope="module", autouse=True)
-def run_server():
+def run_server(tmp_path_factory):
+    app.config["ADMIN_TOKEN"] = ADMIN_TOKEN
+    app.config["MEDIA_FOLDER"] = str(tmp_path_factory.mktemp("media"))  # every run stores media in a new folder
     with app.app_context():
         clear_database()
         initialize_database()
@@ -34,3 +45,662 @@ def test_invalid_general_route():
     # make sure that non-existent page succeeds with OK response
     response = requests.get("http://localhost:8080/nonexisting/route")
     assert response.status_code == http.HTTPStatus.OK
+
+
+def test_request_authorization():
+    session_id = _sign_up_and_login("authorization@test.com")
+
+    # malformed Authorization header is rejected
+    response = requests.get("http://localhost:8080/api/v1/users/authorization@test.com", headers={"Authorization": "not base64 json"})
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+
+    # large body is authenticated and still readable by the request handler
+    body = json.dumps({"email": "authorization@test.com", "message": "x" * (2 * 1024 * 1024), "media": None})
+    response = requests.post("http://localhost:8080/api/v1/posts", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("authorization@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.CREATED
+
+    # tampered body is rejected
+    tampered_body = body.replace("x", "y", 1)
+    response = requests.post("http://localhost:8080/api/v1/posts", data=tampered_body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("authorization@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+
+
+def test_list_posts_pagination():
+    session_id = _sign_up_and_login("pagination@test.com")
+    post_ids = [_create_post("pagination@test.com", session_id, f"post {i}") for i in range(5)]
+
+    # walk through the wall page by page
+    listed_ids = []
+    cursor = None
+    while True:
+        params = {"user_email": "pagination@test.com", "limit": 2}
+        if cursor is not None:
+            params["before_id"] = cursor
+        response = requests.get("http://localhost:8080/api/v1/posts", params=params,
+                                headers={"Authorization": _authorization_header("pagination@test.com", session_id, None)})
+        assert response.status_code == http.HTTPStatus.OK
+        page = response.json()
+        assert len(page["posts"]) <= 2
+        listed_ids.extend(post["id"] for post in page["posts"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    # posts are listed newest first, each exactly once
+    assert listed_ids == list(reversed(post_ids))
+
+    # invalid page size is rejected
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "pagination@test.com", "limit": 0},
+                            headers={"Authorization": _authorization_header("pagination@test.com", session_id, None)})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+
+def test_search_posts():
+    session_id = _sign_up_and_login("search@test.com")
+    weak_id = _create_post("search@test.com", session_id, "zebra crossing near the station")
+    strong_id = _create_post("search@test.com", session_id, "zebra zebra zebra")
+    other_id = _create_post("search@test.com", session_id, "nothing to see")
+    authorization = _authorization_header("search@test.com", session_id, None)
+
+    # best matches first
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "Zebra"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert [post["id"] for post in response.json()["posts"]] == [strong_id, weak_id]
+
+    # all words must match, FTS5 query syntax is not interpreted
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra station"}, headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [weak_id]
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra OR \"see"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["posts"] == []
+
+    # pagination
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra", "limit": 1}, headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [strong_id]
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra", "limit": 1, "offset": response.json()["next_cursor"]},
+                            headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [weak_id]
+    assert response.json()["next_cursor"] is None
+    assert response.json()["truncated"] is False  # all matches are ranked
+
+    # index follows edited and deleted posts
+    body = json.dumps({"message": "a zebra after all"})
+    response = requests.patch(f"http://localhost:8080/api/v1/posts/{other_id}", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("search@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.delete(f"http://localhost:8080/api/v1/posts/{strong_id}", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra"}, headers={"Authorization": authorization})
+    assert sorted(post["id"] for post in response.json()["posts"]) == sorted([weak_id, other_id])
+
+    # search on a wall
+    other_session_id = _sign_up_and_login("search-other@test.com")
+    other_wall_id = _create_post("search-other@test.com", other_session_id, "zebra on another wall")
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": "zebra", "user_email": "search-other@test.com"},
+                            headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [other_wall_id]
+
+    response = requests.get("http://localhost:8080/api/v1/posts/search", params={"q": " "}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+
+def test_search_users():
+    session_id = _sign_up_and_login("autocomplete-b@test.com")
+    _sign_up_and_login("autocomplete-a@test.com")
+    authorization = _authorization_header("autocomplete-b@test.com", session_id, None)
+
+    # email prefix is case-insensitive, users are ordered by email and don't contain images
+    response = requests.get("http://localhost:8080/api/v1/users", params={"prefix": "AutoComplete"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["users"] == [
+        {"email": "autocomplete-a@test.com", "firstname": "Peter", "lastname": "Parker"},
+        {"email": "autocomplete-b@test.com", "firstname": "Peter", "lastname": "Parker"},
+    ]
+
+    # name prefix
+    response = requests.get("http://localhost:8080/api/v1/users", params={"prefix": "park", "limit": 1}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert len(response.json()["users"]) == 1
+
+    response = requests.get("http://localhost:8080/api/v1/users", params={"prefix": "autocomplete-c"}, headers={"Authorization": authorization})
+    assert response.json()["users"] == []
+
+    response = requests.get("http://localhost:8080/api/v1/users", params={"prefix": ""}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+    response = requests.get("http://localhost:8080/api/v1/users", params={"prefix": "auto", "limit": 0}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+
+def test_get_users_batch():
+    session_id = _sign_up_and_login("batch-a@test.com")
+    _sign_up_and_login("batch-b@test.com")
+    authorization = _authorization_header("batch-a@test.com", session_id, None)
+
+    # unknown users are left out, duplicates are returned once
+    response = requests.get("http://localhost:8080/api/v1/users", params={"emails": "batch-a@test.com,batch-b@test.com,batch-a@test.com,batch-c@test.com"},
+                            headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    users = response.json()["users"]
+    assert sorted(users) == ["batch-a@test.com", "batch-b@test.com"]
+    assert users["batch-b@test.com"]["firstname"] == "Peter" and "password" not in users["batch-b@test.com"]
+
+    response = requests.get("http://localhost:8080/api/v1/users", params={"emails": ["batch-a@test.com", "batch-b@test.com"], "fields": "lastname"},
+                            headers={"Authorization": authorization})
+    assert response.json()["users"]["batch-a@test.com"] == {"email": "batch-a@test.com", "lastname": "Parker"}
+
+    response = requests.get("http://localhost:8080/api/v1/users", params={"emails": ","}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+    # authors of a page of posts are embedded once
+    _create_post("batch-a@test.com", session_id, "first")
+    _create_post("batch-a@test.com", session_id, "second")
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "batch-a@test.com", "include_authors": "true", "fields": "content"},
+                            headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert [post["content"] for post in response.json()["posts"]] == ["second", "first"]
+    assert response.json()["authors"] == {"batch-a@test.com": {"email": "batch-a@test.com", "firstname": "Peter", "lastname": "Parker", "image": None}}
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "batch-a@test.com", "include_authors": "true", "fields": "content"},
+                            headers={"Authorization": authorization, "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == http.HTTPStatus.NOT_MODIFIED
+
+
+def test_feed():
+    session_id = _sign_up_and_login("feed-reader@test.com")
+    followed_session_id = _sign_up_and_login("feed-followed@test.com")
+    authorization = _authorization_header("feed-reader@test.com", session_id, None)
+    old_id = _create_post("feed-followed@test.com", followed_session_id, "before following")
+
+    response = requests.put("http://localhost:8080/api/v1/users/feed-followed@test.com/follow", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.get("http://localhost:8080/api/v1/users/feed-followed@test.com/follow", headers={"Authorization": authorization})
+    assert response.json()["following"] is True
+    response = requests.put("http://localhost:8080/api/v1/users/feed-reader@test.com/follow", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+    response = requests.put("http://localhost:8080/api/v1/users/feed-unknown@test.com/follow", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.NOT_FOUND
+
+    # feed contains own posts and posts of followed users, including the latest ones written before following
+    own_id = _create_post("feed-reader@test.com", session_id, "own post")
+    new_id = _create_post("feed-followed@test.com", followed_session_id, "after following")
+    _create_post("feed-followed@test.com", followed_session_id, "on the reader's wall", wall_email="feed-reader@test.com")
+    response = requests.get("http://localhost:8080/api/v1/feed", params={"limit": 3, "fields": "author"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert [post["author"] for post in response.json()["posts"]] == ["feed-followed@test.com"] * 2 + ["feed-reader@test.com"]
+    assert response.json()["posts"][1]["id"] == new_id and response.json()["posts"][2]["id"] == own_id
+    response = requests.get("http://localhost:8080/api/v1/feed", params={"before_id": response.json()["next_cursor"]}, headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [old_id]
+    assert response.json()["next_cursor"] is None
+
+    response = requests.delete("http://localhost:8080/api/v1/users/feed-followed@test.com/follow", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.get("http://localhost:8080/api/v1/feed", headers={"Authorization": authorization})
+    assert [post["id"] for post in response.json()["posts"]] == [own_id]
+
+
+def test_post_media_store():
+    session_id = _sign_up_and_login("media@test.com")
+    media = "data:image/png;base64," + base64.b64encode(b"not really a png, but good enough").decode("utf-8")
+    _create_post("media@test.com", session_id, "first", media=media)
+    _create_post("media@test.com", session_id, "second", media=media)
+
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "media@test.com"},
+                            headers={"Authorization": _authorization_header("media@test.com", session_id, None)})
+    assert response.status_code == http.HTTPStatus.OK
+    posts = response.json()["posts"]
+
+    # identical uploads share the same media
+    assert posts[0]["media"] == posts[1]["media"]
+    assert posts[0]["media"].startswith("/api/v1/media/")
+    assert posts[0]["media_type"] == "image/png"
+
+    # media which can't be processed is not queued again when it is uploaded again
+    media_id = posts[0]["media"].rsplit("/", 1)[-1]
+    with app.app_context():
+        for _ in range(50):
+            if get_media_by_id(media_id)["processed"] is not None:
+                break
+            time.sleep(0.1)
+        assert get_media_by_id(media_id)["thumbnail"] is None
+        last_job = get_read_db().execute("select seq from sqlite_sequence where name=='media_job'").fetchone()[0]
+        _create_post("media@test.com", session_id, "third", media=media)
+        assert get_read_db().execute("select seq from sqlite_sequence where name=='media_job'").fetchone()[0] == last_job
+
+    # media can be downloaded, also partially
+    response = requests.get("http://localhost:8080" + posts[0]["media"])
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.content == b"not really a png, but good enough"
+    assert response.headers["Content-Type"] == "image/png"
+    assert "immutable" in response.headers["Cache-Control"]
+    response = requests.get("http://localhost:8080" + posts[0]["media"], headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == http.HTTPStatus.NOT_MODIFIED
+
+    response = requests.get("http://localhost:8080" + posts[0]["media"], headers={"Range": "bytes=0-9"})
+    assert response.status_code == http.HTTPStatus.PARTIAL_CONTENT
+    assert response.content == b"not really"
+
+    # invalid media are rejected
+    body = json.dumps({"email": "media@test.com", "message": "invalid", "media": "not a data url"})
+    response = requests.post("http://localhost:8080/api/v1/posts", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("media@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+
+def test_post_media_thumbnail():
+    session_id = _sign_up_and_login("thumbnail@test.com")
+    image = io.BytesIO()
+    Image.new("RGB", (1600, 800), "red").save(image, "PNG")
+    media = "data:image/png;base64," + base64.b64encode(image.getvalue()).decode("utf-8")
+    _create_post("thumbnail@test.com", session_id, "large image", media=media)
+
+    # thumbnail is generated in the background, the page changes then
+    post, etags = None, set()
+    for _ in range(50):
+        response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "thumbnail@test.com"},
+                                headers={"Authorization": _authorization_header("thumbnail@test.com", session_id, None)})
+        post = response.json()["posts"][0]
+        if post["media_preview"] is not None:
+            break
+        etags.add(response.headers["ETag"])
+        time.sleep(0.1)
+    assert response.headers["ETag"] not in etags
+
+    # the thumbnail is served by default, the original on request
+    assert post["media"] == post["media_preview"]
+    assert post["media"] != post["media_original"]
+    response = requests.get("http://localhost:8080" + post["media"])
+    assert response.headers["Content-Type"] == "image/webp"
+    assert Image.open(io.BytesIO(response.content)).size == (app.config["MEDIA_THUMBNAIL_SIZE"], app.config["MEDIA_THUMBNAIL_SIZE"] // 2)
+    response = requests.get("http://localhost:8080" + post["media_original"])
+    assert response.content == image.getvalue()
+
+
+def test_media_upload():
+    session_id = _sign_up_and_login("upload@test.com")
+    data = bytes(range(256)) * 40
+    body = json.dumps({"mimetype": "video/mp4", "size": len(data)})
+    response = requests.post("http://localhost:8080/api/v1/media/uploads", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("upload@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.CREATED
+    upload_url = f"http://localhost:8080/api/v1/media/uploads/{response.json()['id']}"
+    assert response.json()["offset"] == 0
+
+    def append(offset: int, chunk: bytes) -> requests.Response:
+        return requests.put(upload_url, params={"offset": offset}, data=chunk, headers={
+            "Content-Type": "application/octet-stream",
+            "Authorization": _authorization_header("upload@test.com", session_id, chunk),
+        })
+
+    response = append(0, data[:4096])
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["offset"] == 4096
+
+    # a chunk which isn't authentic is rejected once it is read, the upload is not extended by it
+    response = requests.put(upload_url, params={"offset": 4096}, data=data[4096:8192], headers={
+        "Content-Type": "application/octet-stream",
+        "Authorization": _authorization_header("upload@test.com", session_id, b"another chunk"),
+    })
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+
+    # a chunk sent again (e.g. after a dropped response) is rejected, the upload resumes from the received offset
+    response = append(0, data[:4096])
+    assert response.status_code == http.HTTPStatus.CONFLICT
+    assert response.json()["offset"] == 4096
+    response = requests.get(upload_url, headers={"Authorization": _authorization_header("upload@test.com", session_id, None)})
+    assert response.json()["offset"] == 4096
+
+    # incomplete uploads can't be completed, chunks can't exceed the size
+    response = requests.post(upload_url, headers={"Authorization": _authorization_header("upload@test.com", session_id, None)})
+    assert response.status_code == http.HTTPStatus.CONFLICT
+    assert append(4096, data[4096:] + b"x").status_code == http.HTTPStatus.BAD_REQUEST
+
+    assert append(4096, data[4096:]).json()["offset"] == len(data)
+
+    # uploads are accessible only to their owner
+    other_session_id = _sign_up_and_login("upload-other@test.com")
+    response = requests.post(upload_url, headers={"Authorization": _authorization_header("upload-other@test.com", other_session_id, None)})
+    assert response.status_code == http.HTTPStatus.FORBIDDEN
+
+    response = requests.post(upload_url, headers={"Authorization": _authorization_header("upload@test.com", session_id, None)})
+    assert response.status_code == http.HTTPStatus.CREATED
+    media_id = response.json()["id"]
+
+    # uploaded media are referenced by their id
+    post_id = _create_post("upload@test.com", session_id, "uploaded video", media=media_id)
+    response = requests.get(f"http://localhost:8080/api/v1/posts/{post_id}", headers={"Authorization": _authorization_header("upload@test.com", session_id, None)})
+    assert response.json()["media_type"] == "video/mp4"
+    response = requests.get("http://localhost:8080" + response.json()["media"])
+    assert response.content == data
+
+
+def test_post_field_projection():
+    session_id = _sign_up_and_login("projection@test.com")
+    media = "data:image/png;base64," + base64.b64encode(b"projected png").decode("utf-8")
+    post_id = _create_post("projection@test.com", session_id, "with media", media=media)
+    authorization = _authorization_header("projection@test.com", session_id, None)
+
+    # media are left out of the listing
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "projection@test.com", "include_media": "false"},
+                            headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    post = response.json()["posts"][0]
+    assert "media" not in post and "media_type" not in post
+    assert post["content"] == "with media"
+
+    # only requested fields are returned, the id is needed for pagination
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "projection@test.com", "fields": "content"},
+                            headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["posts"] == [{"id": post_id, "content": "with media"}]
+
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "projection@test.com", "fields": "content,password"},
+                            headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+
+    # media are fetched on demand
+    response = requests.get(f"http://localhost:8080/api/v1/posts/{post_id}", params={"fields": "media,media_type"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["media"].startswith("/api/v1/media/")
+    assert response.json()["media_type"] == "image/png"
+
+    response = requests.get("http://localhost:8080/api/v1/users/projection@test.com", params={"include_media": "false"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    assert "image" not in response.json()
+    assert response.json()["firstname"] == "Peter"
+
+
+def test_response_compression():
+    session_id = _sign_up_and_login("compression@test.com")
+    for _ in range(10):
+        _create_post("compression@test.com", session_id, "a rather long post, so that the page is worth compressing " * 5)
+    authorization = _authorization_header("compression@test.com", session_id, None)
+
+    # posts are streamed and compressed, the content is the same as without compression
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "compression@test.com"},
+                            headers={"Authorization": authorization, "Accept-Encoding": "gzip"})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.headers["ETag"].startswith("W/")
+    uncompressed = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "compression@test.com"},
+                                headers={"Authorization": authorization, "Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in uncompressed.headers
+    assert uncompressed.json() == response.json() and len(response.json()["posts"]) == 10
+
+    # the weak entity tag of the compressed page still validates the cached page
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "compression@test.com"},
+                            headers={"Authorization": authorization, "Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == http.HTTPStatus.NOT_MODIFIED
+
+    # small responses are not compressed
+    response = requests.get("http://localhost:8080/api/v1/users/compression@test.com", headers={"Authorization": authorization, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_conditional_requests():
+    session_id = _sign_up_and_login("cache@test.com")
+    authorization = _authorization_header("cache@test.com", session_id, None)
+
+    # unchanged user profile is not sent again
+    response = requests.get("http://localhost:8080/api/v1/users/cache@test.com", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    etag = response.headers["ETag"]
+    response = requests.get("http://localhost:8080/api/v1/users/cache@test.com", headers={"Authorization": authorization, "If-None-Match": etag})
+    assert response.status_code == http.HTTPStatus.NOT_MODIFIED
+
+    # updated user profile is sent again
+    body = json.dumps({"city": "Stockholm"})
+    response = requests.patch("http://localhost:8080/api/v1/users/cache@test.com", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header("cache@test.com", session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.get("http://localhost:8080/api/v1/users/cache@test.com", headers={"Authorization": authorization, "If-None-Match": etag})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["city"] == "Stockholm"
+
+    # unchanged wall is not sent again, new post invalidates it
+    _create_post("cache@test.com", session_id, "first")
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "cache@test.com"}, headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    etag = response.headers["ETag"]
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "cache@test.com"},
+                            headers={"Authorization": authorization, "If-None-Match": etag})
+    assert response.status_code == http.HTTPStatus.NOT_MODIFIED
+    post_id = _create_post("cache@test.com", session_id, "second")
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "cache@test.com"},
+                            headers={"Authorization": authorization, "If-None-Match": etag})
+    assert response.status_code == http.HTTPStatus.OK
+    assert len(response.json()["posts"]) == 2
+
+    # deleted post invalidates the wall too, also when validated by its modification time (with the resolution of one second)
+    last_modified = response.headers["Last-Modified"]
+    time.sleep(1)
+    response = requests.delete(f"http://localhost:8080/api/v1/posts/{post_id}", headers={"Authorization": authorization})
+    assert response.status_code == http.HTTPStatus.OK
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "cache@test.com"},
+                            headers={"Authorization": authorization, "If-Modified-Since": last_modified})
+    assert response.status_code == http.HTTPStatus.OK
+    assert len(response.json()["posts"]) == 1
+
+
+def test_admin_database_stats():
+    # admin API requires the admin token
+    response = requests.get("http://localhost:8080/api/v1/admin/database")
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+    response = requests.get("http://localhost:8080/api/v1/admin/database", headers={"Authorization": "Bearer wrong-token"})
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+
+    response = requests.get("http://localhost:8080/api/v1/admin/database", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.OK
+    pool = response.json()["pool"]
+    assert pool["size"] == app.config["DATABASE_POOL_SIZE"]
+    assert pool["misses"] <= pool["size"]
+
+    # reads use the read-only pool, its connections are reused by subsequent requests
+    read_pool = response.json()["read_pool"]
+    assert read_pool["size"] == app.config["DATABASE_READ_POOL_SIZE"]
+    assert read_pool["misses"] <= read_pool["size"]
+    assert read_pool["hits"] > 0
+
+
+def test_metrics():
+    session_id = _sign_up_and_login("metrics@test.com")
+    _create_post("metrics@test.com", session_id, "measured")
+    for _ in range(3):
+        response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "metrics@test.com"},
+                                headers={"Authorization": _authorization_header("metrics@test.com", session_id, None)})
+        assert response.status_code == http.HTTPStatus.OK
+
+    assert requests.get("http://localhost:8080/metrics").status_code == http.HTTPStatus.UNAUTHORIZED
+    response = requests.get("http://localhost:8080/metrics", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    samples = dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+
+    # streamed pages are measured until they are sent completely
+    labels = 'endpoint="api.posts.list_posts",method="GET",status="200"'
+    assert int(samples[f"twidder_http_request_duration_seconds_count{{{labels}}}"]) >= 3
+    assert int(samples[f'twidder_http_request_duration_seconds_bucket{{{labels},le="+Inf"}}']) >= 3
+    assert float(samples[f"twidder_http_request_duration_seconds_sum{{{labels}}}"]) > 0
+    assert int(samples['twidder_sql_queries_total{endpoint="api.posts.list_posts"}']) >= 3
+    assert float(samples['twidder_sql_query_duration_seconds_total{endpoint="api.posts.list_posts"}']) > 0
+
+    # the scrape itself is in progress
+    assert int(samples['twidder_http_requests_in_flight{endpoint="get_metrics"}']) == 1
+    assert int(samples["twidder_sessions"]) >= 1
+
+
+def test_admin_query_stats():
+    response = requests.get("http://localhost:8080/api/v1/admin/queries", params={"limit": 500}, headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.OK
+    queries = response.json()["queries"]
+    assert len(queries) > 0
+    assert all(query["count"] > 0 and (query["plan"] is None or isinstance(query["plan"], list)) for query in queries)
+    assert [query["total_time"] for query in queries] == sorted((query["total_time"] for query in queries), reverse=True)
+
+    # walls are read by index
+    wall_query = next(query for query in queries if query["query"].startswith("select") and " from post where user==?" in query["query"])
+    assert not wall_query["full_scan"]
+
+
+def test_admin_password_hashing_stats():
+    _sign_up_and_login("hashing@test.com")
+
+    response = requests.get("http://localhost:8080/api/v1/admin/passwords", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.OK
+    hashing = response.json()["hashing"]
+    assert hashing["workers"] == app.config["PASSWORD_HASHING_WORKERS"]
+    assert hashing["completed"] >= 2  # sign up hashes the password, login checks it
+    assert hashing["in_progress"] == 0
+
+
+def test_admin_import():
+    records = [
+        {"type": "user", "email": "import-a@test.com", "password": "secretpassword", "firstname": "Peter", "lastname": "Parker", "gender": "Male",
+         "city": "Linkoping", "country": "Sweden"},
+        {"type": "user", "email": "import-b@test.com", "password_hash": "$2b$04$O5P2uIQ.29c9RaEAwzAkCuWHILUOcmpM3x/j.GaDqp5Fn4Oblx21m", "firstname": "Mary",
+         "lastname": "Jane", "gender": "Female", "city": "Linkoping", "country": "Sweden"},
+        *({"type": "post", "author": "import-b@test.com", "user": "import-a@test.com", "content": f"imported {i}", "created": "2024-01-01T00:00:00+00:00"}
+          for i in range(3)),
+    ]
+    body = "\n".join(json.dumps(record) for record in records) + "\n"
+    response = requests.post("http://localhost:8080/api/v1/admin/import", data=body, headers={"Authorization": f"Bearer {ADMIN_TOKEN}",
+                                                                                               "Content-Type": "application/x-ndjson"})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["imported"] == {"users": 2, "posts": 3}
+
+    # imported users can log in and their posts are listed
+    response = requests.post("http://localhost:8080/api/v1/session", json={"email": "import-a@test.com", "password": "secretpassword"})
+    assert response.status_code == http.HTTPStatus.CREATED
+    authorization = _authorization_header("import-a@test.com", response.headers["Authorization"], None)
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "import-a@test.com"}, headers={"Authorization": authorization})
+    assert [post["content"] for post in response.json()["posts"]] == ["imported 2", "imported 1", "imported 0"]
+
+    # records before an invalid one are imported
+    body = json.dumps({**records[2], "content": "valid"}) + "\n" + json.dumps({"type": "post", "author": "import-a@test.com"}) + "\n"
+    response = requests.post("http://localhost:8080/api/v1/admin/import", data=body, headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
+    assert "line 2" in response.json()["message"] and response.json()["imported"] == {"users": 0, "posts": 1}
+
+    # records before an invalid one which can't be written are reported as an error
+    body = json.dumps({**records[2], "author": "unknown@test.com"}) + "\n" + json.dumps({"type": "post", "author": "import-a@test.com"}) + "\n"
+    response = requests.post("http://localhost:8080/api/v1/admin/import", data=body, headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})
+    assert response.status_code == http.HTTPStatus.INTERNAL_SERVER_ERROR
+    assert response.json()["imported"] == {"users": 0, "posts": 0}
+
+    response = requests.post("http://localhost:8080/api/v1/admin/import", data=body)
+    assert response.status_code == http.HTTPStatus.UNAUTHORIZED
+
+
+def test_delete_user_with_posts():
+    session_id = _sign_up_and_login("delete@test.com")
+    other_session_id = _sign_up_and_login("delete-other@test.com")
+    _create_post("delete@test.com", session_id, "on my wall")
+    _create_post("delete@test.com", session_id, "on other wall", wall_email="delete-other@test.com")
+    _create_post("delete-other@test.com", other_session_id, "on deleted user's wall", wall_email="delete@test.com")
+
+    response = requests.delete("http://localhost:8080/api/v1/users/delete@test.com",
+                               headers={"Authorization": _authorization_header("delete@test.com", session_id, None)})
+    assert response.status_code == http.HTTPStatus.OK
+
+    # posts authored by the deleted user are gone as well
+    response = requests.get("http://localhost:8080/api/v1/posts", params={"user_email": "delete-other@test.com"},
+                            headers={"Authorization": _authorization_header("delete-other@test.com", other_session_id, None)})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["posts"] == []
+
+
+def test_session_socket_closed_on_new_login():
+    session_id = _sign_up_and_login("socket@test.com")
+    ws = simple_websocket.Client.connect("ws://localhost:8080/session")
+    try:
+        ws.send(base64.b64encode(json.dumps({"email": "socket@test.com", "session_id": session_id}).encode("utf-8")).decode("utf-8"))
+        assert ws.receive(timeout=5) == "ok"
+
+        # logging in again invalidates the previous session, the socket is closed right away
+        start = time.monotonic()
+        response = requests.post("http://localhost:8080/api/v1/session", json={"email": "socket@test.com", "password": "secretpassword"})
+        assert response.status_code == http.HTTPStatus.CREATED
+        with pytest.raises(simple_websocket.ConnectionClosed):
+            ws.receive(timeout=5)
+        assert time.monotonic() - start < 2.0
+        assert ws.close_message == "session expired"
+    finally:
+        try:
+            ws.close()
+        except simple_websocket.ConnectionClosed:
+            pass
+
+
+def test_wall_events_pushed_over_session_socket():
+    session_id = _sign_up_and_login("events@test.com")
+    other_session_id = _sign_up_and_login("events-other@test.com")
+    ws = simple_websocket.Client.connect("ws://localhost:8080/session")
+    try:
+        ws.send(base64.b64encode(json.dumps({"email": "events@test.com", "session_id": session_id}).encode("utf-8")).decode("utf-8"))
+        assert ws.receive(timeout=5) == "ok"
+        ws.send(json.dumps({"type": "watch", "walls": ["events@test.com"]}))
+        time.sleep(0.5)  # wait for the subscription
+
+        # posts on a watched wall are pushed to the client
+        post_id = _create_post("events-other@test.com", other_session_id, "hello there", wall_email="events@test.com")
+        event = json.loads(ws.receive(timeout=5))
+        assert event["type"] == "post_created"
+        assert event["wall"] == "events@test.com"
+        assert event["post"]["id"] == post_id
+        assert event["post"]["content"] == "hello there"
+
+        # posts on other walls are not
+        _create_post("events-other@test.com", other_session_id, "on my own wall")
+        response = requests.delete(f"http://localhost:8080/api/v1/posts/{post_id}",
+                                   headers={"Authorization": _authorization_header("events@test.com", session_id, None)})
+        assert response.status_code == http.HTTPStatus.OK
+        event = json.loads(ws.receive(timeout=5))
+        assert event == {"type": "post_deleted", "wall": "events@test.com", "id": post_id}
+    finally:
+        ws.close()
+
+
+def _authorization_header(email: str, session_id: str, body: str | bytes | None) -> str:
+    message = body.encode("utf-8") if isinstance(body, str) else body or b""
+    user_hash = hmac.new(session_id.encode("utf-8"), message, hashlib.sha256).hexdigest()
+    return base64.b64encode(json.dumps({"email": email, "hash": user_hash}).encode("utf-8")).decode("utf-8")
+
+
+def _sign_up_and_login(email: str, password: str = "secretpassword") -> str:
+    response = requests.post("http://localhost:8080/api/v1/users", json={
+        "email": email,
+        "password": password,
+        "firstname": "Peter",
+        "lastname": "Parker",
+        "gender": "Male",
+        "city": "Linkoping",
+        "country": "Sweden",
+    })
+    assert response.status_code == http.HTTPStatus.CREATED
+
+    response = requests.post("http://localhost:8080/api/v1/session", json={"email": email, "password": password})
+    assert response.status_code == http.HTTPStatus.CREATED
+    return response.headers["Authorization"]
+
+
+def _create_post(email: str, session_id: str, message: str, wall_email: str | None = None, media: str | None = None) -> int:
+    body = json.dumps({"email": wall_email or email, "message": message, "media": media})
+    response = requests.post("http://localhost:8080/api/v1/posts", data=body, headers={
+        "Content-Type": "application/json",
+        "Authorization": _authorization_header(email, session_id, body),
+    })
+    assert response.status_code == http.HTTPStatus.CREATED
+    return response.json()["id"]
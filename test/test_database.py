@@ -0,0 +1,263 @@
+import concurrent.futures
+import datetime
+import sqlite3
+
+import pytest
+
+from twidder import database_handler, event_handler
+from twidder.server import app
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch) -> str:
+    # every test uses its own database file, the config is restored after the test
+    database_file = str(tmp_path / "database.db")
+    monkeypatch.setitem(app.config, "DATABASE_FILE", database_file)
+    return database_file
+
+
+def test_migrate_existing_database(database):
+    # create a database with the original schema and some data
+    with sqlite3.connect(database) as db:
+        db.executescript("""
+            create table user (email text primary key, password text NOT NULL, firstname text NOT NULL, lastname text NOT NULL,
+                               gender text NOT NULL, city text NOT NULL, country text NOT NULL, image blob);
+            create table post (id integer primary key AUTOINCREMENT, author text not NULL, user text NOT NULL, content text NOT NULL,
+                               created datetime NOT NULL, edited datetime, media blob);
+            insert into user values ('peter@parker.com', 'hash', 'Peter', 'Parker', 'Male', 'Linkoping', 'Sweden', NULL);
+            insert into post values (1, 'peter@parker.com', 'peter@parker.com', 'hey!', '2024-01-01 00:00:00', NULL, NULL);
+        """)
+
+    with app.app_context():
+        database_handler.initialize_database()
+        database_handler.initialize_database()  # already migrated database is left untouched
+
+        # data are preserved
+        assert database_handler.get_user_by_email("peter@parker.com")["revision"] == 0
+        assert [post["content"] for post in database_handler.list_posts_by_user("peter@parker.com")] == ["hey!"]
+        assert database_handler.get_posts_version("peter@parker.com")["version"] == 1
+        assert database_handler.get_posts_version()["version"] == 1
+
+        # schema is at the latest version
+        db = database_handler.get_db()
+        assert db.execute("PRAGMA user_version").fetchone()[0] == len(database_handler._list_migrations())
+        plan = db.execute("EXPLAIN QUERY PLAN select id from post where user==? order by id desc", ["peter@parker.com"]).fetchall()
+        assert "post_user_id" in plan[0][3]
+
+
+def test_user_cache(monkeypatch, database):
+    monkeypatch.setitem(app.config, "USER_CACHE_SIZE", 16)
+    with app.app_context():
+        database_handler.initialize_database()
+        assert not database_handler.user_exists("peter@parker.com")
+        assert database_handler.create_user("peter@parker.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        assert database_handler.user_exists("peter@parker.com")
+
+        # modifying the retrieved user doesn't modify the cached one
+        user = database_handler.get_user_by_email("peter@parker.com")
+        user["city"] = "Stockholm"
+        assert database_handler.get_user_by_email("peter@parker.com")["city"] == "Linkoping"
+
+    # other requests are served by the process cache, until the user is updated
+    with app.app_context():
+        assert database_handler.get_user_cache().get("peter@parker.com")["city"] == "Linkoping"
+        assert database_handler.update_user_by_email("peter@parker.com", "peter@parker.com", "hash", "Peter", "Parker", "Male", "Stockholm", "Sweden", None)
+        assert database_handler.get_user_cache().get("peter@parker.com") is None
+        assert database_handler.get_user_by_email("peter@parker.com")["city"] == "Stockholm"
+
+    # a user cached by a concurrent request before the transaction commits is invalidated again by the commit
+    def read_user():
+        with app.app_context():
+            return database_handler.get_user_by_email("peter@parker.com")
+
+    with app.app_context():
+        with database_handler.transaction():
+            assert database_handler.update_user_by_email("peter@parker.com", "peter@parker.com", "hash", "Peter", "Parker", "Male", "Uppsala", "Sweden", None)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(read_user).result()
+            assert database_handler.get_user_cache().get("peter@parker.com")["city"] == "Stockholm"
+        assert database_handler.get_user_cache().get("peter@parker.com") is None
+
+    with app.app_context():
+        assert database_handler.delete_user_by_email("peter@parker.com")
+        assert database_handler.get_user_by_email("peter@parker.com") is None
+        assert not database_handler.user_exists("peter@parker.com")
+
+
+def test_feed_fanout(database):
+    with app.app_context():
+        database_handler.initialize_database()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for name in ("reader", "friend", "star", "fan"):
+            assert database_handler.create_user(f"{name}@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        old_post = database_handler.create_post("friend@test.com", "friend@test.com", "old", now, now, None)
+
+        # with the fan-out limit of one follower, posts of 'star' are read by its two followers on their own
+        assert database_handler.follow_user("reader@test.com", "friend@test.com", now, 1, 10)
+        assert database_handler.follow_user("reader@test.com", "star@test.com", now, 1, 10)
+        assert database_handler.follow_user("fan@test.com", "star@test.com", now, 1, 10)
+        own_post = database_handler.create_post("reader@test.com", "reader@test.com", "own", now, now, None)
+        friend_post = database_handler.create_post("friend@test.com", "friend@test.com", "friend", now, now, None)
+        star_post = database_handler.create_post("star@test.com", "star@test.com", "star", now, now, None)
+
+        feed = [post["id"] for post in database_handler.list_feed("reader@test.com")]
+        assert feed == [star_post, friend_post, own_post, old_post]
+        assert [post["id"] for post in database_handler.list_feed("reader@test.com", before_id=friend_post, limit=1)] == [own_post]
+        assert [post["id"] for post in database_handler.list_feed("fan@test.com")] == [star_post]
+        assert database_handler.get_db().execute("select count(*) from timeline where post==?", [star_post]).fetchone()[0] == 1  # only the author's
+
+        # unfollowing and deleting posts removes them from feeds
+        assert database_handler.unfollow_user("reader@test.com", "friend@test.com")
+        assert database_handler.delete_post_by_id(star_post)
+        assert [post["id"] for post in database_handler.list_feed("reader@test.com")] == [own_post]
+        assert database_handler.is_following("reader@test.com", "star@test.com")
+        assert database_handler.delete_user_by_email("star@test.com")
+        assert not database_handler.is_following("reader@test.com", "star@test.com")
+
+
+def test_search_rank_window(database):
+    with app.app_context():
+        database_handler.initialize_database()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        assert database_handler.create_user("search@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        post_ids = [database_handler.create_post("search@test.com", "search@test.com", f"zebra {i}", now, now, None) for i in range(5)]
+
+        # only the newest matches are ranked, the number of matches tells whether some were left out
+        assert sorted(post["id"] for post in database_handler.search_posts("zebra", window=2)) == post_ids[-2:]
+        assert database_handler.count_search_matches("zebra", limit=3) == 3
+        assert database_handler.count_search_matches("zebra", "search@test.com") == 5
+        assert database_handler.count_search_matches("giraffe") == 0
+
+
+def test_transaction_and_bulk_writes(database):
+    with app.app_context():
+        database_handler.initialize_database()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        users = [{"email": f"user{i}@test.com", "password": "hash", "firstname": "Peter", "lastname": "Parker", "gender": "Male", "city": "Linkoping",
+                  "country": "Sweden"} for i in range(3)]
+        assert database_handler.create_users(users) == 3
+        assert database_handler.create_users(users[:1]) == -1  # duplicate email, nothing is written
+
+        # posts of bulk writes are fanned out to feeds
+        assert database_handler.follow_user("user1@test.com", "user0@test.com", now, 10, 10)
+        assert database_handler.create_posts([{"author": "user0@test.com", "user": "user0@test.com", "content": f"post {i}", "created": now}
+                                              for i in range(5)]) == 5
+        assert [post["content"] for post in database_handler.list_feed("user1@test.com")] == [f"post {i}" for i in reversed(range(5))]
+        assert database_handler.create_posts([{"author": "unknown@test.com", "user": "user0@test.com", "content": "post", "created": now}]) == -1
+
+        # writes of a transaction are rolled back together when one of them fails
+        with database_handler.transaction():
+            assert database_handler.delete_posts_by_author("user0@test.com")
+            assert not database_handler.create_user("user1@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        assert len(database_handler.list_posts_by_author("user0@test.com")) == 5
+
+        with database_handler.transaction():
+            with database_handler.transaction():
+                assert database_handler.delete_posts_by_author("user0@test.com")
+            assert database_handler.delete_user_by_email("user0@test.com")
+        assert database_handler.list_posts_by_author("user0@test.com") == []
+        assert not database_handler.user_exists("user0@test.com")
+
+
+def test_query_log(monkeypatch, database, caplog):
+    monkeypatch.setitem(app.config, "SLOW_QUERY_THRESHOLD_MS", None)
+    with app.app_context():
+        database_handler.initialize_database()
+        db = database_handler.get_db()
+        for email in ("peter@parker.com", "mary@jane.com"):
+            db.execute("select email from user where email==?", [email]).fetchall()
+        db.execute("select email from user where city==? and country in (?, ?)", ["Linkoping", "Sweden", "Norway"]).fetchall()
+
+        # queries differing only in parameters share one fingerprint, full table scans are detected from the query plan
+        queries = {query["query"]: query for query in db.query_log.top(100)}
+        assert queries["select email from user where email==?"]["count"] == 2
+        assert not queries["select email from user where email==?"]["full_scan"]
+        assert queries["select email from user where city==? and country in (?, ...)"]["full_scan"]
+
+        # slow queries are logged with parameter types, but not their values
+        db.query_log.slow_query_threshold = 0.0
+        db.execute("select email from user where password==?", ["secret hash"]).fetchall()
+        assert "slow query" in caplog.text and "(str)" in caplog.text and "SCAN user" in caplog.text
+        assert "secret hash" not in caplog.text
+
+
+def test_writer_group_commit(monkeypatch, database):
+    monkeypatch.setitem(app.config, "DATABASE_WRITE_WINDOW", 0.05)  # wait for all writes, so they are grouped into one transaction
+    with app.app_context():
+        database_handler.initialize_database()
+        assert database_handler.create_user("writer@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    def write(i: int):
+        with app.app_context():
+            if i % 5 == 0:
+                # duplicate user, rolled back alone
+                return database_handler.create_user("writer@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+            return database_handler.create_post("writer@test.com", "writer@test.com", f"post {i}", now, now, None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(write, range(20)))
+    assert [result for i, result in enumerate(results) if i % 5 == 0] == [False] * 4
+    assert len(set(result for i, result in enumerate(results) if i % 5 != 0)) == 16  # ids of created posts
+
+    with app.app_context():
+        assert len(database_handler.list_posts_by_user("writer@test.com")) == 16
+        stats = database_handler.get_writer().stats()
+        assert stats["writes"] == 21
+        assert stats["transactions"] < stats["writes"]
+        assert stats["retried_transactions"] == 0
+
+
+def test_writer_failure(database):
+    class Crash(BaseException):
+        pass
+
+    def crash():
+        raise Crash()
+
+    with app.app_context():
+        database_handler.initialize_database()
+
+        # an unexpected error stops the writer, its callers get an error instead of waiting forever
+        writer = database_handler.get_writer()
+        future = writer.submit(crash, (), {}, {})
+        with pytest.raises(sqlite3.OperationalError):
+            future.result(timeout=5)
+        assert writer.failed
+        with pytest.raises(sqlite3.OperationalError):
+            writer.submit(crash, (), {}, {}).result(timeout=5)
+
+        # the next write starts a new writer
+        assert database_handler.create_user("writer@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+        assert database_handler.get_writer() is not writer
+
+
+def test_read_only_connections(database):
+    with app.app_context():
+        database_handler.initialize_database()
+        assert database_handler.create_user("reader@test.com", "hash", "Peter", "Parker", "Male", "Linkoping", "Sweden", None)
+
+        # reads see committed writes, but can't write themselves
+        read_db = database_handler.get_read_db()
+        assert read_db is not database_handler.get_db()
+        assert database_handler.user_exists("reader@test.com")
+        with pytest.raises(sqlite3.OperationalError):
+            read_db.execute("delete from user")
+
+        # within a transaction, reads see its writes which are not committed yet
+        with database_handler.transaction():
+            assert database_handler.delete_user_by_email("reader@test.com")
+            assert database_handler.get_read_db() is database_handler.get_db()
+            assert not database_handler.user_exists("reader@test.com")
+        assert not database_handler.user_exists("reader@test.com")
+
+
+def test_wall_events_deleted_without_subscribers(monkeypatch, database):
+    monkeypatch.setitem(app.config, "WALL_EVENT_RETENTION", 0)
+    with app.app_context():
+        database_handler.initialize_database()
+
+        # publishers delete old events, also in processes without a dispatcher
+        for i in range(3):
+            assert event_handler.publish("events@test.com", {"type": "post_deleted", "id": i})
+        assert [event["event"] for event in database_handler.list_wall_events(0)] == ['{"type": "post_deleted", "id": 2}']
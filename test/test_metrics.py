@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+from twidder import metrics
+from twidder.server import app
+
+
+def test_stopped_process_counters_are_kept(tmp_path, monkeypatch):
+    folder = str(tmp_path / "metrics")
+    monkeypatch.setitem(app.config, "METRICS_FOLDER", folder)
+
+    # a worker process which wrote its snapshot and stopped
+    worker = metrics.Metrics()
+    worker.pid = int(subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, check=True, text=True).stdout)
+    worker.start_request("api.posts.list_posts")
+    worker.finish_request("api.posts.list_posts", "GET", "200", 0.02, 3, 0.001)
+    worker.start_request("api.posts.list_posts")
+    worker.flush(folder)
+
+    labels = 'endpoint="api.posts.list_posts",method="GET",status="200"'
+    with app.test_request_context():
+        for _ in range(2):
+            # the snapshot is retired by the first scrape, its counters are kept but its requests are not in progress anymore
+            text = metrics.render({})
+            assert f"twidder_http_request_duration_seconds_count{{{labels}}} 1" in text
+            assert 'twidder_sql_queries_total{endpoint="api.posts.list_posts"} 3' in text
+            assert 'twidder_http_requests_in_flight{endpoint="api.posts.list_posts"}' not in text
@@ -0,0 +1,61 @@
+import os
+import threading
+
+from twidder import session_handler
+from twidder.server import app
+from twidder.session_handler import MemorySessionBackend, SQLiteSessionBackend
+
+
+def test_memory_backend():
+    backend = MemorySessionBackend()
+    assert backend.get("peter@parker.com") is None
+
+    backend.set("peter@parker.com", "first")
+    backend.set("peter@parker.com", "second")
+    assert backend.get("peter@parker.com") == "second"
+    assert backend.count() == 1
+
+    backend.delete("peter@parker.com")
+    backend.delete("peter@parker.com")
+    assert backend.get("peter@parker.com") is None
+    assert backend.count() == 0
+
+
+def test_sqlite_backend_is_shared(tmp_path):
+    # two backends on the same file behave like two worker processes
+    database_file = str(tmp_path / "sessions.db")
+    worker_1 = SQLiteSessionBackend(database_file)
+    worker_2 = SQLiteSessionBackend(database_file)
+
+    worker_1.set("peter@parker.com", "first")
+    assert worker_2.get("peter@parker.com") == "first"
+
+    worker_2.set("peter@parker.com", "second")
+    assert worker_1.get("peter@parker.com") == "second"
+    assert worker_1.count() == 1
+
+    worker_2.delete("peter@parker.com")
+    assert worker_1.get("peter@parker.com") is None
+    assert worker_1.count() == 0
+
+
+def test_subscription_notified_by_other_process(tmp_path, monkeypatch):
+    database_file = str(tmp_path / "sessions.db")
+    monkeypatch.setattr(session_handler, "_backend", SQLiteSessionBackend(database_file))
+    monkeypatch.setattr(session_handler, "_backend_pid", os.getpid())
+    other_process = SQLiteSessionBackend(database_file)
+
+    with app.app_context():
+        session_id = session_handler.create_session("peter@parker.com")
+        invalidated = threading.Event()
+        subscription = session_handler.subscribe("peter@parker.com", session_id, invalidated.set)
+        try:
+            # changes of other sessions don't invalidate the subscribed one
+            other_process.set("adam@cool.com", "other")
+            assert not invalidated.wait(timeout=3 * app.config["SESSION_WATCH_INTERVAL"])
+
+            # session deleted by another process is noticed by the watcher
+            other_process.delete("peter@parker.com")
+            assert invalidated.wait(timeout=5.0)
+        finally:
+            session_handler.unsubscribe(subscription)
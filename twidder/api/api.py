@@ -2,6 +2,10 @@ import http
 
 from flask import jsonify, Blueprint
 
+from twidder import util
+from twidder.api.v1.admin import blueprint as api_v1_admin
+from twidder.api.v1.feed import blueprint as api_v1_feed
+from twidder.api.v1.media import blueprint as api_v1_media
 from twidder.api.v1.posts import blueprint as api_v1_posts
 from twidder.api.v1.session import blueprint as api_v1_session
 from twidder.api.v1.users import blueprint as api_v1_users
@@ -10,6 +14,9 @@ blueprint = Blueprint('api', __name__)
 blueprint.register_blueprint(api_v1_session, url_prefix="/v1/session")
 blueprint.register_blueprint(api_v1_users, url_prefix="/v1/users")
 blueprint.register_blueprint(api_v1_posts, url_prefix="/v1/posts")
+blueprint.register_blueprint(api_v1_feed, url_prefix="/v1/feed")
+blueprint.register_blueprint(api_v1_media, url_prefix="/v1/media")
+blueprint.register_blueprint(api_v1_admin, url_prefix="/v1/admin")
 
 
 @blueprint.route("/", defaults={"path": ""})
@@ -21,3 +28,8 @@ def get_page(path: str):
 @blueprint.errorhandler(http.HTTPStatus.INTERNAL_SERVER_ERROR)
 def not_found(e):
     return jsonify({"message": "internal server error"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@blueprint.errorhandler(util.PasswordHashingBusyError)
+def password_hashing_busy(e):
+    return jsonify({"message": "server is busy, try again later"}), http.HTTPStatus.TOO_MANY_REQUESTS, {"Retry-After": "1"}
@@ -0,0 +1,117 @@
+import datetime
+import http
+import json
+
+from flask import jsonify, Blueprint, request, current_app
+
+from twidder import database_handler, util
+
+blueprint = Blueprint('admin', __name__)
+
+
+@blueprint.route("/database", methods=["GET"])
+@util.authorize_admin
+def get_database_stats():
+    """Get database connection pools and writer statistics."""
+    writer = database_handler.get_writer().stats() if current_app.config["DATABASE_WRITER"] else None
+    return jsonify({"pool": database_handler.get_pool().stats(), "read_pool": database_handler.get_read_pool().stats(), "writer": writer}), http.HTTPStatus.OK
+
+
+@blueprint.route("/queries", methods=["GET"])
+@util.authorize_admin
+def get_query_stats():
+    """Get statistics and plans of the most expensive SQL queries executed by the current process."""
+    limit = request.args.get("limit", default=20, type=int)
+    if limit < 1:
+        return jsonify({"message": "parameter 'limit' must be positive"}), http.HTTPStatus.BAD_REQUEST
+    pool = database_handler.get_pool()
+    return jsonify({"queries": pool.query_log.top(limit), "slow_query_threshold": pool.query_log.slow_query_threshold}), http.HTTPStatus.OK
+
+
+@blueprint.route("/passwords", methods=["GET"])
+@util.authorize_admin
+def get_password_hashing_stats():
+    """Get password hashing statistics."""
+    return jsonify({"hashing": util.get_password_hasher().stats()}), http.HTTPStatus.OK
+
+
+@blueprint.route("/import", methods=["POST"])
+@util.authorize_admin
+def import_data():
+    """
+    Import users and posts in bulk, e.g. to seed a staging environment. The body is streamed NDJSON, one user or post record per line.
+    Records are written in batches of 'IMPORT_BATCH_SIZE', batches written before an invalid record are kept.
+    """
+    users, posts = [], []
+    imported = {"users": 0, "posts": 0}
+
+    def write_batch() -> bool:
+        # plain text passwords of the batch are hashed at once, by all hashing processes
+        plain_users = [user for user in users if not user["hashed"]]
+        for user, password in zip(plain_users, util.hash_passwords([user["password"] for user in plain_users])):
+            user["password"], user["hashed"] = password, True
+
+        # users are written first, as posts reference them
+        for name, records, create in (("users", users, database_handler.create_users), ("posts", posts, database_handler.create_posts)):
+            if records:
+                if create(records) == -1:
+                    return False
+                imported[name] += len(records)
+                records.clear()
+        return True
+
+    for line_number, line in enumerate(request.stream, start=1):
+        if line.strip() == b"":
+            continue
+        try:
+            record = _parse_import_record(json.loads(line))
+        except ValueError as e:
+            if not write_batch():
+                return jsonify({"message": f"couldn't import records before line {line_number}", "imported": imported}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+            return jsonify({"message": f"invalid record on line {line_number}: {e}", "imported": imported}), http.HTTPStatus.BAD_REQUEST
+
+        (users if record["type"] == "user" else posts).append(record)
+        if len(users) + len(posts) >= current_app.config["IMPORT_BATCH_SIZE"] and not write_batch():
+            return jsonify({"message": f"couldn't import records before line {line_number + 1}", "imported": imported}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    if not write_batch():
+        return jsonify({"message": "couldn't import the last records", "imported": imported}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"message": "data successfully imported", "imported": imported}), http.HTTPStatus.OK
+
+
+def _parse_import_record(record) -> dict:
+    """
+    Validate an imported user or post record.
+    Users have the same fields as when they are created, their password is either given in plain text ('password'), or already hashed ('password_hash').
+    Plain text passwords are not hashed yet, as they are hashed by batches ('hashed' is False).
+    Posts have fields 'author', 'user', 'content' and optionally 'created' (ISO 8601 datetime, the current datetime by default).
+
+    :param record: decoded JSON record, with field 'type' either 'user' or 'post'
+    :return: dictionary of the user or the post information, as accepted by database_handler.create_users() or database_handler.create_posts()
+    :raises ValueError: if the record is invalid
+    """
+    if not isinstance(record, dict) or record.get("type") not in ("user", "post"):
+        raise ValueError("'type' must be 'user' or 'post'")
+
+    fields = ("email", "firstname", "lastname", "gender", "city", "country") if record["type"] == "user" else ("author", "user", "content")
+    for field in fields:
+        if not isinstance(record.get(field), str) or record[field] == "":
+            raise ValueError(f"'{field}' must be a non-empty string")
+
+    if record["type"] == "post":
+        try:
+            created = datetime.datetime.fromisoformat(record["created"]) if "created" in record else datetime.datetime.now(datetime.timezone.utc)
+        except (TypeError, ValueError):
+            raise ValueError("'created' must be an ISO 8601 datetime")
+        return {"type": "post", "author": record["author"], "user": record["user"], "content": record["content"], "created": created}
+
+    if record["gender"] not in ["Female", "Male", "Other"]:
+        raise ValueError("forbidden gender")
+    if not util.is_email_valid(record["email"]):
+        raise ValueError("invalid email")
+    if isinstance(record.get("password_hash"), str) and record["password_hash"].startswith("$2"):
+        password, hashed = record["password_hash"], True
+    elif isinstance(record.get("password"), str) and len(record["password"]) >= current_app.config["MIN_PASSWORD_LENGTH"]:
+        password, hashed = record["password"], False
+    else:
+        raise ValueError(f"'password' must have at least {current_app.config['MIN_PASSWORD_LENGTH']} characters, or 'password_hash' must be a bcrypt hash")
+    return {"type": "user", **{field: record[field] for field in fields}, "password": password, "hashed": hashed}
@@ -0,0 +1,27 @@
+import http
+
+from flask import jsonify, Blueprint, request, current_app
+
+from twidder import database_handler, util
+from twidder.api.v1.posts import POST_FIELDS, MEDIA_FIELDS, post_columns, stream_page
+
+blueprint = Blueprint('feed', __name__)
+
+
+@blueprint.route("", methods=["GET"])
+@util.authorize_user
+def get_feed(user_email: str):
+    """Get posts written by the user and by users they follow, one page at a time, newest first."""
+    before_id = request.args.get("before_id", type=int)
+    limit = request.args.get("limit", default=current_app.config["POSTS_PAGE_SIZE"], type=int)
+    if limit < 1 or limit > current_app.config["POSTS_PAGE_SIZE_MAX"]:
+        return jsonify({"message": f"parameter 'limit' must be between 1 and {current_app.config['POSTS_PAGE_SIZE_MAX']}"}), http.HTTPStatus.BAD_REQUEST
+
+    try:
+        fields = util.parse_fields(POST_FIELDS, media=MEDIA_FIELDS, required=("id",))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+
+    # fetch one extra post to find out whether there is a next page
+    posts = database_handler.list_feed(user_email, before_id, limit + 1, post_columns(fields))
+    return util.stream_json(stream_page(posts, limit, fields, lambda post: post["id"])), http.HTTPStatus.OK
@@ -0,0 +1,121 @@
+import http
+
+from flask import jsonify, Blueprint, send_file, request, current_app
+
+from twidder import database_handler, media_handler, util
+
+blueprint = Blueprint('media', __name__)
+
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60  # media are content-addressed, so they never change
+
+
+@blueprint.route("/<string:media_id>", methods=["GET"])
+def get_media(media_id: str):
+    """Download media. Media are not authorized, so they can be used directly as a source of HTML image and video elements."""
+    if not media_handler.is_media_id(media_id):
+        return jsonify({"message": "media not found"}), http.HTTPStatus.NOT_FOUND
+
+    media = database_handler.get_media_by_id(media_id)
+    if media is None:
+        return jsonify({"message": "media not found"}), http.HTTPStatus.NOT_FOUND
+
+    # conditional responses also handle range requests, so videos can be streamed and seeked
+    response = send_file(media_handler.get_media_path(media_id), mimetype=media["mimetype"], conditional=True, etag=media_id, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@blueprint.route("/uploads", methods=["POST"])
+@util.authorize_user
+@util.post_parameters(("mimetype", str), ("size", int))
+def create_upload(user_email: str, mimetype: str, size: int):
+    """Start an upload of media in chunks, which are sent as raw binary data, instead of a base64 data URL."""
+    if size < 1 or size > current_app.config["MEDIA_UPLOAD_MAX_SIZE"]:
+        return jsonify({"message": f"parameter 'size' must be between 1 and {current_app.config['MEDIA_UPLOAD_MAX_SIZE']}"}), http.HTTPStatus.BAD_REQUEST
+    if not mimetype.startswith(media_handler.ALLOWED_MEDIA_TYPES):
+        return jsonify({"message": "only images and videos can be uploaded"}), http.HTTPStatus.BAD_REQUEST
+
+    upload_id = media_handler.create_upload(user_email, mimetype, size)
+    if upload_id is None:
+        return jsonify({"message": "couldn't start the upload"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"id": upload_id, "offset": 0, "chunk_size": current_app.config["MEDIA_UPLOAD_CHUNK_SIZE"]}), http.HTTPStatus.CREATED
+
+
+@blueprint.route("/uploads/<string:upload_id>", methods=["GET"])
+@util.authorize_user
+def get_upload(user_email: str, upload_id: str):
+    """Get the progress of an upload of media, e.g. to resume it after a dropped connection."""
+    upload = _get_own_upload(user_email, upload_id)
+    if not isinstance(upload, dict):
+        return upload
+    return jsonify({"id": upload["id"], "offset": upload["received"], "size": upload["size"]}), http.HTTPStatus.OK
+
+
+@blueprint.route("/uploads/<string:upload_id>", methods=["PUT"])
+@util.authorize_user_streaming
+def append_upload(user_email: str, body: util.SignedBody, upload_id: str):
+    """
+    Append a chunk of raw binary data to an upload of media. The chunk must start at the offset of data received so far (parameter 'offset').
+    The chunk is authenticated while it is written to the upload, instead of being buffered first.
+    """
+    upload = _get_own_upload(user_email, upload_id)
+    if not isinstance(upload, dict):
+        return upload
+
+    # a chunk sent again after a dropped response is rejected, the client resumes from the returned offset
+    offset = request.args.get("offset", type=int)
+    if offset != upload["received"]:
+        return jsonify({"message": "chunk doesn't start at the offset of received data", "offset": upload["received"]}), http.HTTPStatus.CONFLICT
+    if request.content_length is not None and upload["received"] + request.content_length > upload["size"]:
+        return jsonify({"message": "chunk exceeds the media size"}), http.HTTPStatus.BAD_REQUEST
+
+    received = media_handler.append_upload(upload, body, body.verify)
+    if received == -1:
+        upload = database_handler.get_media_upload(upload_id) or upload
+        return jsonify({"message": "couldn't append the chunk", "offset": upload["received"]}), http.HTTPStatus.CONFLICT
+    return jsonify({"id": upload_id, "offset": received, "size": upload["size"]}), http.HTTPStatus.OK
+
+
+@blueprint.route("/uploads/<string:upload_id>", methods=["POST"])
+@util.authorize_user
+def complete_upload(user_email: str, upload_id: str):
+    """Complete an upload of media, whose all chunks have been received. The returned media id can be referenced by posts and user profiles."""
+    upload = _get_own_upload(user_email, upload_id)
+    if not isinstance(upload, dict):
+        return upload
+    if upload["received"] != upload["size"]:
+        return jsonify({"message": "upload is not complete", "offset": upload["received"]}), http.HTTPStatus.CONFLICT
+
+    media_id = media_handler.complete_upload(upload)
+    if media_id is None:
+        return jsonify({"message": "couldn't store the media"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"id": media_id, "url": media_handler.get_media_url(media_id)}), http.HTTPStatus.CREATED
+
+
+@blueprint.route("/uploads/<string:upload_id>", methods=["DELETE"])
+@util.authorize_user
+def delete_upload(user_email: str, upload_id: str):
+    """Cancel an upload of media."""
+    upload = _get_own_upload(user_email, upload_id)
+    if not isinstance(upload, dict):
+        return upload
+    if not media_handler.delete_upload(upload_id):
+        return jsonify({"message": "couldn't delete the upload"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"message": "upload successfully deleted"}), http.HTTPStatus.OK
+
+
+def _get_own_upload(user_email: str, upload_id: str):
+    """
+    Get an upload of media started by the given user.
+
+    :param user_email: email of the user
+    :param upload_id: upload id
+    :return: dictionary of the upload information, or an error response if the upload doesn't exist or belongs to another user
+    """
+    upload = database_handler.get_media_upload(upload_id) if media_handler.is_upload_id(upload_id) else None
+    if upload is None:
+        return jsonify({"message": "upload not found"}), http.HTTPStatus.NOT_FOUND
+    if upload["owner"] != user_email:
+        return jsonify({"message": "you can access only your uploads"}), http.HTTPStatus.FORBIDDEN
+    return upload
@@ -1,13 +1,19 @@
 import datetime
 import http
+from collections.abc import Callable, Iterable
 
 from flask import jsonify, Blueprint, request, current_app
 
-from twidder import database_handler
+from twidder import database_handler, event_handler, media_handler
 from twidder import util
+from twidder.api.v1.users import get_users_json
 
 blueprint = Blueprint('posts', __name__)
 
+POST_FIELDS = ("id", "author", "user", "content", "created", "edited", "media", "media_type", "media_original", "media_preview")  # fields of the post API representation
+MEDIA_FIELDS = ("media", "media_type", "media_original", "media_preview")
+AUTHOR_FIELDS = ("email", "firstname", "lastname", "image")  # fields of post authors embedded by 'include_authors'
+
 
 @blueprint.route("", methods=["POST"])
 @util.authorize_user
@@ -15,49 +21,119 @@ blueprint = Blueprint('posts', __name__)
 def create_post(user_email: str, message: str, email: str):
     """Create a new post."""
 
-    # parse optional parameter 'media'
-    media = None
-    if "media" in (body := request.get_json()):
-        media = body["media"]
-
-    if database_handler.get_user_by_email(email) is None:
+    if not database_handler.user_exists(email):
         return jsonify({"message": "user doesn't exist"}), http.HTTPStatus.FORBIDDEN
 
+    # parse optional parameter 'media' and store it in the blob store, the post only references it
+    media = None
+    if (body := request.get_json()).get("media") is not None:
+        media = media_handler.resolve_media(body["media"]) if isinstance(body["media"], str) else None
+        if media is None:
+            return jsonify({"message": "invalid media"}), http.HTTPStatus.BAD_REQUEST
+
     curr_datetime = datetime.datetime.now(datetime.timezone.utc)
     post_id = database_handler.create_post(user_email, email, message, curr_datetime, curr_datetime, media)
     if post_id == -1:
         return jsonify({"message": "couldn't create a new post"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+    # notify clients viewing the wall
+    if not event_handler.publish(email, {"type": "post_created", "wall": email, "post": post_to_json(database_handler.get_post_by_id(post_id))}):
+        current_app.logger.warning(f"couldn't publish wall event: {post_id=}")
     return jsonify({"message": "post successfully created", "id": post_id}), http.HTTPStatus.CREATED
 
 
 @blueprint.route("", methods=["GET"])
 @util.authorize_user
 def list_posts(user_email: str):
-    """Get user posts."""
+    """Get user posts, one page at a time, newest first."""
     target_email = request.args.get("user_email")
 
+    # parse pagination parameters
+    before_id = request.args.get("before_id", type=int)
+    limit = request.args.get("limit", default=current_app.config["POSTS_PAGE_SIZE"], type=int)
+    if limit < 1 or limit > current_app.config["POSTS_PAGE_SIZE_MAX"]:
+        return jsonify({"message": f"parameter 'limit' must be between 1 and {current_app.config['POSTS_PAGE_SIZE_MAX']}"}), http.HTTPStatus.BAD_REQUEST
+
+    # parse projection parameters, media can be fetched later for every post on its own
+    try:
+        fields = util.parse_fields(POST_FIELDS, media=MEDIA_FIELDS, required=("id",))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+    include_authors = request.args.get("include_authors", "false").lower() in ("true", "1")
+
     if target_email is not None:
-        user = database_handler.get_user_by_email(target_email)
-        if user is None:
+        if not database_handler.user_exists(target_email):
             return jsonify({"message": "user not found"}), http.HTTPStatus.NOT_FOUND
-        posts = database_handler.list_posts_by_user(target_email)
-    else:
-        posts = database_handler.list_post()
-
-    return jsonify({
-        "posts": [
-            {
-                "id": post["id"],
-                "author": post["author"],
-                "user": post["user"],
-                "content": post["content"],
-                "created": post["created"],
-                "edited": post["edited"],
-                "media": post["media"],
-
-            } for post in posts
-        ]
-    }), http.HTTPStatus.OK
+
+    # the page changes only if posts are created, edited or deleted, or thumbnails of their media are generated, embedded authors are checked once they are loaded
+    version = database_handler.get_posts_version(target_email)
+    etag = util.make_etag(target_email, version["version"], before_id, limit, fields, include_authors)
+    last_modified = datetime.datetime.fromisoformat(version["updated"]) if version["updated"] is not None else None
+    if not include_authors and util.is_not_modified(etag, last_modified):
+        return util.not_modified(etag, last_modified)
+
+    # fetch one extra post to find out whether there is a next page, posts are serialized while they are read from the database
+    columns = post_columns(fields)
+    if include_authors and "author" not in columns:
+        columns += ("author",)
+    posts = database_handler.iter_posts(target_email, before_id, limit + 1, columns)
+    if not include_authors:
+        return util.set_cache_headers(util.stream_json(stream_page(posts, limit, fields, lambda post: post["id"])), etag, last_modified), http.HTTPStatus.OK
+
+    # every author is sent once per page, instead of being requested by the client once per post
+    posts = list(posts)
+    authors = get_users_json([post["author"] for post in posts[:limit]], AUTHOR_FIELDS)
+    etag = util.make_etag(etag, sorted((email, sorted(author.items())) for email, author in authors.items()))
+    if util.is_not_modified(etag):
+        return util.not_modified(etag)
+    page = stream_page(posts, limit, fields, lambda post: post["id"]) | {"authors": authors}
+    return util.set_cache_headers(util.stream_json(page), etag), http.HTTPStatus.OK  # authors may change without changing posts, so there is no modification time
+
+
+@blueprint.route("/search", methods=["GET"])
+@util.authorize_user
+def search_posts(user_email: str):
+    """Search posts by their content, best matches first, one page at a time."""
+    query = request.args.get("q", "")
+    if query.strip() == "":
+        return jsonify({"message": "parameter 'q' must not be empty"}), http.HTTPStatus.BAD_REQUEST
+    target_email = request.args.get("user_email")
+
+    # parse pagination parameters, matches are ranked by relevance, so pages are addressed by offset
+    offset = request.args.get("offset", default=0, type=int)
+    limit = request.args.get("limit", default=current_app.config["POSTS_PAGE_SIZE"], type=int)
+    if offset < 0:
+        return jsonify({"message": "parameter 'offset' must not be negative"}), http.HTTPStatus.BAD_REQUEST
+    if limit < 1 or limit > current_app.config["POSTS_PAGE_SIZE_MAX"]:
+        return jsonify({"message": f"parameter 'limit' must be between 1 and {current_app.config['POSTS_PAGE_SIZE_MAX']}"}), http.HTTPStatus.BAD_REQUEST
+
+    try:
+        fields = util.parse_fields(POST_FIELDS, media=MEDIA_FIELDS, required=("id",))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+
+    # only the newest matches are ranked, clients are told if there were more of them, as pages beyond the window are empty
+    window = current_app.config["SEARCH_RANK_WINDOW"]
+    truncated = window is not None and database_handler.count_search_matches(query, target_email, window + 1) > window
+
+    # fetch one extra post to find out whether there is a next page
+    posts = database_handler.search_posts(query, target_email, offset, limit + 1, post_columns(fields), window)
+    return util.stream_json(stream_page(posts, limit, fields, lambda post: offset + limit) | {"truncated": truncated}), http.HTTPStatus.OK
+
+
+@blueprint.route("/<string:post_id>", methods=["GET"])
+@util.authorize_user
+def get_post(user_email: str, post_id: str):
+    """Get a post, e.g. its media left out of the wall listing."""
+    try:
+        fields = util.parse_fields(POST_FIELDS, media=MEDIA_FIELDS, required=("id",))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+
+    post = database_handler.get_post_by_id(post_id, post_columns(fields))
+    if post is None:
+        return jsonify({"message": "post not found"}), http.HTTPStatus.NOT_FOUND
+    return jsonify(post_to_json(post, fields)), http.HTTPStatus.OK
 
 
 @blueprint.route("/<string:post_id>", methods=["PATCH"])
@@ -86,7 +162,12 @@ def update_post(user_email: str, post_id: str):
 
     # update media
     if "media" in body:
-        post["media"] = body["media"]
+        if body["media"] is None:
+            post["media"] = None
+        else:
+            post["media"] = media_handler.resolve_media(body["media"]) if isinstance(body["media"], str) else None
+            if post["media"] is None:
+                return jsonify({"message": "invalid media"}), http.HTTPStatus.BAD_REQUEST
 
     # update edited time
     post["edited"] = datetime.datetime.now(datetime.timezone.utc)
@@ -102,6 +183,10 @@ def update_post(user_email: str, post_id: str):
             post["media"],
     ):
         return jsonify({"message": "couldn't update post"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+    # notify clients viewing the wall
+    if not event_handler.publish(post["user"], {"type": "post_updated", "wall": post["user"], "post": post_to_json(database_handler.get_post_by_id(post_id))}):
+        current_app.logger.warning(f"couldn't publish wall event: {post_id=}")
     return jsonify({"message": "post successfully updated"}), http.HTTPStatus.OK
 
 
@@ -115,9 +200,62 @@ def delete_post(user_email: str, post_id: str):
         return jsonify({"message": "you can delete only your posts, or posts on your wall"}), http.HTTPStatus.FORBIDDEN
     if not database_handler.delete_post_by_id(post_id):
         return jsonify({"message": "couldn't delete the post"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+    # notify clients viewing the wall
+    if not event_handler.publish(post["user"], {"type": "post_deleted", "wall": post["user"], "id": post["id"]}):
+        current_app.logger.warning(f"couldn't publish wall event: {post_id=}")
     return jsonify({"message": "post successfully deleted"}), http.HTTPStatus.OK
 
 
-@blueprint.teardown_request
-def after_request(exception):
-    database_handler.disconnect_db()
+def post_columns(fields: tuple[str, ...]) -> tuple[str, ...]:
+    """
+    Get post columns needed for the given fields of the post API representation.
+
+    :param fields: fields of the representation
+    :return: post fields to retrieve from the database
+    """
+    columns = tuple(field for field in fields if field in database_handler.POST_COLUMNS and field not in MEDIA_FIELDS)
+    if any(field in MEDIA_FIELDS for field in fields):
+        columns += ("media", "media_type", "media_thumbnail")
+    return columns
+
+
+def stream_page(posts: Iterable[dict], limit: int, fields: tuple[str, ...], make_cursor: Callable[[dict], int]) -> dict:
+    """
+    Create a page of posts to be streamed by util.stream_json(). Posts are converted into their API representation while they are streamed.
+
+    :param posts: posts of the page, followed by the first post of the next page if there is one
+    :param limit: maximum number of posts in the page
+    :param fields: fields of the post representation
+    :param make_cursor: function creating the cursor of the next page from the last post of the page
+    :return: page with the 'posts' and the 'next_cursor' (None on the last page), which is known once the posts are streamed
+    """
+    next_cursor = None
+
+    def stream() -> Iterable[dict]:
+        nonlocal next_cursor
+        last_post = None
+        for index, post in enumerate(posts):
+            if index == limit:
+                next_cursor = make_cursor(last_post)
+                return
+            last_post = post
+            yield post_to_json(post, fields)
+
+    return {"posts": stream(), "next_cursor": lambda: next_cursor}
+
+
+def post_to_json(post: dict, fields: tuple[str, ...] = POST_FIELDS) -> dict:
+    """
+    Convert post information into its API representation. Images are represented by their thumbnails, if they are available.
+
+    :param post: dictionary of post information
+    :param fields: fields of the representation, the post must contain all columns needed for them
+    :return: JSON serializable post
+    """
+    post_json = {field: post[field] for field in fields if field not in MEDIA_FIELDS}
+    if "media" in post:
+        urls = media_handler.get_media_urls(post["media"], post["media_type"], post["media_thumbnail"])
+        media_json = {"media": urls["url"], "media_type": post["media_type"], "media_original": urls["original"], "media_preview": urls["preview"]}
+        post_json |= {field: media_json[field] for field in fields if field in MEDIA_FIELDS}
+    return post_json
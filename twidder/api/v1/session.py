@@ -11,7 +11,7 @@ blueprint = Blueprint('session', __name__)
 @util.post_parameters(("email", str), ("password", str))
 def create_session(email: str, password: str):
     """Create a new session."""
-    user = database_handler.get_user_by_email(email)
+    user = database_handler.get_user_by_email(email, ("password",))
 
     if user is not None and util.check_password(password, user["password"]):
         session_id = session_handler.create_session(email)
@@ -27,8 +27,3 @@ def delete_session(user_email: str):
     """Destroy existing session."""
     session_handler.delete_session(user_email)
     return jsonify({"message": "session successfully deleted"}), http.HTTPStatus.OK
-
-
-@blueprint.teardown_request
-def after_request(exception):
-    database_handler.disconnect_db()
@@ -1,11 +1,16 @@
+import datetime
 import http
 
-from flask import jsonify, Blueprint, current_app
+from flask import jsonify, Blueprint, request, current_app
 
-from twidder import database_handler, session_handler, util
+from twidder import database_handler, media_handler, session_handler, util
 
 blueprint = Blueprint('users', __name__)
 
+USER_FIELDS = ("firstname", "lastname", "gender", "city", "country", "email", "image", "image_original")  # fields of the user API representation
+IMAGE_FIELDS = ("image", "image_original")
+USER_SEARCH_MAX_AGE = 30  # number of seconds search results may be cached by the browser
+
 
 @blueprint.route("", methods=["POST"])
 @util.post_parameters(("email", str), ("password", str), ("firstname", str), ("lastname", str), ("gender", str), ("city", str), ("country", str))
@@ -23,7 +28,7 @@ def create_user(email: str, password: str, firstname: str, lastname: str, gender
     if not util.is_email_valid(email):
         return jsonify({"message": "invalid email"}), http.HTTPStatus.FORBIDDEN
 
-    if database_handler.get_user_by_email(email) is not None:
+    if database_handler.user_exists(email):
         return jsonify({"message": "user with the same email already exists"}), http.HTTPStatus.CONFLICT
 
     hashed_password = util.hash_password(password)
@@ -33,22 +38,41 @@ def create_user(email: str, password: str, firstname: str, lastname: str, gender
     return jsonify({"message": "user successfully created"}), http.HTTPStatus.CREATED
 
 
+@blueprint.route("", methods=["GET"])
+@util.authorize_user
+def list_users(user_email: str):
+    """Get many users at once by their emails (parameter 'emails'), or search users by a prefix of their email or name (parameter 'prefix')."""
+    if "emails" in request.args:
+        return _get_users()
+    return _search_users()
+
+
 @blueprint.route('/<string:target_user>', methods=["GET"])
 @util.authorize_user
 def get_user(user_email: str, target_user: str):
     """Get user information."""
-    user = database_handler.get_user_by_email(target_user)
+    try:
+        fields = util.parse_fields(USER_FIELDS, media=IMAGE_FIELDS)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+
+    columns = _user_columns(fields)
+    user = database_handler.get_user_by_email(target_user, ("revision", *columns))
     if user is None:
         return jsonify({"message": "user not found"}), http.HTTPStatus.NOT_FOUND
-    return jsonify({
-        "firstname": user["firstname"],
-        "lastname": user["lastname"],
-        "gender": user["gender"],
-        "city": user["city"],
-        "country": user["country"],
-        "email": user["email"],
-        "image": user["image"],
-    }), http.HTTPStatus.OK
+
+    # profile images are shown small, so they are represented by their thumbnails
+    thumbnail = None
+    if user.get("image") is not None and media_handler.is_media_id(user["image"]):
+        image = database_handler.get_media_by_id(user["image"])
+        thumbnail = image["thumbnail"] if image is not None else None
+
+    # the revision alone is not enough, a deleted user can be registered again with the same email
+    etag = util.make_etag(user["revision"], *(user[column] for column in columns), thumbnail, fields)
+    if util.is_not_modified(etag):
+        return util.not_modified(etag)
+
+    return util.set_cache_headers(jsonify(_user_to_json(user, fields, thumbnail)), etag), http.HTTPStatus.OK
 
 
 @blueprint.route('/<string:target_user>', methods=["PATCH"])
@@ -56,7 +80,7 @@ def get_user(user_email: str, target_user: str):
 @util.patch_parameters(("email", str), ("old_password", str), ("new_password", str), ("firstname", str), ("lastname", str), ("gender", str), ("city", str),
                        ("country", str), ("image", str))
 def update_user(user_email: str, email: str | None, old_password: str | None, new_password: str | None, firstname: str | None, lastname: str | None,
-                gender: str | None, city: str | None, country: str | None, image: bytes | None, target_user: str):
+                gender: str | None, city: str | None, country: str | None, image: str | None, target_user: str):
     """Update user information."""
     user = database_handler.get_user_by_email(target_user)
     if user is None:
@@ -111,7 +135,11 @@ def update_user(user_email: str, email: str | None, old_password: str | None, ne
         # user["email"] = email
 
     if image is not None:
-        user["image"] = image
+        # store the image in the blob store (unless it was uploaded already), the user only references it
+        image_id = media_handler.resolve_media(image, ("image/",))
+        if image_id is None:
+            return jsonify({"message": "invalid image"}), http.HTTPStatus.BAD_REQUEST
+        user["image"] = image_id
 
     if database_handler.update_user_by_email(
             user_email,
@@ -133,19 +161,123 @@ def update_user(user_email: str, email: str | None, old_password: str | None, ne
 @util.authorize_user
 def delete_user(user_email: str, target_user: str):
     """Delete user."""
-    user = database_handler.get_user_by_email(target_user)
-    if user is None:
+    if not database_handler.user_exists(target_user):
         return jsonify({"message": "user not found"}), http.HTTPStatus.NOT_FOUND
     if user_email != target_user:
         return jsonify({"message": "you are not allowed to delete other user accounts"}), http.HTTPStatus.FORBIDDEN
-    if not database_handler.delete_posts_by_user(target_user):
-        return jsonify({"message": "couldn't delete user posts"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
-    if not database_handler.delete_user_by_email(target_user):
-        return jsonify({"message": "couldn't delete user"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    # the user is deleted together with their posts, or nothing is deleted
+    with database_handler.transaction():
+        if not database_handler.delete_posts_by_user(target_user) or not database_handler.delete_posts_by_author(target_user):
+            return jsonify({"message": "couldn't delete user posts"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+        if not database_handler.delete_user_by_email(target_user):
+            return jsonify({"message": "couldn't delete user"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
     session_handler.delete_session(user_email)
     return jsonify({"message": "user successfully deleted"}), http.HTTPStatus.OK
 
 
-@blueprint.teardown_request
-def after_request(exception):
-    database_handler.disconnect_db()
+@blueprint.route('/<string:target_user>/follow', methods=["GET"])
+@util.authorize_user
+def get_follow(user_email: str, target_user: str):
+    """Check if the user follows another user."""
+    if not database_handler.user_exists(target_user):
+        return jsonify({"message": "user not found"}), http.HTTPStatus.NOT_FOUND
+    return jsonify({"following": database_handler.is_following(user_email, target_user)}), http.HTTPStatus.OK
+
+
+@blueprint.route('/<string:target_user>/follow', methods=["PUT"])
+@util.authorize_user
+def follow_user(user_email: str, target_user: str):
+    """Follow another user, their posts are shown in the user's feed."""
+    if not database_handler.user_exists(target_user):
+        return jsonify({"message": "user not found"}), http.HTTPStatus.NOT_FOUND
+    if user_email == target_user:
+        return jsonify({"message": "you can not follow yourself"}), http.HTTPStatus.BAD_REQUEST
+    if not database_handler.follow_user(user_email, target_user, datetime.datetime.now(datetime.timezone.utc), current_app.config["FEED_FANOUT_LIMIT"],
+                                        current_app.config["FEED_BACKFILL_SIZE"]):
+        return jsonify({"message": "couldn't follow user"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"message": "user successfully followed"}), http.HTTPStatus.OK
+
+
+@blueprint.route('/<string:target_user>/follow', methods=["DELETE"])
+@util.authorize_user
+def unfollow_user(user_email: str, target_user: str):
+    """Stop following another user."""
+    if not database_handler.unfollow_user(user_email, target_user):
+        return jsonify({"message": "couldn't unfollow user"}), http.HTTPStatus.INTERNAL_SERVER_ERROR
+    return jsonify({"message": "user successfully unfollowed"}), http.HTTPStatus.OK
+
+
+def get_users_json(emails: list[str], fields: tuple[str, ...] = USER_FIELDS) -> dict[str, dict]:
+    """
+    Get the API representation of many users at once, e.g. authors of posts, by a constant number of database queries.
+
+    :param emails: users' email addresses, duplicates are allowed
+    :param fields: fields of the representation
+    :return: dictionary mapping the email of existing users to their JSON serializable representation
+    """
+    users = database_handler.get_users_by_emails(emails, tuple(dict.fromkeys(("email", *_user_columns(fields)))))
+    images = [user["image"] for user in users.values() if user.get("image") is not None and media_handler.is_media_id(user["image"])]
+    thumbnails = database_handler.get_media_thumbnails(images) if images else dict()
+    return {email: _user_to_json(user, fields, thumbnails.get(user.get("image"))) for email, user in users.items()}
+
+
+def _get_users():
+    """Get many users at once by their comma separated emails, e.g. to show details of post authors."""
+    emails = [email.strip() for emails in request.args.getlist("emails") for email in emails.split(",") if email.strip() != ""]
+    if len(emails) == 0:
+        return jsonify({"message": "parameter 'emails' must not be empty"}), http.HTTPStatus.BAD_REQUEST
+    if len(emails) > current_app.config["USER_BATCH_SIZE_MAX"]:
+        return jsonify({"message": f"parameter 'emails' must contain at most {current_app.config['USER_BATCH_SIZE_MAX']} emails"}), http.HTTPStatus.BAD_REQUEST
+    try:
+        fields = util.parse_fields(USER_FIELDS, media=IMAGE_FIELDS, required=("email",))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), http.HTTPStatus.BAD_REQUEST
+
+    # users which don't exist are left out
+    return jsonify({"users": get_users_json(emails, fields)}), http.HTTPStatus.OK
+
+
+def _search_users():
+    """Search users by a prefix of their email or name, e.g. to suggest users while typing."""
+    prefix = request.args.get("prefix", "").strip()
+    if prefix == "":
+        return jsonify({"message": "parameter 'prefix' must not be empty"}), http.HTTPStatus.BAD_REQUEST
+    limit = request.args.get("limit", default=current_app.config["USER_SEARCH_LIMIT"], type=int)
+    if limit < 1 or limit > current_app.config["USER_SEARCH_LIMIT_MAX"]:
+        return jsonify({"message": f"parameter 'limit' must be between 1 and {current_app.config['USER_SEARCH_LIMIT_MAX']}"}), http.HTTPStatus.BAD_REQUEST
+
+    response = jsonify({"users": database_handler.search_users(prefix, limit)})
+    # suggestions are requested on every keystroke, repeated prefixes (e.g. after backspace) are served by the browser cache
+    response.cache_control.private = True
+    response.cache_control.max_age = USER_SEARCH_MAX_AGE
+    return response, http.HTTPStatus.OK
+
+
+def _user_columns(fields: tuple[str, ...]) -> tuple[str, ...]:
+    """
+    Get user columns needed for the given fields of the user API representation.
+
+    :param fields: fields of the representation
+    :return: user fields to retrieve from the database
+    """
+    columns = tuple(field for field in fields if field not in IMAGE_FIELDS)
+    if any(field in IMAGE_FIELDS for field in fields):
+        columns += ("image",)
+    return columns
+
+
+def _user_to_json(user: dict, fields: tuple[str, ...], thumbnail: None | str) -> dict:
+    """
+    Convert user information into its API representation. Profile images are represented by their thumbnails, if they are available.
+
+    :param user: dictionary of user information
+    :param fields: fields of the representation, the user must contain all columns needed for them
+    :param thumbnail: media id of the profile image thumbnail, None if it is not available
+    :return: JSON serializable user
+    """
+    user_json = {field: user[field] for field in fields if field not in IMAGE_FIELDS}
+    if "image" in user:
+        urls = media_handler.get_media_urls(user["image"], "image/", thumbnail)
+        image_json = {"image": urls["url"], "image_original": urls["original"]}
+        user_json |= {field: image_json[field] for field in fields if field in IMAGE_FIELDS}
+    return user_json
@@ -1,43 +1,912 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+import urllib.parse
+from collections.abc import Iterator
 
-from flask import g, current_app
+from flask import g, current_app, Flask
+
+USER_COLUMNS = {  # user fields and the columns they are selected from
+    "email": "email",
+    "password": "password",
+    "firstname": "firstname",
+    "lastname": "lastname",
+    "gender": "gender",
+    "city": "city",
+    "country": "country",
+    "image": "image",
+    "revision": "revision",
+}
+POST_COLUMNS = {  # post fields and the columns they are selected from
+    "id": "post.id",
+    "author": "post.author",
+    "user": "post.user",
+    "content": "post.content",
+    "created": "post.created",
+    "edited": "post.edited",
+    "media": "post.media",
+    "media_type": "media.mimetype",
+    "media_thumbnail": "media.thumbnail",
+}
+MAX_QUERY_PARAMETERS = 500  # maximum number of values bound to one 'in (...)' list, longer lists are queried in chunks
+FINGERPRINT_PATTERNS = (  # parts of SQL statements replaced by placeholders, so statements differing only in literals share one fingerprint
+    (re.compile(r"--[^\n]*"), ""),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\?(?: ?, ?\?)+"), "?, ..."),
+)
+
+
+class QueryLog:
+    """
+    Statistics of SQL queries grouped by their fingerprint, keeping the most expensive ones. The query plan of every fingerprint is captured
+    when it is executed for the first time, so full table scans show up before they get slow. Slow queries are logged with their plan.
+    """
+
+    def __init__(self, size: int, slow_query_threshold: None | float):
+        """
+        :param size: maximum number of fingerprints kept, the cheapest one is dropped when a new one doesn't fit
+        :param slow_query_threshold: queries slower than this number of seconds are logged, None to log no queries
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self._size = size
+        self._lock = threading.Lock()
+        self._queries: dict[str, dict] = dict()
+
+    def record(self, cursor: sqlite3.Cursor, fingerprint: str, sql: str, parameters, duration: float, many: bool = False) -> None:
+        """
+        Record an executed query.
+
+        :param cursor: cursor which executed the query
+        :param fingerprint: fingerprint of the SQL statement (see _fingerprint())
+        :param sql: SQL statement
+        :param parameters: query parameters, or a sequence of them
+        :param duration: duration of the query execution in seconds
+        :param many: True if the query was executed for a sequence of parameters
+        :return: None
+        """
+        with self._lock:
+            query = self._queries.get(fingerprint)
+            if query is not None:
+                query["count"] += 1
+                query["total_time"] += duration
+                query["max_time"] = max(query["max_time"], duration)
+        is_slow = self.slow_query_threshold is not None and duration >= self.slow_query_threshold
+        if query is not None and not is_slow:
+            return
+
+        # explain new and slow queries outside the lock, other queries don't wait for it
+        plan = _explain_query(cursor.connection, sql, parameters, many)
+        with self._lock:
+            if fingerprint in self._queries:
+                self._queries[fingerprint]["plan"] = plan
+            else:
+                if len(self._queries) >= self._size:
+                    del self._queries[min(self._queries, key=lambda key: self._queries[key]["total_time"])]
+                self._queries[fingerprint] = {"query": fingerprint, "count": 1, "total_time": duration, "max_time": duration, "plan": plan}
+        if is_slow:
+            current_app.logger.warning(f"slow query: {duration * 1000:.1f} ms, {fingerprint}, parameters: {_parameters_shape(parameters, many)}, plan: {plan}")
+
+    def record_fetch(self, fingerprint: str, duration: float) -> None:
+        """
+        Add time spent fetching rows of a query to its statistics.
+
+        :param fingerprint: fingerprint of the SQL statement
+        :param duration: duration of the fetch in seconds
+        :return: None
+        """
+        with self._lock:
+            query = self._queries.get(fingerprint)
+            if query is not None:
+                query["total_time"] += duration
+
+    def top(self, limit: int) -> list[dict]:
+        """
+        Get statistics of the most expensive queries.
+
+        :param limit: maximum number of queries
+        :return: list of query statistics, with the highest total time first
+        """
+        with self._lock:
+            queries = sorted(self._queries.values(), key=lambda query: query["total_time"], reverse=True)[:limit]
+            return [{
+                **query,
+                "mean_time": query["total_time"] / query["count"],
+                "full_scan": query["plan"] is not None and any(_is_full_scan(step) for step in query["plan"]),
+            } for query in queries]
+
+
+@functools.lru_cache(maxsize=1024)
+def _fingerprint(sql: str) -> str:
+    """
+    Get the fingerprint of an SQL statement, i.e. the statement with literals and lists of parameters replaced by placeholders.
+
+    :param sql: SQL statement
+    :return: fingerprint of the statement
+    """
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def _explain_query(connection: sqlite3.Connection, sql: str, parameters, many: bool) -> None | list[str]:
+    """
+    Get the query plan of an SQL statement.
+
+    :param connection: connection which executed the statement
+    :param sql: SQL statement
+    :param parameters: query parameters, or a sequence of them
+    :param many: True if the statement was executed for a sequence of parameters
+    :return: steps of the query plan, None if the statement can't be explained (e.g. parameters of executemany() were an iterator)
+    """
+    if many:
+        if not isinstance(parameters, (list, tuple)) or len(parameters) == 0:
+            return None
+        parameters = parameters[0]
+    try:
+        # a plain cursor, so the explanation itself is not recorded
+        return [row[3] for row in sqlite3.Cursor(connection).execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+    except (sqlite3.Error, ValueError):
+        return None
+
+
+def _is_full_scan(step: str) -> bool:
+    """
+    Check if a step of a query plan scans a whole table, instead of searching an index.
+
+    :param step: step of a query plan
+    :return: True if the step is a full table scan
+    """
+    return step.startswith("SCAN ") and " USING " not in step and not step.startswith("SCAN CONSTANT ROW")
+
+
+def _parameters_shape(parameters, many: bool) -> str:
+    """
+    Describe query parameters by their types, so logs don't leak their values (e.g. password hashes).
+
+    :param parameters: query parameters, or a sequence of them
+    :param many: True if the query was executed for a sequence of parameters
+    :return: description of the parameters
+    """
+    if many:
+        return f"{len(parameters)} x {_parameters_shape(parameters[0], False)}" if isinstance(parameters, (list, tuple)) and parameters else "iterator"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+
+class MeasuredCursor(sqlite3.Cursor):
+    """
+    Cursor recording the number and duration of executed queries in its connection and in the query log of the connection (see QueryLog).
+    Rows fetched by iterating over the cursor are not measured.
+    """
+
+    _fingerprint: None | str = None
+
+    def execute(self, sql: str, parameters=(), /):
+        self._fingerprint = _fingerprint(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            duration = time.perf_counter() - start
+            self.connection.queries += 1
+            self.connection.query_time += duration
+            self.connection.query_log.record(self, self._fingerprint, sql, parameters, duration)
+
+    def executemany(self, sql: str, parameters, /):
+        self._fingerprint = _fingerprint(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            duration = time.perf_counter() - start
+            self.connection.queries += 1
+            self.connection.query_time += duration
+            self.connection.query_log.record(self, self._fingerprint, sql, parameters, duration, many=True)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._record_fetch(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._record_fetch(time.perf_counter() - start)
+
+    def _record_fetch(self, duration: float) -> None:
+        self.connection.query_time += duration
+        if self._fingerprint is not None:
+            self.connection.query_log.record_fetch(self._fingerprint, duration)
+
+
+class MeasuredConnection(sqlite3.Connection):
+    """Connection whose queries are executed by measured cursors (see MeasuredCursor)."""
+
+    query_log: QueryLog
+    queries: int = 0  # number of queries executed since the connection was taken from the pool (see get_db())
+    query_time: float = 0.0  # time spent executing the queries and fetching their rows in seconds
+
+    def cursor(self, factory=MeasuredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters, /):
+        return self.cursor().executemany(sql, parameters)
+
+
+class ConnectionPool:
+    """Thread-safe pool of SQLite connections, which are configured once when opened and then reused by requests."""
+
+    def __init__(self, database: str, size: int, timeout: float, pragmas: dict[str, str | int], query_log: QueryLog, read_only: bool = False):
+        """
+        :param database: path to the SQLite database file
+        :param size: maximum number of open connections
+        :param timeout: number of seconds to wait for a free connection when all of them are in use
+        :param pragmas: PRAGMA statements executed on every new connection
+        :param query_log: log of queries executed by all connections
+        :param read_only: True to open the database read-only, the database must exist already
+        """
+        self.database = database
+        self.pid = os.getpid()
+        self.query_log = query_log
+        self.read_only = read_only
+        self._size = size
+        self._timeout = timeout
+        self._pragmas = pragmas
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()  # LIFO keeps the most recently used (warm) connections busy
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+        self._hits = 0
+        self._misses = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Take a connection from the pool. Opens a new connection if there is no idle one and the pool is not full yet, waits for a released one otherwise.
+
+        :return: SQLite database connection
+        """
+        try:
+            connection = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+                self._in_use += 1
+            return connection
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self._size
+            if can_open:
+                self._opened += 1
+                self._misses += 1
+                self._in_use += 1
+            else:
+                self._waits += 1
+
+        if can_open:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                    self._in_use -= 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            connection = self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise sqlite3.OperationalError("timed out waiting for a free database connection")
+        with self._lock:
+            self._wait_time += time.perf_counter() - start
+            self._in_use += 1
+        return connection
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """
+        Return a connection to the pool. Uncommitted changes are rolled back.
+
+        :param connection: connection previously acquired from this pool
+        :return: None
+        """
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(connection)
+
+    def close(self) -> None:
+        """
+        Close all idle connections.
+
+        :return: None
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+
+    def stats(self) -> dict:
+        """
+        Get pool usage statistics.
+
+        :return: dictionary of pool statistics
+        """
+        with self._lock:
+            return {
+                "size": self._size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "hits": self._hits,
+                "misses": self._misses,
+                "waits": self._waits,
+                "wait_time": self._wait_time,
+                "timeouts": self._timeouts,
+            }
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection configured like the pooled ones. Connections which are not acquired from the pool are not counted by the pool.
+
+        :return: SQLite database connection
+        """
+        # connections are shared by all request threads, but only one thread uses a connection at a time
+        if self.read_only:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.database))}?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=MeasuredConnection)
+        else:
+            connection = sqlite3.connect(self.database, check_same_thread=False, factory=MeasuredConnection)
+        connection.query_log = self.query_log
+        for name, value in self._pragmas.items():
+            connection.execute(f"PRAGMA {name}={value}")
+        return connection
+
+
+_pool: None | ConnectionPool = None  # connection pool of the current process
+_read_pool: None | ConnectionPool = None  # read-only connection pool of the current process
+_pool_lock: threading.Lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Get the database connection pool of the current process, creating it if necessary.
+
+    :return: database connection pool
+    """
+    global _pool
+    with _pool_lock:
+        # SQLite connections must not be shared with forked processes (e.g. gunicorn workers), so every process gets its own pool
+        if _pool is None or _pool.pid != os.getpid() or _pool.database != current_app.config["DATABASE_FILE"]:
+            if _pool is not None and _pool.pid == os.getpid():
+                _pool.close()
+            _pool = ConnectionPool(
+                current_app.config["DATABASE_FILE"],
+                current_app.config["DATABASE_POOL_SIZE"],
+                current_app.config["DATABASE_POOL_TIMEOUT"],
+                {
+                    "journal_mode": "WAL",
+                    "synchronous": "NORMAL",
+                    "foreign_keys": "ON",
+                    "cache_size": current_app.config["DATABASE_CACHE_SIZE"],
+                    "mmap_size": current_app.config["DATABASE_MMAP_SIZE"],
+                },
+                QueryLog(
+                    current_app.config["QUERY_LOG_SIZE"],
+                    current_app.config["SLOW_QUERY_THRESHOLD_MS"] / 1000 if current_app.config["SLOW_QUERY_THRESHOLD_MS"] is not None else None,
+                ),
+            )
+        return _pool
+
+
+def get_read_pool() -> ConnectionPool:
+    """
+    Get the read-only database connection pool of the current process, creating it if necessary.
+    Its connections share the query log with the connections of get_pool().
+
+    :return: read-only database connection pool
+    """
+    global _read_pool
+    pool = get_pool()
+    with _pool_lock:
+        if _read_pool is None or _read_pool.pid != os.getpid() or _read_pool.database != pool.database:
+            if _read_pool is not None and _read_pool.pid == os.getpid():
+                _read_pool.close()
+            # under WAL, readers never wait for the writer, and query_only makes sure no read function writes by mistake
+            _read_pool = ConnectionPool(
+                pool.database,
+                current_app.config["DATABASE_READ_POOL_SIZE"],
+                current_app.config["DATABASE_POOL_TIMEOUT"],
+                {
+                    "query_only": "ON",
+                    "cache_size": current_app.config["DATABASE_CACHE_SIZE"],
+                    "mmap_size": current_app.config["DATABASE_MMAP_SIZE"],
+                },
+                pool.query_log,
+                read_only=True,
+            )
+        return _read_pool
+
+
+class WriteJob:
+    """Call of a function of this module which writes to the database, waiting in the queue of the writer."""
+
+    def __init__(self, fun, args: tuple, kwargs: dict, users: dict):
+        """
+        :param fun: function to call
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :param users: users memoized by the calling request, so the function can invalidate them (see get_user_by_email())
+        """
+        self.fun = fun
+        self.args = args
+        self.kwargs = kwargs
+        self.users = users
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class Writer:
+    """
+    Thread executing all writes of the current process on its own connection, so request threads don't compete for the database lock.
+    Writes queued while a transaction is being written are grouped into the next transaction, which is committed once (group commit).
+    Every write runs in its own savepoint, so a failing write is rolled back without failing the other writes of the transaction.
+    """
+
+    def __init__(self, app: Flask, connection: sqlite3.Connection, window: float, batch_size: int):
+        """
+        :param app: Flask application, whose app context the writes run in
+        :param connection: connection used by the writer only
+        :param window: number of seconds to wait for more writes after the first one before the transaction is written, 0 not to wait
+        :param batch_size: maximum number of writes grouped into one transaction
+        """
+        self.pid = os.getpid()
+        self.database = app.config["DATABASE_FILE"]
+        self._app = app
+        self._connection = connection
+        self._window = window
+        self._batch_size = batch_size
+        self._queue: queue.SimpleQueue[None | WriteJob] = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._transactions = 0
+        self._retried_transactions = 0
+        self._max_batch_size = 0
+        self.failed = False  # the writer stopped after an unexpected error, a new writer is started by get_writer()
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fun, args: tuple, kwargs: dict, users: dict) -> concurrent.futures.Future:
+        """
+        Queue a call of a function which writes to the database.
+
+        :param fun: function to call
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :param users: users memoized by the calling request
+        :return: future of the function result
+        """
+        job = WriteJob(fun, args, kwargs, users)
+        with self._lock:
+            if self.failed:
+                job.future.set_exception(sqlite3.OperationalError("database writer stopped after a failure"))
+            else:
+                self._queue.put(job)
+        return job.future
+
+    def stop(self) -> None:
+        """
+        Stop the writer once the queued writes are written, and close its connection.
+
+        :return: None
+        """
+        self._queue.put(None)
+
+    def stats(self) -> dict:
+        """
+        Get writer statistics.
+
+        :return: dictionary of writer statistics
+        """
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "writes": self._writes,
+                "transactions": self._transactions,
+                "retried_transactions": self._retried_transactions,
+                "max_batch_size": self._max_batch_size,
+            }
+
+    def _run(self) -> None:
+        with self._app.app_context():
+            g.db = self._connection
+            g.writer = True  # writes of the writer itself are never queued
+            stopped = False
+            while not stopped:
+                job = self._queue.get()
+                if job is None:
+                    break
+                jobs = [job]
+                deadline = time.monotonic() + self._window
+                while len(jobs) < self._batch_size:
+                    try:
+                        job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopped = True
+                        break
+                    jobs.append(job)
+                jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+                try:
+                    self._write(jobs)
+                except BaseException as e:
+                    self._fail(jobs, e)
+                    break
+            g.db = None
+        self._connection.close()
+
+    def _fail(self, jobs: list[WriteJob], exception: BaseException) -> None:
+        """
+        Stop the writer after an unexpected error (e.g. the connection can't be rolled back), failing the jobs being written and all queued jobs.
+        Whether the writes of the jobs were committed is unknown, so their callers get an error.
+
+        :param jobs: jobs being written
+        :param exception: the unexpected error
+        :return: None
+        """
+        self._app.logger.error("database writer failed", exc_info=exception)
+        error = sqlite3.OperationalError("database writer stopped after a failure")
+        error.__cause__ = exception
+        with self._lock:
+            self.failed = True
+        # jobs are not queued anymore once the writer failed (see submit())
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and job.future.set_running_or_notify_cancel():
+                jobs.append(job)
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(error)
+        try:
+            if self._connection.in_transaction:
+                self._connection.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _write(self, jobs: list[WriteJob]) -> None:
+        """
+        Write jobs in one transaction. If the transaction can't be committed, every job is written again in its own transaction.
+
+        :param jobs: jobs to write
+        :return: None
+        """
+        try:
+            self._connection.execute("BEGIN IMMEDIATE")
+            results = [self._call(job, savepoint=True) for job in jobs]
+            self._connection.commit()
+            retried = False
+        except sqlite3.Error:
+            if self._connection.in_transaction:
+                self._connection.rollback()
+            results = [self._call(job, savepoint=False) for job in jobs]
+            retried = True
+        _invalidate_committed_users()
+
+        with self._lock:
+            self._writes += len(jobs)
+            self._transactions += 1 if not retried else len(jobs)
+            self._retried_transactions += retried
+            self._max_batch_size = max(self._max_batch_size, len(jobs))
+        # results are handed over only once they are committed
+        for job, (result, exception) in zip(jobs, results):
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+    def _call(self, job: WriteJob, savepoint: bool) -> tuple:
+        """
+        Call the function of a job, either within a savepoint of the current transaction, or in its own transaction.
+
+        :param job: job to call
+        :param savepoint: True to call the function within a savepoint, which is rolled back if the function fails
+        :return: function result and exception raised by the function, if any
+        """
+        g.users = job.users
+        g.transaction_depth, g.transaction_failed = (1, False) if savepoint else (0, False)
+        if savepoint:
+            self._connection.execute("SAVEPOINT write")
+        result, exception = None, None
+        try:
+            result = job.fun(*job.args, **job.kwargs)
+        except Exception as e:
+            exception = e
+            g.transaction_failed = True
+        finally:
+            g.transaction_depth = 0
+            g.users = dict()
+        if savepoint:
+            # functions of this module report failures by _rollback(), which marks the transaction failed instead of rolling it back
+            if g.transaction_failed:
+                self._connection.execute("ROLLBACK TO write")
+            self._connection.execute("RELEASE write")
+        elif self._connection.in_transaction:
+            self._connection.rollback()
+        return result, exception
+
+
+_writer: None | Writer = None  # writer of the current process
+_writer_lock: threading.Lock = threading.Lock()
+
+
+def get_writer() -> Writer:
+    """
+    Get the writer of the current process, starting it if necessary.
+
+    :return: database writer
+    """
+    global _writer
+    with _writer_lock:
+        # threads don't survive forks (e.g. of gunicorn workers), so every process starts its own writer
+        if _writer is None or _writer.pid != os.getpid() or _writer.database != current_app.config["DATABASE_FILE"] or _writer.failed:
+            if _writer is not None and _writer.pid == os.getpid() and not _writer.failed:
+                _writer.stop()
+            _writer = Writer(current_app._get_current_object(), get_pool().connect(), current_app.config["DATABASE_WRITE_WINDOW"],
+                             current_app.config["DATABASE_WRITE_BATCH_SIZE"])
+        return _writer
+
+
+class UserCache:
+    """Thread-safe LRU cache of users shared by all requests of the process. Entries expire after a while, so changes made by other processes become visible."""
+
+    def __init__(self, database: str, size: int, ttl: float):
+        """
+        :param database: path to the SQLite database file the users are stored in
+        :param size: maximum number of cached users
+        :param ttl: number of seconds a user stays cached
+        """
+        self.database = database
+        self._size = size
+        self._ttl = ttl
+        self._users: collections.OrderedDict[str, tuple[float, dict]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> None | dict:
+        """
+        Retrieve a cached user.
+
+        :param email: user's email address
+        :return: dictionary of user's information if the user is cached, None otherwise
+        """
+        with self._lock:
+            entry = self._users.get(email)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                del self._users[email]
+                return None
+            self._users.move_to_end(email)
+            return user
+
+    def put(self, email: str, user: dict) -> None:
+        """
+        Cache a user, evicting the least recently used user if the cache is full.
+
+        :param email: user's email address
+        :param user: dictionary of user's information
+        :return: None
+        """
+        with self._lock:
+            self._users[email] = (time.monotonic() + self._ttl, user)
+            self._users.move_to_end(email)
+            while len(self._users) > self._size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, email: str) -> None:
+        """
+        Remove a user from the cache. No action is taken if the user is not cached.
+
+        :param email: user's email address
+        :return: None
+        """
+        with self._lock:
+            self._users.pop(email, None)
+
+    def clear(self) -> None:
+        """
+        Remove all users from the cache.
+
+        :return: None
+        """
+        with self._lock:
+            self._users.clear()
+
+
+_user_cache: None | UserCache = None  # user cache of the current process
+_user_cache_lock: threading.Lock = threading.Lock()
+
+
+def get_user_cache() -> None | UserCache:
+    """
+    Get the user cache of the current process, creating it if necessary.
+
+    :return: user cache, None if the cache is disabled by 'USER_CACHE_SIZE'
+    """
+    global _user_cache
+    if current_app.config["USER_CACHE_SIZE"] <= 0:
+        return None
+    with _user_cache_lock:
+        if _user_cache is None or _user_cache.database != current_app.config["DATABASE_FILE"]:
+            _user_cache = UserCache(current_app.config["DATABASE_FILE"], current_app.config["USER_CACHE_SIZE"], current_app.config["USER_CACHE_TTL"])
+        return _user_cache
 
 
 def get_db():
     """
-    Get a database connection to the SQLite database.
+    Get a database connection to the SQLite database. The connection is taken from the connection pool and kept until the end of the app context.
 
     :return: SQLite database connection
     """
     db = getattr(g, "db", None)
     if db is None:
-        db = g.db = sqlite3.connect(current_app.config["DATABASE_FILE"])
+        g.db_pool = get_pool()
+        db = g.db = g.db_pool.acquire()
+        db.queries, db.query_time = 0, 0.0
+    return db
+
+
+def get_read_db():
+    """
+    Get a read-only database connection to the SQLite database, which is used by functions of this module which only read.
+    The connection is taken from the read-only connection pool and kept until the end of the app context.
+    Within transaction() and in the writer, the connection of get_db() is returned instead, so the reads see the writes which are not committed yet.
+
+    :return: SQLite database connection
+    """
+    if g.get("transaction_depth", 0) > 0 or g.get("writer", False):
+        return get_db()
+    db = getattr(g, "read_db", None)
+    if db is None:
+        g.read_db_pool = get_read_pool()
+        db = g.read_db = g.read_db_pool.acquire()
+        db.queries, db.query_time = 0, 0.0
     return db
 
 
-def disconnect_db():
+def disconnect_db(exception: BaseException | None = None):
     """
-    Disconnect the current database connection.
+    Return the current database connections to the connection pools.
 
+    :param exception: exception which ended the app context, if any
     :return: None
     """
     db = getattr(g, "db", None)
     if db is not None:
-        db.close()
+        g.db_pool.release(db)
         g.db = None
+    read_db = getattr(g, "read_db", None)
+    if read_db is not None:
+        g.read_db_pool.release(read_db)
+        g.read_db = None
     return db
 
 
+@contextlib.contextmanager
+def transaction() -> Iterator[None]:
+    """
+    Group writes of several functions of this module into one transaction, e.g. to delete a user together with their posts.
+    The writes are committed at the end of the block. They are rolled back if the block raises an exception or if any of the writes fails.
+    Transactions may be nested, only the outermost one commits.
+
+    :return: context manager of the transaction
+    """
+    db = get_db()
+    depth = g.get("transaction_depth", 0)
+    if depth == 0:
+        g.transaction_failed = False
+    g.transaction_depth = depth + 1
+    try:
+        yield
+    except BaseException:
+        g.transaction_failed = True
+        raise
+    finally:
+        g.transaction_depth = depth
+        if depth == 0:
+            try:
+                if g.transaction_failed:
+                    db.rollback()
+                else:
+                    db.commit()
+            finally:
+                _invalidate_committed_users()
+
+
+def _serialized(fun):
+    """
+    Decorator of functions of this module which write to the database. Unless 'DATABASE_WRITER' is disabled, the function is executed by the writer
+    of the process (see Writer), and the caller waits until its writes are committed. Functions called within transaction() are executed directly,
+    so the writes of the transaction stay together.
+    """
+
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        if not current_app.config["DATABASE_WRITER"] or g.get("transaction_depth", 0) > 0 or g.get("writer", False):
+            return fun(*args, **kwargs)
+        future = get_writer().submit(fun, args, kwargs, g.setdefault("users", dict()))
+        try:
+            return future.result(timeout=current_app.config["DATABASE_WRITE_TIMEOUT"])
+        except concurrent.futures.TimeoutError:
+            raise sqlite3.OperationalError("timed out waiting for the database writer")
+
+    return wrapper
+
+
 def initialize_database():
     """
-    Initialize the database schema and tables.
+    Initialize the database schema and tables, and migrate them to the latest version.
 
     :return: None
     """
     with open(current_app.config["DATABASE_SCHEMA"], "r") as schema_file:
         get_db().executescript(schema_file.read())
         get_db().commit()
+    migrate_database()
+
+
+def migrate_database():
+    """
+    Apply all pending schema migrations. The schema version is tracked by 'PRAGMA user_version', each migration is applied in its own transaction.
+
+    :return: None
+    """
+    db = get_db()
+    for version, path in _list_migrations():
+        # take the write lock before checking the version, so concurrently starting processes apply every migration just once
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("PRAGMA user_version").fetchone()[0] >= version:
+                db.rollback()
+                continue
+            with open(path, "r") as migration_file:
+                for statement in _split_statements(migration_file.read()):
+                    db.execute(statement)
+            db.execute(f"PRAGMA user_version={version}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        current_app.logger.info(f"database migrated to version {version}: {os.path.basename(path)}")
 
 
 def clear_database():
@@ -46,12 +915,25 @@ def clear_database():
 
     :return: None
     """
-    get_db().execute("DROP TABLE IF EXISTS user")
+    get_db().execute("DROP TABLE IF EXISTS post_search")
     get_db().execute("DROP TABLE IF EXISTS post")
+    get_db().execute("DROP TABLE IF EXISTS user")
+    get_db().execute("DROP TABLE IF EXISTS media")
+    get_db().execute("DROP TABLE IF EXISTS wall_event")
+    get_db().execute("DROP TABLE IF EXISTS media_job")
+    get_db().execute("DROP TABLE IF EXISTS follow")
+    get_db().execute("DROP TABLE IF EXISTS timeline")
+    get_db().execute("DROP TABLE IF EXISTS media_upload")
+    get_db().execute("DROP TABLE IF EXISTS wall_version")
+    get_db().execute("PRAGMA user_version=0")
     get_db().commit()
+    g.pop("users", None)
+    if get_user_cache() is not None:
+        get_user_cache().clear()
 
 
-def create_user(email: str, password: str, firstname: str, lastname: str, gender: str, city: str, country: str, image: bytes | None) -> bool:
+@_serialized
+def create_user(email: str, password: str, firstname: str, lastname: str, gender: str, city: str, country: str, image: str | None) -> bool:
     """
     Insert a new user into the database.
 
@@ -62,45 +944,160 @@ def create_user(email: str, password: str, firstname: str, lastname: str, gender
     :param gender: user's gender
     :param city: user's city
     :param country: user's country
-    :param image: user's profile image
+    :param image: id of the user's profile image
     :return: True on success, False on error
     """
     try:
         get_db().execute("insert into user (email, password, firstname, lastname, gender, city, country, image) values (?, ?, ?, ?, ?, ?, ?, ?)",
                          [email, password, firstname, lastname, gender, city, country, image])
-        get_db().commit()
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
+    finally:
+        _invalidate_user(email)
 
 
-def get_user_by_email(email: str) -> None | dict:
+def get_user_by_email(email: str, fields: None | tuple[str, ...] = None) -> None | dict:
     """
     Retrieve the user information belonging to a user with the given email address.
+    Users are memoized for the rest of the request, and cached by the process if enabled by 'USER_CACHE_SIZE'.
 
     :param email: user's email address
+    :param fields: user fields to retrieve (see USER_COLUMNS), all fields if None
     :return: dictionary of user's information if user exists, None otherwise
+    :raises ValueError: if an unknown field is requested
     """
-    cursor = get_db().execute("select email, password, firstname, lastname, gender, city, country, image from user where email==?", [email])
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        return None
+    if fields is not None and not set(fields) <= set(USER_COLUMNS):
+        raise ValueError(f"unknown user fields: {', '.join(sorted(set(fields) - set(USER_COLUMNS)))}")
 
-    return {
-        'email': rows[0][0],
-        'password': rows[0][1],
-        'firstname': rows[0][2],
-        'lastname': rows[0][3],
-        'gender': rows[0][4],
-        'city': rows[0][5],
-        'country': rows[0][6],
-        'image': rows[0][7]
-    }
+    users = g.setdefault("users", dict())  # users retrieved by the current request
+    if email in users:
+        return _project(users[email], fields)
+
+    user_cache = get_user_cache()
+    user = user_cache.get(email) if user_cache is not None else None
+    if user is not None:
+        users[email] = user
+        return _project(user, fields)
+
+    if fields is not None:
+        # partial users are not cached, so only the requested columns are read
+        columns = [USER_COLUMNS[field] for field in fields]
+        row = get_read_db().execute(f"select {', '.join(columns)} from user where email==?", [email]).fetchone()
+        return dict(zip(fields, row)) if row is not None else None
+
+    row = get_read_db().execute(f"select {', '.join(USER_COLUMNS.values())} from user where email==?", [email]).fetchone()
+    user = dict(zip(USER_COLUMNS, row)) if row is not None else None
+    if user is not None and user_cache is not None:
+        user_cache.put(email, user)
+    users[email] = user
+    return _project(user, fields)
+
+
+@_serialized
+def create_users(users: list[dict]) -> int:
+    """
+    Insert many users into the database by one statement in one transaction, either all of them or none.
+
+    :param users: dictionaries of users' information with the same keys as parameters of create_user(); 'image' is optional
+    :return: number of created users on success, -1 on error
+    """
+    try:
+        get_db().executemany("insert into user (email, password, firstname, lastname, gender, city, country, image) values (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(user["email"], user["password"], user["firstname"], user["lastname"], user["gender"], user["city"], user["country"],
+                               user.get("image")) for user in users])
+        _commit()
+        return len(users)
+    except Exception:
+        _rollback()
+        return -1
+    finally:
+        for user in users:
+            _invalidate_user(user["email"])
+
+
+def get_users_by_emails(emails: list[str], fields: None | tuple[str, ...] = None) -> dict[str, dict]:
+    """
+    Retrieve the user information of many users at once, by as few queries as possible.
+    Users already memoized by the request or cached by the process are not queried again.
+
+    :param emails: users' email addresses
+    :param fields: user fields to retrieve (see USER_COLUMNS), all fields if None
+    :return: dictionary mapping the email of existing users to their information
+    :raises ValueError: if an unknown field is requested
+    """
+    if fields is not None and not set(fields) <= set(USER_COLUMNS):
+        raise ValueError(f"unknown user fields: {', '.join(sorted(set(fields) - set(USER_COLUMNS)))}")
+
+    users = g.setdefault("users", dict())  # users retrieved by the current request
+    user_cache = get_user_cache()
+    found = dict()
+    missing = []
+    for email in dict.fromkeys(emails):
+        user = users.get(email)
+        if user is None and email not in users and user_cache is not None:
+            user = user_cache.get(email)
+            if user is not None:
+                users[email] = user
+        if user is not None:
+            found[email] = _project(user, fields)
+        elif email not in users:
+            missing.append(email)
+
+    # partial users are not cached, so only the requested columns are read
+    columns = tuple(USER_COLUMNS) if fields is None else ("email", *fields)
+    for first in range(0, len(missing), MAX_QUERY_PARAMETERS):
+        chunk = missing[first:first + MAX_QUERY_PARAMETERS]
+        cursor = get_read_db().execute(f"select {', '.join(USER_COLUMNS[column] for column in columns)} from user where email in ({', '.join('?' * len(chunk))})", chunk)
+        for row in cursor.fetchall():
+            user = dict(zip(columns, row))
+            if fields is None:
+                if user_cache is not None:
+                    user_cache.put(user["email"], user)
+                users[user["email"]] = user
+            found[user["email"]] = _project(user, fields)
+    return found
+
+
+def search_users(prefix: str, limit: int) -> list[dict]:
+    """
+    Search users by a case-insensitive prefix of their email, first name or last name. Only the email and the name of users are retrieved.
+
+    :param prefix: prefix of the email, first name or last name
+    :param limit: maximum number of users to return
+    :return: list of dictionaries of user's email and name, ordered by email
+    """
+    # every column is searched by a range of its NOCASE index, the upper bound sorts after any string with the prefix
+    query = " union ".join(
+        f"select * from (select email, firstname, lastname from user where {column}>=? collate nocase and {column}<? collate nocase order by {column} collate nocase limit ?)"
+        for column in ("email", "firstname", "lastname")
+    )
+    cursor = get_read_db().execute(query + " order by email limit ?", [prefix, prefix + "\U0010ffff", limit] * 3 + [limit])
+    return [{"email": row[0], "firstname": row[1], "lastname": row[2]} for row in cursor.fetchall()]
+
+
+def user_exists(email: str) -> bool:
+    """
+    Check if a user with the given email address exists, without retrieving the user information.
+
+    :param email: user's email address
+    :return: True if the user exists, False otherwise
+    """
+    users = g.get("users", dict())
+    if email in users:
+        return users[email] is not None
+    user_cache = get_user_cache()
+    if user_cache is not None and user_cache.get(email) is not None:
+        return True
+    return get_read_db().execute("select 1 from user where email==?", [email]).fetchone() is not None
 
 
-def update_user_by_email(curr_email: str, email: str, password: str, firstname: str, lastname: str, gender: str, city: str, country: str, image: bytes | None) -> bool:
+@_serialized
+def update_user_by_email(curr_email: str, email: str, password: str, firstname: str, lastname: str, gender: str, city: str, country: str, image: str | None) -> bool:
     """
-    Update information belonging to a user with the given email address.
+    Update information belonging to a user with the given email address. Every update increments the user's revision.
 
     :param curr_email: current user's email address
     :param email: new email address
@@ -110,18 +1107,23 @@ def update_user_by_email(curr_email: str, email: str, password: str, firstname:
     :param gender: new gender
     :param city: new city
     :param country: new country
-    :param image: new profile image
+    :param image: id of the new profile image
     :return: True on success, False on error
     """
     try:
-        get_db().execute("update user set email=?, password=?, firstname=?, lastname=?, gender=?, city=?, country=?, image=? where email==?",
+        get_db().execute("update user set email=?, password=?, firstname=?, lastname=?, gender=?, city=?, country=?, image=?, revision=revision+1 where email==?",
                          [email, password, firstname, lastname, gender, city, country, image, curr_email])
-        get_db().commit()
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
+    finally:
+        _invalidate_user(curr_email)
+        _invalidate_user(email)
 
 
+@_serialized
 def delete_user_by_email(email: str) -> bool:
     """
     Delete a user with the given email address.
@@ -131,12 +1133,16 @@ def delete_user_by_email(email: str) -> bool:
     """
     try:
         get_db().execute("delete from user where email==?", [email])
-        get_db().commit()
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
+    finally:
+        _invalidate_user(email)
 
 
+@_serialized
 def create_post(author: str, user: str, content: str, created: datetime.datetime, edited: datetime.datetime, media: str | None) -> int:
     """
     Insert a new post into the database.
@@ -146,7 +1152,7 @@ def create_post(author: str, user: str, content: str, created: datetime.datetime
     :param content: content of the post
     :param created: datetime of the post creation
     :param edited: datetime of the post last edition
-    :param media: uploaded media
+    :param media: id of the uploaded media
     :return: id of the created post on success, -1 on error
     """
     try:
@@ -154,94 +1160,286 @@ def create_post(author: str, user: str, content: str, created: datetime.datetime
         cursor = db.cursor()
         cursor.execute("insert into post (author, user, content, created, edited, media) values (?, ?, ?, ?, ?, ?)",
                        [author, user, content, created, edited, media])
-        db.commit()
-        return cursor.lastrowid
+        post_id = cursor.lastrowid
+        # fan the post out to the feeds of the author and their followers, unless the author's followers read it on their own
+        cursor.execute("insert or ignore into timeline (user, post) select ?, ? union all "
+                       "select follower, ? from follow where followee==? and not (select fanout_on_read from user where email==?)",
+                       [author, post_id, post_id, author, author])
+        _commit()
+        return post_id
+    except Exception:
+        _rollback()
+        return -1
+
+
+@_serialized
+def create_posts(posts: list[dict]) -> int:
+    """
+    Insert many posts into the database by one statement in one transaction, either all of them or none. Posts are fanned out to feeds like by create_post().
+
+    :param posts: dictionaries of posts information with the same keys as parameters of create_post(); 'edited' and 'media' are optional
+    :return: number of created posts on success, -1 on error
+    """
+    try:
+        db = get_db()
+        # take the write lock first, so that no other process creates posts in the meantime and the new posts are exactly those after the last one
+        if not db.in_transaction:
+            db.execute("BEGIN IMMEDIATE")
+        last_id = db.execute("select coalesce(max(seq), 0) from sqlite_sequence where name=='post'").fetchone()[0]
+        db.executemany("insert into post (author, user, content, created, edited, media) values (?, ?, ?, ?, ?, ?)",
+                       [(post["author"], post["user"], post["content"], post["created"], post.get("edited", post["created"]), post.get("media")) for post in posts])
+        db.execute("insert or ignore into timeline (user, post) select author, id from post where id>? union all "
+                   "select follow.follower, post.id from post join follow on follow.followee==post.author join user on user.email==post.author "
+                   "where post.id>? and not user.fanout_on_read", [last_id, last_id])
+        _commit()
+        return len(posts)
     except Exception:
+        _rollback()
         return -1
 
 
-def get_post_by_id(post_id: str) -> None | dict:
+def get_post_by_id(post_id: str, fields: None | tuple[str, ...] = None) -> None | dict:
     """
     Retrieve a post by its id.
 
     :param post_id: id of the post
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None
     :return: dictionary of the posts information if it exists, None otherwise
+    :raises ValueError: if an unknown field is requested
     """
-    cursor = get_db().execute("select id, author, user, content, created, edited, media from post where id==?", [post_id])
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        return None
-
-    return {
-        "id": rows[0][0],
-        "author": rows[0][1],
-        "user": rows[0][2],
-        "content": rows[0][3],
-        "created": rows[0][4],
-        "edited": rows[0][5],
-        "media": rows[0][6],
-    }
+    posts = _select_posts("post.id==?", [post_id], fields)
+    return posts[0] if len(posts) > 0 else None
 
 
-def list_post() -> list[dict]:
+def list_post(before_id: int | None = None, limit: int | None = None, fields: None | tuple[str, ...] = None) -> list[dict]:
     """
-    List all posts.
+    List all posts, newest first.
 
+    :param before_id: only list posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to return, unlimited if None
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
     :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
     """
-    cursor = get_db().execute("select id, author, user, content, created, edited, media from post")
-    rows = cursor.fetchall()
-    return [{
-        "id": row[0],
-        "author": row[1],
-        "user": row[2],
-        "content": row[3],
-        "created": row[4],
-        "edited": row[5],
-        "media": row[6],
-    } for row in rows]
+    return _select_posts(None, [], fields, before_id, limit)
 
 
-def list_posts_by_user(email: str) -> list[dict]:
+def list_posts_by_user(email: str, before_id: int | None = None, limit: int | None = None, fields: None | tuple[str, ...] = None) -> list[dict]:
     """
-    List all posts on given user's wall.
+    List posts on given user's wall, newest first.
 
     :param email: user's email address
+    :param before_id: only list posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to return, unlimited if None
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
     :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
     """
-    cursor = get_db().execute("select id, author, user, content, created, edited, media from post where user==?", [email])
-    rows = cursor.fetchall()
-    return [{
-        "id": row[0],
-        "author": row[1],
-        "user": row[2],
-        "content": row[3],
-        "created": row[4],
-        "edited": row[5],
-        "media": row[6],
-    } for row in rows]
+    return _select_posts("user==?", [email], fields, before_id, limit)
+
+
+def iter_posts(email: str | None = None, before_id: int | None = None, limit: int | None = None, fields: None | tuple[str, ...] = None) -> Iterator[dict]:
+    """
+    Iterate posts on given user's wall, newest first, as they are read from the database. Posts are not held in memory, so they can be streamed.
+
+    :param email: user's email address, all posts if None
+    :param before_id: only iterate posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to iterate, unlimited if None
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
+    :return: iterator of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
+    """
+    if email is not None:
+        return _iter_posts("user==?", [email], fields, before_id, limit)
+    return _iter_posts(None, [], fields, before_id, limit)
 
 
-def list_posts_by_author(email: str) -> list[dict]:
+def list_posts_by_author(email: str, fields: None | tuple[str, ...] = None) -> list[dict]:
     """
     List all posts created by given user.
 
     :param email: user's email address
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
     :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
     """
-    cursor = get_db().execute("select id, author, user, content, created, edited, media from post where author==?", [email])
-    rows = cursor.fetchall()
-    return [{
-        "id": row[0],
-        "author": row[1],
-        "user": row[2],
-        "content": row[3],
-        "created": row[4],
-        "edited": row[5],
-        "media": row[6],
-    } for row in rows]
+    return _select_posts("author==?", [email], fields)
+
+
+def search_posts(query: str, email: str | None = None, offset: int = 0, limit: int | None = None, fields: None | tuple[str, ...] = None,
+                 window: int | None = None) -> list[dict]:
+    """
+    Search posts by their content, best matches first (ranked by bm25).
+
+    :param query: words the posts must contain, every word is matched as a whole (not as FTS5 query syntax)
+    :param email: only search posts on this user's wall, all posts if None
+    :param offset: number of best matches to skip
+    :param limit: maximum number of posts to return, unlimited if None
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
+    :param window: only rank this many newest matches, so searching common words doesn't rank all posts; all matches if None
+    :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
+    """
+    fields = _post_fields(fields)
+    match = _search_match(query, email)
+    if match is None:
+        return []
+
+    sql = f"select {', '.join(POST_COLUMNS[field] for field in fields)} from post_search join post on post.id==post_search.rowid"
+    if "media_type" in fields or "media_thumbnail" in fields:
+        sql += " left join media on media.id==post.media"
+    sql += " where post_search match ?"
+    params = [match]
+    if email is not None:
+        sql += " and post.user==?"
+        params.append(email)
+    if window is not None:
+        sql += " and post_search.rowid>=(select coalesce(min(rowid), 0) from (select rowid from post_search where post_search match ? order by rowid desc limit ?))"
+        params.extend([match, window])
+    sql += " order by post_search.rank, post.id desc limit ? offset ?"
+    params.extend([limit if limit is not None else -1, offset])
+    cursor = get_read_db().execute(sql, params)
+    return [dict(zip(fields, row)) for row in cursor.fetchall()]
+
+
+def count_search_matches(query: str, email: str | None = None, limit: int | None = None) -> int:
+    """
+    Count posts matching a search query, e.g. to find out whether search results are limited by the ranking window.
+
+    :param query: words the posts must contain (see search_posts())
+    :param email: only count posts on this user's wall, all posts if None
+    :param limit: stop counting at this number of matches, unlimited if None
+    :return: number of matching posts, at most 'limit'
+    """
+    match = _search_match(query, email)
+    if match is None:
+        return 0
+    cursor = get_read_db().execute("select count(*) from (select rowid from post_search where post_search match ? limit ?)",
+                                   [match, limit if limit is not None else -1])
+    return cursor.fetchone()[0]
+
 
+def _search_match(query: str, email: str | None) -> None | str:
+    """
+    Create an FTS5 match expression of a search query.
+
+    :param query: words the posts must contain, every word is matched as a whole
+    :param email: only match posts on this user's wall, all posts if None
+    :return: match expression, None if the query contains no words
+    """
+    words = " ".join(_quote_fts(word) for word in query.split())
+    if words == "":
+        return None
+    match = f"content : ({words})"
+    if email is not None:
+        # the wall owner is tokenized like text, so the match is narrowed down by the index and checked exactly by the query
+        match += f" AND user : {_quote_fts(email)}"
+    return match
+
+
+def list_feed(email: str, before_id: int | None = None, limit: int | None = None, fields: None | tuple[str, ...] = None) -> list[dict]:
+    """
+    List posts in given user's feed, i.e. posts written by the user and by users they follow, newest first.
+    Posts are read from the user's materialized timeline, posts of followed users with too many followers are merged in from the post table.
+
+    :param email: user's email address
+    :param before_id: only list posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to return, unlimited if None
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
+    :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
+    """
+    db = get_read_db()
+    authors = [row[0] for row in db.execute("select followee from follow join user on user.email==follow.followee where follow.follower==? and user.fanout_on_read",
+                                            [email]).fetchall()]
+
+    # every source is a range of an index, so at most 'limit' newest posts are read from each of them
+    before = " and {column}<?" if before_id is not None else ""
+    sources, params = [f"select * from (select post from timeline where user==?{before.format(column='post')} order by post desc limit ?)"], [email]
+    params += [before_id] if before_id is not None else []
+    params.append(limit if limit is not None else -1)
+    for author in authors:
+        sources.append(f"select * from (select id from post where author==?{before.format(column='id')} order by id desc limit ?)")
+        params += [author, *([before_id] if before_id is not None else []), limit if limit is not None else -1]
+    return _select_posts(f"post.id in ({' union '.join(sources)})", params, fields, limit=limit)
+
+
+@_serialized
+def follow_user(follower: str, followee: str, created: datetime.datetime, fanout_limit: int, backfill: int) -> bool:
+    """
+    Make a user follow another user, and add the latest posts of the followed user to the follower's feed.
+    Once a user has more followers than the fan-out limit, their posts are not fanned out to followers' feeds anymore, followers read them on their own.
 
+    :param follower: email of the following user
+    :param followee: email of the followed user
+    :param created: datetime of the follow creation
+    :param fanout_limit: maximum number of followers whose feeds posts are fanned out to
+    :param backfill: number of latest posts of the followed user added to the follower's feed
+    :return: True on success, False on error
+    """
+    try:
+        db = get_db()
+        if db.execute("insert or ignore into follow (follower, followee, created) values (?, ?, ?)", [follower, followee, created]).rowcount > 0:
+            db.execute("update user set fanout_on_read=1 where email==? and not fanout_on_read and (select count(*) from follow where followee==?)>?",
+                       [followee, followee, fanout_limit])
+            db.execute("insert or ignore into timeline (user, post) select ?, id from post where author==? and not (select fanout_on_read from user where email==?) "
+                       "order by id desc limit ?", [follower, followee, followee, backfill])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def unfollow_user(follower: str, followee: str) -> bool:
+    """
+    Make a user stop following another user, and remove posts of the followed user from the follower's feed.
+    No action is taken if the user is not followed.
+
+    :param follower: email of the following user
+    :param followee: email of the followed user
+    :return: True on success, False on error
+    """
+    try:
+        db = get_db()
+        if db.execute("delete from follow where follower==? and followee==?", [follower, followee]).rowcount > 0:
+            db.execute("delete from timeline where user==? and post in (select id from post where author==?)", [follower, followee])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+def is_following(follower: str, followee: str) -> bool:
+    """
+    Check if a user follows another user.
+
+    :param follower: email of the following user
+    :param followee: email of the followed user
+    :return: True if the user is followed, False otherwise
+    """
+    return get_read_db().execute("select 1 from follow where follower==? and followee==?", [follower, followee]).fetchone() is not None
+
+
+def get_posts_version(email: str | None = None) -> dict:
+    """
+    Retrieve the version of a set of posts, which changes whenever a post is created, edited or deleted, or a thumbnail of its media is generated.
+
+    :param email: email of the user whose wall to describe, all posts if None
+    :return: dictionary of the version number and the datetime of the last change, 0 and None if no posts were ever created
+    """
+    row = get_read_db().execute("select version, updated from wall_version where user==?", ["" if email is None else email]).fetchone()
+    if row is None:
+        return {"version": 0, "updated": None}
+    return {
+        "version": row[0],
+        "updated": row[1],
+    }
+
+
+@_serialized
 def update_post_by_id(post_id: str, author: str, user: str, content: str, created: datetime.datetime, edited: datetime.datetime, media: str | None) -> bool:
     """
     Update post by its id.
@@ -252,18 +1450,20 @@ def update_post_by_id(post_id: str, author: str, user: str, content: str, create
     :param content: new post's content
     :param created: datetime of the post creation
     :param edited: datetime of the post last edition
-    :param media: uploaded media
+    :param media: id of the uploaded media
     :return: True on success, False on error
     """
     try:
         get_db().execute("update post set author=?, user=?, content=?, created=?, edited=?, media=? where id==?",
-                         [author, user, content, created, edited, post_id, media])
-        get_db().commit()
+                         [author, user, content, created, edited, media, post_id])
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
 
 
+@_serialized
 def delete_post_by_id(post_id: str) -> bool:
     """
     Deletes post by its id.
@@ -273,12 +1473,14 @@ def delete_post_by_id(post_id: str) -> bool:
     """
     try:
         get_db().execute("delete from post where id==?", [post_id])
-        get_db().commit()
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
 
 
+@_serialized
 def delete_posts_by_user(email: str) -> bool:
     """
     Delete all posts on user's wall.
@@ -288,7 +1490,483 @@ def delete_posts_by_user(email: str) -> bool:
     """
     try:
         get_db().execute("delete from post where user==?", [email])
-        get_db().commit()
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def delete_posts_by_author(email: str) -> bool:
+    """
+    Delete all posts created by given user.
+
+    :param email: user's email address
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("delete from post where author==?", [email])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def create_media(media_id: str, mimetype: str, size: int, created: datetime.datetime) -> bool:
+    """
+    Register media stored in the blob store. No action is taken if the media is already registered.
+
+    :param media_id: media id (hash of the media content)
+    :param mimetype: media MIME type
+    :param size: media size in bytes
+    :param created: datetime of the media upload
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("insert or ignore into media (id, mimetype, size, created) values (?, ?, ?, ?)", [media_id, mimetype, size, created])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def create_media_upload(upload_id: str, owner: str, mimetype: str, size: int, created: datetime.datetime) -> bool:
+    """
+    Register a new upload of media in chunks.
+
+    :param upload_id: upload id
+    :param owner: email of the user uploading the media
+    :param mimetype: media MIME type
+    :param size: media size in bytes
+    :param created: datetime of the upload start
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("insert into media_upload (id, owner, mimetype, size, created) values (?, ?, ?, ?, ?)", [upload_id, owner, mimetype, size, created])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+def get_media_upload(upload_id: str) -> None | dict:
+    """
+    Retrieve an upload of media in chunks.
+
+    :param upload_id: upload id
+    :return: dictionary of the upload information if it exists, None otherwise
+    """
+    row = get_read_db().execute("select id, owner, mimetype, size, received, created from media_upload where id==?", [upload_id]).fetchone()
+    if row is None:
+        return None
+
+    return {
+        "id": row[0],
+        "owner": row[1],
+        "mimetype": row[2],
+        "size": row[3],
+        "received": row[4],
+        "created": row[5],
+    }
+
+
+@_serialized
+def update_media_upload_received(upload_id: str, received: int, new_received: int) -> bool:
+    """
+    Record a received chunk of an upload, unless another chunk has been recorded in the meantime.
+
+    :param upload_id: upload id
+    :param received: number of bytes received before the chunk
+    :param new_received: number of bytes received including the chunk
+    :return: True if the chunk was recorded, False on error or if the upload has changed in the meantime
+    """
+    try:
+        updated = get_db().execute("update media_upload set received=? where id==? and received==?", [new_received, upload_id, received]).rowcount
+        _commit()
+        return updated > 0
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def delete_media_upload(upload_id: str) -> bool:
+    """
+    Delete an upload of media in chunks.
+
+    :param upload_id: upload id
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("delete from media_upload where id==?", [upload_id])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+def list_expired_media_uploads(created_before: datetime.datetime) -> list[str]:
+    """
+    List uploads of media in chunks started before the given datetime.
+
+    :param created_before: datetime of the oldest upload to keep
+    :return: list of upload ids
+    """
+    return [row[0] for row in get_read_db().execute("select id from media_upload where created<?", [created_before]).fetchall()]
+
+
+def get_media_by_id(media_id: str) -> None | dict:
+    """
+    Retrieve media information by its id.
+
+    :param media_id: media id
+    :return: dictionary of media information if it exists, None otherwise
+    """
+    cursor = get_read_db().execute("select id, mimetype, size, created, thumbnail, processed from media where id==?", [media_id])
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return None
+
+    return {
+        "id": rows[0][0],
+        "mimetype": rows[0][1],
+        "size": rows[0][2],
+        "created": rows[0][3],
+        "thumbnail": rows[0][4],
+        "processed": rows[0][5],
+    }
+
+
+def get_media_thumbnails(media_ids: list[str]) -> dict[str, str]:
+    """
+    Retrieve thumbnails of many media at once.
+
+    :param media_ids: media ids
+    :return: dictionary mapping the id of media with a thumbnail to the media id of the thumbnail
+    """
+    media_ids = list(dict.fromkeys(media_ids))
+    thumbnails = dict()
+    for first in range(0, len(media_ids), MAX_QUERY_PARAMETERS):
+        chunk = media_ids[first:first + MAX_QUERY_PARAMETERS]
+        cursor = get_read_db().execute(f"select id, thumbnail from media where id in ({', '.join('?' * len(chunk))}) and thumbnail is not NULL", chunk)
+        thumbnails |= dict(cursor.fetchall())
+    return thumbnails
+
+
+@_serialized
+def update_media_thumbnail(media_id: str, thumbnail: None | str, processed: datetime.datetime) -> bool:
+    """
+    Assign a thumbnail (downscaled image or video preview frame) to media, or record that the media can't be processed. Walls showing the media get a new version.
+
+    :param media_id: media id
+    :param thumbnail: media id of the thumbnail, None if the media can't be processed
+    :param processed: datetime of the media processing
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("update media set thumbnail=?, processed=? where id==?", [thumbnail, processed, media_id])
+        _commit()
         return True
     except Exception:
+        _rollback()
         return False
+
+
+@_serialized
+def create_media_job(media_id: str, created: datetime.datetime) -> int:
+    """
+    Insert a new media processing job into the queue.
+
+    :param media_id: id of the media to process
+    :param created: datetime of the job creation
+    :return: id of the created job on success, -1 on error
+    """
+    try:
+        cursor = get_db().execute("insert into media_job (media, created) values (?, ?)", [media_id, created])
+        _commit()
+        return cursor.lastrowid
+    except Exception:
+        _rollback()
+        return -1
+
+
+@_serialized
+def claim_media_job(now: datetime.datetime, claimed_until: datetime.datetime, max_attempts: int) -> None | dict:
+    """
+    Claim the oldest media processing job, which is not claimed by another worker. Jobs of workers which died are claimed again once their claim expires.
+
+    :param now: current datetime
+    :param claimed_until: datetime when the claim expires
+    :param max_attempts: jobs which were claimed this many times are not claimed anymore
+    :return: dictionary of the job information if a job was claimed, None otherwise
+    """
+    cursor = get_db().execute("update media_job set attempts=attempts+1, claimed_until=? where id==("
+                              "select id from media_job where attempts<? and (claimed_until is null or claimed_until<?) order by id limit 1"
+                              ") returning id, media, attempts", [claimed_until, max_attempts, now])
+    row = cursor.fetchone()
+    _commit()
+    if row is None:
+        return None
+
+    return {
+        "id": row[0],
+        "media": row[1],
+        "attempts": row[2],
+    }
+
+
+@_serialized
+def delete_media_job(job_id: int) -> bool:
+    """
+    Delete a finished media processing job.
+
+    :param job_id: id of the job
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("delete from media_job where id==?", [job_id])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+@_serialized
+def create_wall_event(wall: str, event: str, created: datetime.datetime) -> int:
+    """
+    Insert a new wall event into the database.
+
+    :param wall: email of the user whose wall the event belongs to
+    :param event: JSON encoded event
+    :param created: datetime of the event
+    :return: id of the created event on success, -1 on error
+    """
+    try:
+        db = get_db()
+        cursor = db.cursor()
+        cursor.execute("insert into wall_event (wall, event, created) values (?, ?, ?)", [wall, event, created])
+        _commit()
+        return cursor.lastrowid
+    except Exception:
+        _rollback()
+        return -1
+
+
+def get_last_wall_event_id() -> int:
+    """
+    Retrieve the id of the latest wall event.
+
+    :return: id of the latest wall event, 0 if there are no events
+    """
+    cursor = get_read_db().execute("select max(id) from wall_event")
+    return cursor.fetchone()[0] or 0
+
+
+def list_wall_events(after_id: int) -> list[dict]:
+    """
+    List wall events newer than the given one, oldest first.
+
+    :param after_id: id of the last already known event
+    :return: list of dictionaries of wall events
+    """
+    cursor = get_read_db().execute("select id, wall, event, created from wall_event where id>? order by id", [after_id])
+    return [{
+        "id": row[0],
+        "wall": row[1],
+        "event": row[2],
+        "created": row[3],
+    } for row in cursor.fetchall()]
+
+
+@_serialized
+def delete_wall_events(created_before: datetime.datetime) -> bool:
+    """
+    Delete wall events older than the given datetime.
+
+    :param created_before: datetime of the oldest event to keep
+    :return: True on success, False on error
+    """
+    try:
+        get_db().execute("delete from wall_event where created<?", [created_before])
+        _commit()
+        return True
+    except Exception:
+        _rollback()
+        return False
+
+
+def _commit() -> None:
+    """
+    Commit the writes of a function of this module, unless they are grouped by transaction(), which commits them at its end.
+
+    :return: None
+    """
+    if g.get("transaction_depth", 0) == 0:
+        get_db().commit()
+
+
+def _rollback() -> None:
+    """
+    Roll back the writes of a function of this module which failed. Within transaction(), all writes of the transaction are rolled back at its end.
+
+    :return: None
+    """
+    if g.get("transaction_depth", 0) == 0:
+        get_db().rollback()
+    else:
+        g.transaction_failed = True
+
+
+def _invalidate_user(email: str) -> None:
+    """
+    Remove a user from the request memo and the process cache, so the next retrieval reads the user from the database.
+
+    :param email: user's email address
+    :return: None
+    """
+    g.get("users", dict()).pop(email, None)
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user_cache.invalidate(email)
+        if g.get("transaction_depth", 0) > 0:
+            # concurrent requests may cache the user again until the transaction is committed, so it is invalidated once more then
+            g.setdefault("uncommitted_users", set()).add(email)
+
+
+def _invalidate_committed_users() -> None:
+    """
+    Remove users written by a transaction from the process cache, once the transaction is committed or rolled back (see _invalidate_user()).
+
+    :return: None
+    """
+    emails = g.pop("uncommitted_users", None)
+    user_cache = get_user_cache()
+    if emails and user_cache is not None:
+        for email in emails:
+            user_cache.invalidate(email)
+
+
+def _select_posts(condition: None | str, params: list, fields: None | tuple[str, ...], before_id: int | None = None, limit: int | None = None) -> list[dict]:
+    """
+    Select posts matching a condition, newest first. The media table is joined only if the media type is requested.
+
+    :param condition: SQL condition the posts must match, all posts if None
+    :param params: parameters of the condition
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
+    :param before_id: only select posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to select, unlimited if None
+    :return: list of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
+    """
+    return list(_iter_posts(condition, params, fields, before_id, limit))
+
+
+def _iter_posts(condition: None | str, params: list, fields: None | tuple[str, ...], before_id: int | None = None, limit: int | None = None) -> Iterator[dict]:
+    """
+    Iterate posts matching a condition, newest first, as they are read from the database cursor. The media table is joined only if the media type is requested.
+
+    :param condition: SQL condition the posts must match, all posts if None
+    :param params: parameters of the condition
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None; 'id' is always retrieved
+    :param before_id: only select posts with id lower than this one (keyset pagination cursor), all posts if None
+    :param limit: maximum number of posts to select, unlimited if None
+    :return: iterator of dictionaries of posts information
+    :raises ValueError: if an unknown field is requested
+    """
+    fields = _post_fields(fields)
+    query = f"select {', '.join(POST_COLUMNS[field] for field in fields)} from post"
+    if "media_type" in fields or "media_thumbnail" in fields:
+        query += " left join media on media.id==post.media"
+    conditions, params = ([condition] if condition is not None else []), list(params)
+    if before_id is not None:
+        conditions.append("post.id<?")
+        params.append(before_id)
+    if conditions:
+        query += " where " + " and ".join(conditions)
+    query += " order by post.id desc"
+    if limit is not None:
+        query += " limit ?"
+        params.append(limit)
+    cursor = get_read_db().execute(query, params)
+    return (dict(zip(fields, row)) for row in cursor)
+
+
+def _post_fields(fields: None | tuple[str, ...]) -> tuple[str, ...]:
+    """
+    Validate requested post fields.
+
+    :param fields: post fields to retrieve (see POST_COLUMNS), all fields if None
+    :return: post fields to retrieve, starting with 'id'
+    :raises ValueError: if an unknown field is requested
+    """
+    if fields is None:
+        return tuple(POST_COLUMNS)
+    unknown_fields = set(fields) - set(POST_COLUMNS)
+    if unknown_fields:
+        raise ValueError(f"unknown post fields: {', '.join(sorted(unknown_fields))}")
+    return "id", *(field for field in fields if field != "id")
+
+
+def _quote_fts(text: str) -> str:
+    """
+    Quote text as an FTS5 string, so it is matched as a phrase instead of being interpreted as query syntax.
+
+    :param text: text to quote
+    :return: FTS5 string
+    """
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _project(record: None | dict, fields: None | tuple[str, ...]) -> None | dict:
+    """
+    Copy a record (e.g. a cached user), keeping only the given fields. Callers may modify the copy freely.
+
+    :param record: dictionary of record fields, or None
+    :param fields: fields to keep, all fields if None
+    :return: copy of the record, None if no record is given
+    """
+    if record is None:
+        return None
+    if fields is None:
+        return dict(record)
+    return {field: record[field] for field in fields}
+
+
+def _list_migrations() -> list[tuple[int, str]]:
+    """
+    List schema migrations. Migrations are SQL scripts named '<version>_<description>.sql', versions start at 1.
+
+    :return: list of migration versions and paths, sorted by version
+    """
+    migrations = []
+    for file_name in os.listdir(current_app.config["DATABASE_MIGRATIONS"]):
+        if file_name.endswith(".sql"):
+            migrations.append((int(file_name.split("_", 1)[0]), os.path.join(current_app.config["DATABASE_MIGRATIONS"], file_name)))
+    return sorted(migrations)
+
+
+def _split_statements(script: str) -> list[str]:
+    """
+    Split an SQL script into separate statements.
+
+    :param script: SQL script
+    :return: list of SQL statements
+    """
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
@@ -0,0 +1,143 @@
+import datetime
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+from flask import current_app, Flask
+
+from twidder import database_handler
+
+
+class WallSubscription:
+    """Subscription to events of posts on a user's wall."""
+
+    def __init__(self, wall: str, callback: Callable[[dict], None]):
+        """
+        :param wall: email of the user whose wall to watch
+        :param callback: function called with every event of the wall, it must not block (e.g. by sending the event to a client)
+        """
+        self.wall = wall
+        self.callback = callback
+
+
+_subscriptions: dict[str, set[WallSubscription]] = dict()  # subscriptions of the current process, mapping the wall email to its subscriptions
+_subscriptions_lock: threading.Lock = threading.Lock()
+_dispatcher_pid: None | int = None
+_last_cleanup: float = time.monotonic()  # when old events were last deleted by the current process
+
+
+def publish(wall: str, event: dict) -> bool:
+    """
+    Publish an event of a post on a user's wall. Events are stored in the database, so subscribers in all worker processes receive them.
+
+    :param wall: email of the user whose wall the event belongs to
+    :param event: JSON serializable event
+    :return: True on success, False on error
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if database_handler.create_wall_event(wall, json.dumps(event), now) == -1:
+        return False
+    _delete_old_events(now)
+    return True
+
+
+def subscribe(wall: str, callback: Callable[[dict], None]) -> WallSubscription:
+    """
+    Subscribe to events of posts on a user's wall.
+
+    :param wall: email of the user whose wall to watch
+    :param callback: function called with every event of the wall, it is called from another thread and must not block, as it delays events of all subscribers
+    :return: the subscription, which must be cancelled by unsubscribe() when not needed anymore
+    """
+    subscription = WallSubscription(wall, callback)
+    _start_dispatcher()
+    with _subscriptions_lock:
+        _subscriptions.setdefault(wall, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription: WallSubscription) -> None:
+    """
+    Cancel a subscription to events of posts on a user's wall.
+
+    :param subscription: subscription returned by subscribe()
+    :return: None
+    """
+    with _subscriptions_lock:
+        subscriptions = _subscriptions.get(subscription.wall, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            _subscriptions.pop(subscription.wall, None)
+
+
+def _delete_old_events(now: datetime.datetime) -> None:
+    """
+    Delete events older than their retention, at most once per retention period in every process.
+    Events are deleted by publishers instead of dispatchers, so they don't pile up when no process has subscribers.
+
+    :param now: current datetime
+    :return: None
+    """
+    global _last_cleanup
+    retention = current_app.config["WALL_EVENT_RETENTION"]
+    with _subscriptions_lock:
+        if time.monotonic() - _last_cleanup < retention:
+            return
+        _last_cleanup = time.monotonic()
+
+    try:
+        if not database_handler.delete_wall_events(now - datetime.timedelta(seconds=retention)):
+            current_app.logger.warning("couldn't delete old wall events")
+    except Exception:
+        current_app.logger.exception("couldn't delete old wall events")
+
+
+def _start_dispatcher() -> None:
+    """
+    Start a thread dispatching wall events to subscribers of the current process, unless it is already running.
+
+    :return: None
+    """
+    global _dispatcher_pid
+    with _subscriptions_lock:
+        if _dispatcher_pid == os.getpid():
+            return
+        _dispatcher_pid = os.getpid()
+
+    dispatcher = threading.Thread(target=_dispatch_events, args=(current_app._get_current_object(),), name="wall-event-dispatcher", daemon=True)
+    dispatcher.start()
+
+
+def _dispatch_events(app: Flask) -> None:
+    """
+    Periodically read new wall events from the database and pass them to subscribers of the current process.
+    The dispatcher reads events in its own app context, so it doesn't hold a database connection of the request which started it.
+
+    :param app: the application, providing the configuration and database connections
+    :return: None
+    """
+    last_event_id = None
+    while True:
+        try:
+            with app.app_context():
+                # start reading events published from now on
+                if last_event_id is None:
+                    last_event_id = database_handler.get_last_wall_event_id()
+                events = database_handler.list_wall_events(last_event_id)
+        except Exception:
+            app.logger.exception("couldn't read wall events")
+            events = []
+
+        for event in events:
+            last_event_id = event["id"]
+            with _subscriptions_lock:
+                subscriptions = list(_subscriptions.get(event["wall"], ()))
+            for subscription in subscriptions:
+                try:
+                    subscription.callback(json.loads(event["event"]))
+                except Exception:
+                    app.logger.exception(f"couldn't dispatch wall event: {event['id']=}")
+
+        time.sleep(app.config["WALL_EVENT_POLL_INTERVAL"])
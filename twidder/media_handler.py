@@ -0,0 +1,466 @@
+import base64
+import binascii
+import datetime
+import fcntl
+import hashlib
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+from typing import BinaryIO, Callable
+
+from flask import current_app, url_for, Flask
+
+from twidder import database_handler
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are not generated without Pillow, original media are served instead
+    Image = ImageOps = None
+
+ALLOWED_MEDIA_TYPES = ("image/", "video/")
+THUMBNAIL_FORMAT = ("WEBP", "image/webp")  # Pillow format and MIME type of thumbnails
+VIDEO_FRAME_TIMEOUT = 30  # maximum number of seconds to extract a preview frame of a video
+MEDIA_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+UPLOAD_CHUNK_READ_SIZE = 64 * 1024  # uploaded chunks are written to disk by blocks of this size
+DATA_URL_PATTERN = re.compile(r"^data:(?P<mimetype>[\w.+-]+/[\w.+-]+)(;[\w.+-]+=[\w.+-]+)*;base64,", re.ASCII)
+
+
+def store_data_url(data_url: str) -> None | str:
+    """
+    Store media given as a base64 data URL (e.g. 'data:image/png;base64,...') in the blob store.
+
+    :param data_url: media encoded as a data URL
+    :return: id of the stored media on success, None if the data URL is invalid
+    """
+    match = DATA_URL_PATTERN.match(data_url)
+    if match is None:
+        return None
+    try:
+        data = base64.b64decode(data_url[match.end():], validate=True)
+    except binascii.Error:
+        return None
+    return store_bytes(data, match.group("mimetype"))
+
+
+def store_bytes(data: bytes, mimetype: str, process: bool = True) -> None | str:
+    """
+    Store media in the blob store. Media are addressed by the SHA-256 hash of their content, so identical uploads share the same file.
+    New media are queued for processing, i.e. generating their thumbnail.
+
+    :param data: media content
+    :param mimetype: media MIME type
+    :param process: False to skip processing (e.g. for thumbnails themselves)
+    :return: id of the stored media on success, None if the media type is not allowed or the media couldn't be stored
+    """
+    if not mimetype.startswith(ALLOWED_MEDIA_TYPES):
+        return None
+
+    media_id = hashlib.sha256(data).hexdigest()
+    path = get_media_path(media_id)
+    if not os.path.exists(path):
+        # write to a temporary file first, so readers never see partially written media
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            media_id = _store_file(tmp_path, media_id, mimetype, len(data), process)
+        except OSError:
+            media_id = None
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return media_id
+    return _register_media(media_id, mimetype, len(data), process)
+
+
+def resolve_media(media: str, allowed_types: tuple[str, ...] = ALLOWED_MEDIA_TYPES) -> None | str:
+    """
+    Get the id of media referenced by a post or a user profile. Media are given either by the id of media already stored (e.g. uploaded in chunks),
+    or as a base64 data URL, which is stored first.
+
+    :param media: media id or data URL
+    :param allowed_types: allowed prefixes of the media MIME type
+    :return: media id on success, None if the media doesn't exist, its type is not allowed or the data URL is invalid
+    """
+    if is_media_id(media):
+        stored_media = database_handler.get_media_by_id(media)
+        return media if stored_media is not None and stored_media["mimetype"].startswith(allowed_types) else None
+    match = DATA_URL_PATTERN.match(media)
+    if match is None or not match.group("mimetype").startswith(allowed_types):
+        return None
+    return store_data_url(media)
+
+
+def create_upload(owner: str, mimetype: str, size: int) -> None | str:
+    """
+    Start an upload of media in chunks. Chunks are appended to a temporary file, so the upload can be resumed after a dropped connection.
+    Uploads which are not completed within 'MEDIA_UPLOAD_TTL' are deleted.
+
+    :param owner: email of the user uploading the media
+    :param mimetype: media MIME type
+    :param size: media size in bytes
+    :return: upload id on success, None if the media type is not allowed or the upload couldn't be started
+    """
+    if not mimetype.startswith(ALLOWED_MEDIA_TYPES):
+        return None
+    delete_expired_uploads()
+
+    upload_id = uuid.uuid4().hex
+    path = get_upload_path(upload_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "wb").close()
+    except OSError:
+        return None
+    if not database_handler.create_media_upload(upload_id, owner, mimetype, size, datetime.datetime.now(datetime.timezone.utc)):
+        os.unlink(path)
+        return None
+    return upload_id
+
+
+def append_upload(upload: dict, stream: BinaryIO, verify: Callable[[], bool]) -> int:
+    """
+    Append a chunk to an upload of media, right after the data received so far. Chunks of one upload are appended one at a time,
+    also by different processes. A chunk which is not recorded as received (e.g. it was incomplete) is overwritten by the next one.
+    The chunk is written to the upload file while it is read, and recorded as received only once it is verified, otherwise the file is truncated back.
+
+    :param upload: dictionary of the upload information
+    :param stream: stream of the chunk data
+    :param verify: function checking that the chunk data read from the stream are authentic (e.g. util.SignedBody.verify)
+    :return: number of bytes received including the chunk on success,
+             -1 if another chunk has been appended in the meantime, the chunk exceeds the media size, it isn't authentic or it couldn't be written
+    """
+    try:
+        with open(get_upload_path(upload["id"]), "r+b") as upload_file:
+            fcntl.flock(upload_file, fcntl.LOCK_EX)
+            current_upload = database_handler.get_media_upload(upload["id"])
+            if current_upload is None or current_upload["received"] != upload["received"]:
+                return -1
+
+            received = upload["received"]
+            upload_file.seek(received)
+            while block := stream.read(UPLOAD_CHUNK_READ_SIZE):
+                received += len(block)
+                if received > upload["size"]:
+                    return -1
+                upload_file.write(block)
+            if not verify():
+                upload_file.truncate(upload["received"])
+                return -1
+            upload_file.flush()
+            if not database_handler.update_media_upload_received(upload["id"], upload["received"], received):
+                return -1
+            return received
+    except OSError:
+        return -1
+
+
+def complete_upload(upload: dict) -> None | str:
+    """
+    Complete an upload of media, whose all data have been received, and move the media into the blob store.
+
+    :param upload: dictionary of the upload information
+    :return: id of the stored media on success, None if the media couldn't be stored
+    """
+    path = get_upload_path(upload["id"])
+    media_hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as upload_file:
+            while block := upload_file.read(UPLOAD_CHUNK_READ_SIZE):
+                media_hash.update(block)
+    except OSError:
+        return None
+
+    media_id = _store_file(path, media_hash.hexdigest(), upload["mimetype"], upload["size"], True)
+    if media_id is not None and not database_handler.delete_media_upload(upload["id"]):
+        current_app.logger.warning(f"couldn't delete completed upload: {upload['id']=}")
+    return media_id
+
+
+def delete_upload(upload_id: str) -> bool:
+    """
+    Delete an upload of media and its received data.
+
+    :param upload_id: upload id
+    :return: True on success, False on error
+    """
+    try:
+        os.unlink(get_upload_path(upload_id))
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    return database_handler.delete_media_upload(upload_id)
+
+
+def delete_expired_uploads() -> None:
+    """
+    Delete uploads of media which were not completed within 'MEDIA_UPLOAD_TTL'.
+
+    :return: None
+    """
+    created_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=current_app.config["MEDIA_UPLOAD_TTL"])
+    for upload_id in database_handler.list_expired_media_uploads(created_before):
+        if not delete_upload(upload_id):
+            current_app.logger.warning(f"couldn't delete expired upload: {upload_id=}")
+
+
+def get_upload_path(upload_id: str) -> str:
+    """
+    Get the absolute path of the temporary file holding data of the given upload.
+
+    :param upload_id: upload id
+    :return: path to the upload file
+    """
+    return os.path.abspath(os.path.join(current_app.config["MEDIA_FOLDER"], "uploads", upload_id))
+
+
+def is_upload_id(value: str) -> bool:
+    """
+    Check if a given string has the format of an upload id.
+
+    :param value: string to check
+    :return: True if the string is an upload id, False otherwise
+    """
+    return UPLOAD_ID_PATTERN.match(value) is not None
+
+
+def _store_file(path: str, media_id: str, mimetype: str, size: int, process: bool) -> None | str:
+    """
+    Move a completely written file into the blob store, unless the same media is already stored.
+
+    :param path: path to the file, it is moved or deleted
+    :param media_id: media id (hash of the file content)
+    :param mimetype: media MIME type
+    :param size: media size in bytes
+    :param process: False to skip processing (e.g. for thumbnails themselves)
+    :return: media id on success, None if the media couldn't be stored
+    """
+    media_path = get_media_path(media_id)
+    try:
+        if not os.path.exists(media_path):
+            os.makedirs(os.path.dirname(media_path), exist_ok=True)
+            os.replace(path, media_path)
+        else:
+            os.unlink(path)
+    except OSError:
+        return None
+    return _register_media(media_id, mimetype, size, process)
+
+
+def _register_media(media_id: str, mimetype: str, size: int, process: bool) -> None | str:
+    """
+    Register media stored in the blob store and queue it for processing, unless it is already registered and processed (with or without a thumbnail).
+    The media row decides about processing, not the file, as files may outlive their rows (e.g. after the database is cleared or restored).
+
+    :param media_id: media id
+    :param mimetype: media MIME type
+    :param size: media size in bytes
+    :param process: True to queue the media for processing
+    :return: media id on success, None if the media couldn't be registered
+    """
+    media = database_handler.get_media_by_id(media_id)
+    if media is None and not database_handler.create_media(media_id, mimetype, size, datetime.datetime.now(datetime.timezone.utc)):
+        return None
+    if process and (media is None or media["processed"] is None) and not enqueue_processing(media_id):
+        current_app.logger.warning(f"couldn't queue media processing: {media_id=}")
+    return media_id
+
+
+def get_media_path(media_id: str) -> str:
+    """
+    Get the absolute path of the file holding the given media.
+
+    :param media_id: media id
+    :return: path to the media file
+    """
+    return os.path.abspath(os.path.join(current_app.config["MEDIA_FOLDER"], media_id[:2], media_id))
+
+
+def is_media_id(value: str) -> bool:
+    """
+    Check if a given string has the format of a media id.
+
+    :param value: string to check
+    :return: True if the string is a media id, False otherwise
+    """
+    return MEDIA_ID_PATTERN.match(value) is not None
+
+
+def get_media_url(media: None | str) -> None | str:
+    """
+    Get the URL the given media can be downloaded from.
+
+    :param media: media id, or a data URL for media stored inline before the blob store was introduced
+    :return: media URL, None if no media is given
+    """
+    if media is None or media.startswith("data:"):
+        return media
+    return url_for("api.media.get_media", media_id=media)
+
+
+def get_media_urls(media: None | str, mimetype: None | str, thumbnail: None | str) -> dict:
+    """
+    Get URLs of the given media and its thumbnail. Images are served as thumbnails by default, the original only on request.
+
+    :param media: media id, or a data URL for media stored inline before the blob store was introduced
+    :param mimetype: media MIME type
+    :param thumbnail: media id of the media thumbnail, None if it is not generated (yet)
+    :return: dictionary of the default URL ('url'), the original URL ('original') and the preview image URL ('preview'), URLs are None if not available
+    """
+    original = get_media_url(media)
+    preview = get_media_url(thumbnail) if media is not None else None
+    url = preview if preview is not None and mimetype is not None and mimetype.startswith("image/") else original
+    return {"url": url, "original": original, "preview": preview}
+
+
+_jobs_available: threading.Event = threading.Event()  # set when the current process queues new media
+_workers_pid: None | int = None
+_workers_lock: threading.Lock = threading.Lock()
+
+
+def enqueue_processing(media_id: str) -> bool:
+    """
+    Queue stored media for processing by background workers. The queue is stored in the database, so jobs survive restarts.
+
+    :param media_id: media id
+    :return: True on success, False on error
+    """
+    if database_handler.create_media_job(media_id, datetime.datetime.now(datetime.timezone.utc)) == -1:
+        return False
+    start_workers()
+    _jobs_available.set()
+    return True
+
+
+def process_media(media_id: str) -> bool:
+    """
+    Generate the thumbnail of stored media, i.e. a downscaled image, or a preview frame of a video.
+    Images smaller than the thumbnail size are their own thumbnails.
+
+    :param media_id: media id
+    :return: True if the thumbnail was generated, False if the media can't be processed (e.g. it is not a valid image)
+    :raises OSError: if the thumbnail couldn't be stored, the media should be processed again
+    """
+    media = database_handler.get_media_by_id(media_id)
+    if media is None or Image is None:
+        return False
+
+    path = get_media_path(media_id)
+    if media["mimetype"].startswith("video/"):
+        frame = _extract_video_frame(path)
+        if frame is None:
+            return False
+        source = io.BytesIO(frame)
+    else:
+        source = path
+
+    size = current_app.config["MEDIA_THUMBNAIL_SIZE"]
+    try:
+        with Image.open(source) as image:
+            if media["mimetype"].startswith("image/") and image.width <= size and image.height <= size:
+                thumbnail = media_id
+            else:
+                thumbnail = store_bytes(_create_thumbnail(image, size), THUMBNAIL_FORMAT[1], process=False)
+    except (OSError, Image.DecompressionBombError):
+        return False
+
+    if thumbnail is None or not database_handler.update_media_thumbnail(media_id, thumbnail, datetime.datetime.now(datetime.timezone.utc)):
+        raise OSError(f"couldn't store the thumbnail: {media_id=}")
+    return True
+
+
+def start_workers() -> None:
+    """
+    Start threads processing queued media, unless they are already running in this process.
+
+    :return: None
+    """
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+    app = current_app._get_current_object()
+    for i in range(app.config["MEDIA_WORKERS"]):
+        worker = threading.Thread(target=_process_jobs, args=(app,), name=f"media-worker-{i}", daemon=True)
+        worker.start()
+
+
+def _process_jobs(app: Flask) -> None:
+    """
+    Process queued media one by one. Jobs are claimed in the database, so workers of all processes share the queue.
+
+    :param app: the application, providing the configuration and database connections
+    :return: None
+    """
+    while True:
+        job = None
+        try:
+            with app.app_context():
+                now = datetime.datetime.now(datetime.timezone.utc)
+                job = database_handler.claim_media_job(now, now + datetime.timedelta(seconds=app.config["MEDIA_JOB_TIMEOUT"]), app.config["MEDIA_JOB_MAX_ATTEMPTS"])
+                if job is not None:
+                    try:
+                        processed = process_media(job["media"])
+                    except Exception:
+                        if job["attempts"] < app.config["MEDIA_JOB_MAX_ATTEMPTS"]:
+                            raise
+                        app.logger.exception(f"couldn't process media, giving up: {job=}")
+                        processed = False
+                    if not processed:
+                        # the outcome is recorded, so that the media isn't queued again whenever it is uploaded again
+                        app.logger.info(f"media can't be processed: {job['media']=}")
+                        database_handler.update_media_thumbnail(job["media"], None, now)
+                    database_handler.delete_media_job(job["id"])
+                    continue
+        except Exception:
+            # the job is claimed again when its claim expires, until its last attempt
+            app.logger.exception(f"couldn't process media: {job=}")
+
+        # jobs queued by other processes are found by polling
+        _jobs_available.wait(app.config["MEDIA_JOB_POLL_INTERVAL"])
+        _jobs_available.clear()
+
+
+def _create_thumbnail(image: "Image.Image", size: int) -> bytes:
+    """
+    Downscale an image to fit into a square.
+
+    :param image: image to downscale
+    :param size: side of the square in pixels
+    :return: encoded thumbnail
+    """
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, THUMBNAIL_FORMAT[0], quality=80)
+    return buffer.getvalue()
+
+
+def _extract_video_frame(path: str) -> None | bytes:
+    """
+    Extract the first frame of a video using ffmpeg, if it is installed.
+
+    :param path: path to the video file
+    :return: PNG encoded frame, None if the frame couldn't be extracted
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    try:
+        result = subprocess.run([ffmpeg, "-v", "error", "-i", path, "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+                                capture_output=True, timeout=VIDEO_FRAME_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return None
+    return result.stdout if result.returncode == 0 and len(result.stdout) > 0 else None
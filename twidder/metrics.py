@@ -0,0 +1,402 @@
+import bisect
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, g, request, Flask, Response
+
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # upper bounds of request duration histogram buckets in seconds
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  # Prometheus text exposition format
+RETIRED_FILE = "retired.json"  # counters of processes which are no longer running, so merged counters don't decrease when a worker is restarted
+RETIRED_LOCK_FILE = "retired.lock"
+
+
+class Metrics:
+    """
+    Request and database metrics of one process. Recording a request only updates a few counters, the metrics are formatted when they are scraped.
+    Processes (e.g. gunicorn workers) share their metrics through snapshot files, so any of them can serve metrics of all of them.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._requests: dict[tuple[str, str, str], list] = dict()  # (endpoint, method, status) -> counts of histogram buckets, followed by count and sum
+        self._queries: dict[str, list] = dict()  # endpoint -> number of SQL queries and their total duration
+        self._in_flight: dict[str, int] = dict()  # endpoint -> number of requests in progress
+        self._websockets = 0
+        self._changed = False
+        self._flush_lock = threading.Lock()  # snapshots are written in the order they are taken
+
+    def start_request(self, endpoint: str) -> None:
+        """
+        Record a started request.
+
+        :param endpoint: Flask endpoint of the request
+        :return: None
+        """
+        with self._lock:
+            self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+            self._changed = True
+
+    def finish_request(self, endpoint: str, method: str, status: str, duration: float, queries: int, query_time: float) -> None:
+        """
+        Record a finished request.
+
+        :param endpoint: Flask endpoint of the request
+        :param method: HTTP method
+        :param status: HTTP status code of the response
+        :param duration: request duration in seconds, including streaming of the response
+        :param queries: number of SQL queries executed by the request
+        :param query_time: total duration of the SQL queries in seconds
+        :return: None
+        """
+        bucket = bisect.bisect_left(REQUEST_DURATION_BUCKETS, duration)
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+            histogram = self._requests.get((endpoint, method, status))
+            if histogram is None:
+                histogram = self._requests[(endpoint, method, status)] = [0] * (len(REQUEST_DURATION_BUCKETS) + 1) + [0.0]
+            if bucket < len(REQUEST_DURATION_BUCKETS):
+                histogram[bucket] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+            if queries > 0:
+                query_stats = self._queries.setdefault(endpoint, [0, 0.0])
+                query_stats[0] += queries
+                query_stats[1] += query_time
+            self._changed = True
+
+    def add_websockets(self, count: int) -> None:
+        """
+        Record opened (positive count) or closed (negative count) WebSockets.
+
+        :param count: change of the number of open WebSockets
+        :return: None
+        """
+        with self._lock:
+            self._websockets += count
+            self._changed = True
+
+    def snapshot(self) -> dict:
+        """
+        Get a copy of the metrics, which can be serialized to JSON and merged with metrics of other processes.
+
+        :return: dictionary of the metrics
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def flush(self, folder: str) -> dict:
+        """
+        Write a snapshot of the metrics to a file in the given folder, if the metrics changed since the last write.
+
+        :param folder: folder of snapshot files of all processes
+        :return: the snapshot, which is the same as the written one
+        :raises OSError: if the snapshot couldn't be written
+        """
+        with self._flush_lock:
+            with self._lock:
+                snapshot = self._snapshot()
+                changed, self._changed = self._changed, False
+            if changed:
+                try:
+                    _write_snapshot(folder, f"{self.pid}.json", snapshot)
+                except OSError:
+                    with self._lock:
+                        self._changed = True
+                    raise
+            return snapshot
+
+    def _snapshot(self) -> dict:
+        """
+        Get a copy of the metrics, the lock must be held by the caller.
+
+        :return: dictionary of the metrics
+        """
+        return {
+            "requests": [[*key, *histogram] for key, histogram in self._requests.items()],
+            "queries": [[endpoint, *query_stats] for endpoint, query_stats in self._queries.items()],
+            "in_flight": [[endpoint, count] for endpoint, count in self._in_flight.items()],
+            "websockets": self._websockets,
+        }
+
+
+_metrics: None | Metrics = None  # metrics of the current process
+_metrics_lock: threading.Lock = threading.Lock()
+_flusher_pid: None | int = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Get the metrics of the current process, creating them if necessary.
+
+    :return: metrics
+    """
+    global _metrics
+    with _metrics_lock:
+        # forked processes (e.g. gunicorn workers) start with empty metrics, so metrics of the parent are not counted twice
+        if _metrics is None or _metrics.pid != os.getpid():
+            _metrics = Metrics()
+        return _metrics
+
+
+def start_request() -> None:
+    """
+    Start measuring the current request, called before every request.
+
+    :return: None
+    """
+    g.metrics_start = time.perf_counter()
+    get_metrics().start_request(request.endpoint or "none")
+    if _flusher_pid != os.getpid() and current_app.config["METRICS_FOLDER"] is not None:
+        _start_flusher()
+
+
+def record_response(response: Response) -> Response:
+    """
+    Record the status of the response to the current request, called after every request.
+
+    :param response: response to the request
+    :return: the same response
+    """
+    g.metrics_status = response.status_code
+    return response
+
+
+def finish_request(exception: BaseException | None = None) -> None:
+    """
+    Record the current request, called at the end of every request, i.e. after the response is streamed.
+
+    :param exception: exception which ended the request, if any
+    :return: None
+    """
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+    # queries are counted by the database connections of the request (see database_handler.MeasuredConnection), which are released after the request
+    connections = [db for db in (g.get("db"), g.get("read_db")) if db is not None]
+    get_metrics().finish_request(request.endpoint or "none", request.method, str(g.get("metrics_status", 500)), time.perf_counter() - start,
+                                 sum(db.queries for db in connections), sum(db.query_time for db in connections))
+
+
+def render(gauges: dict[str, tuple[str, float]]) -> str:
+    """
+    Format metrics of all processes in the Prometheus text format.
+
+    :param gauges: additional gauges measured when the metrics are scraped, mapping the gauge name to its description and value
+    :return: metrics in the Prometheus text format
+    """
+    folder = current_app.config["METRICS_FOLDER"]
+    if folder is None:
+        snapshots = [get_metrics().snapshot()]
+    else:
+        # metrics of this process are written first, so scrapes served by other processes don't see lower counters afterwards
+        try:
+            snapshots = [get_metrics().flush(folder)]
+        except OSError as e:
+            current_app.logger.warning(f"couldn't write metrics snapshot: {e}")
+            snapshots = [get_metrics().snapshot()]
+        snapshots.extend(_read_snapshots(folder))
+    merged = _merge_snapshots(snapshots)
+    requests, queries, in_flight = merged["requests"], merged["queries"], merged["in_flight"]
+
+    lines = [
+        "# HELP twidder_http_request_duration_seconds Duration of HTTP requests, including streaming of the response.",
+        "# TYPE twidder_http_request_duration_seconds histogram",
+    ]
+    for endpoint, method, status, *histogram in sorted(requests):
+        labels = f'endpoint="{_escape(endpoint)}",method="{_escape(method)}",status="{status}"'
+        cumulative = 0
+        for upper_bound, count in zip(REQUEST_DURATION_BUCKETS, histogram):
+            cumulative += count
+            lines.append(f'twidder_http_request_duration_seconds_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+        lines.append(f'twidder_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+        lines.append(f"twidder_http_request_duration_seconds_count{{{labels}}} {histogram[-2]}")
+        lines.append(f"twidder_http_request_duration_seconds_sum{{{labels}}} {histogram[-1]}")
+
+    lines.append("# HELP twidder_http_requests_in_flight Number of HTTP requests in progress.")
+    lines.append("# TYPE twidder_http_requests_in_flight gauge")
+    lines.extend(f'twidder_http_requests_in_flight{{endpoint="{_escape(endpoint)}"}} {count}' for endpoint, count in sorted(in_flight))
+
+    lines.append("# HELP twidder_sql_queries_total Number of SQL queries executed by HTTP requests.")
+    lines.append("# TYPE twidder_sql_queries_total counter")
+    lines.extend(f'twidder_sql_queries_total{{endpoint="{_escape(endpoint)}"}} {count}' for endpoint, count, _ in sorted(queries))
+    lines.append("# HELP twidder_sql_query_duration_seconds_total Time spent executing SQL queries and fetching their rows by HTTP requests.")
+    lines.append("# TYPE twidder_sql_query_duration_seconds_total counter")
+    lines.extend(f'twidder_sql_query_duration_seconds_total{{endpoint="{_escape(endpoint)}"}} {query_time}' for endpoint, _, query_time in sorted(queries))
+
+    lines.append("# HELP twidder_websockets_open Number of open session WebSockets.")
+    lines.append("# TYPE twidder_websockets_open gauge")
+    lines.append(f"twidder_websockets_open {merged['websockets']}")
+
+    for name, (description, value) in gauges.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _start_flusher() -> None:
+    """
+    Start a thread periodically writing the metrics snapshot of the current process, unless it is already running.
+    Snapshots are written by a thread instead of requests, so the last changes are written also when the process becomes idle.
+
+    :return: None
+    """
+    global _flusher_pid
+    with _metrics_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    flusher = threading.Thread(target=_flush_metrics, args=(current_app._get_current_object(),), name="metrics-flusher", daemon=True)
+    flusher.start()
+
+
+def _flush_metrics(app: Flask) -> None:
+    """
+    Write the metrics snapshot of the current process once per 'METRICS_FLUSH_INTERVAL', if the metrics changed.
+
+    :param app: the application, providing the configuration
+    :return: None
+    """
+    while True:
+        time.sleep(app.config["METRICS_FLUSH_INTERVAL"])
+        try:
+            get_metrics().flush(app.config["METRICS_FOLDER"])
+        except OSError as e:
+            app.logger.warning(f"couldn't write metrics snapshot: {e}")
+
+
+def _merge_snapshots(snapshots: list[dict]) -> dict:
+    """
+    Merge metrics snapshots of several processes.
+
+    :param snapshots: list of snapshots
+    :return: merged snapshot
+    """
+    requests, queries, in_flight, websockets = dict(), dict(), dict(), 0
+    for snapshot in snapshots:
+        for endpoint, method, status, *histogram in snapshot["requests"]:
+            merged = requests.setdefault((endpoint, method, status), [0] * len(histogram))
+            for i, value in enumerate(histogram):
+                merged[i] += value
+        for endpoint, count, query_time in snapshot["queries"]:
+            merged = queries.setdefault(endpoint, [0, 0.0])
+            merged[0] += count
+            merged[1] += query_time
+        for endpoint, count in snapshot["in_flight"]:
+            in_flight[endpoint] = in_flight.get(endpoint, 0) + count
+        websockets += snapshot["websockets"]
+    return {
+        "requests": [[*key, *histogram] for key, histogram in requests.items()],
+        "queries": [[endpoint, *query_stats] for endpoint, query_stats in queries.items()],
+        "in_flight": [[endpoint, count] for endpoint, count in in_flight.items()],
+        "websockets": websockets,
+    }
+
+
+def _read_snapshots(folder: str) -> list[dict]:
+    """
+    Read metrics snapshots of other running processes, followed by the counters of processes which are no longer running.
+
+    :param folder: folder of snapshot files
+    :return: list of snapshots
+    """
+    try:
+        file_names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    snapshots, stopped = [], []
+    for file_name in file_names:
+        pid, extension = os.path.splitext(file_name)
+        if extension != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            stopped.append(file_name)
+            continue
+        except PermissionError:
+            pass  # the process is running, but it belongs to another user
+        snapshot = _load_snapshot(os.path.join(folder, file_name))
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    try:
+        snapshots.append(_retire_snapshots(folder, stopped))
+    except OSError as e:
+        current_app.logger.warning(f"couldn't retire metrics snapshots: {e}")
+    return snapshots
+
+
+def _retire_snapshots(folder: str, file_names: list[str]) -> dict:
+    """
+    Add counters of snapshots of processes which are no longer running to the retired counters, and delete the snapshots.
+    Gauges (e.g. requests in progress) of these processes are dropped. The retired counters are updated by one process at a time.
+
+    :param folder: folder of snapshot files
+    :param file_names: names of snapshot files of processes which are no longer running
+    :return: snapshot of the retired counters
+    """
+    with open(os.path.join(folder, RETIRED_LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        retired = _load_snapshot(os.path.join(folder, RETIRED_FILE)) or {"requests": [], "queries": [], "in_flight": [], "websockets": 0}
+        # snapshots might have been retired by another process in the meantime
+        stopped = [snapshot for snapshot in (_load_snapshot(os.path.join(folder, file_name)) for file_name in file_names) if snapshot is not None]
+        if stopped:
+            retired = _merge_snapshots([retired, *stopped]) | {"in_flight": [], "websockets": 0}
+            _write_snapshot(folder, RETIRED_FILE, retired)
+            for file_name in file_names:
+                try:
+                    os.unlink(os.path.join(folder, file_name))
+                except FileNotFoundError:
+                    pass
+    return retired
+
+
+def _load_snapshot(path: str) -> None | dict:
+    """
+    Read a snapshot file.
+
+    :param path: path to the snapshot file
+    :return: the snapshot, None if the file doesn't exist or is invalid
+    """
+    try:
+        with open(path, "r") as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(folder: str, file_name: str, snapshot: dict) -> None:
+    """
+    Write a snapshot file. The file is written to a temporary file first, so other processes never read a partially written snapshot.
+
+    :param folder: folder of snapshot files
+    :param file_name: name of the snapshot file
+    :param snapshot: snapshot to write
+    :return: None
+    :raises OSError: if the snapshot couldn't be written
+    """
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(snapshot, tmp_file)
+        os.replace(tmp_path, os.path.join(folder, file_name))
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _escape(value: str) -> str:
+    """
+    Escape a label value of the Prometheus text format.
+
+    :param value: label value
+    :return: escaped label value
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,2 @@
+-- revision counter of user details, used to create entity tags of user profiles
+alter table user add column revision integer NOT NULL default 0;
@@ -0,0 +1,3 @@
+-- walls and user's posts are listed newest first
+create index if not exists post_user_id on post (user, id desc);
+create index if not exists post_author_id on post (author, id desc);
@@ -0,0 +1,7 @@
+-- events of posts on user walls, pushed to clients viewing the walls by every worker process
+create table if not exists wall_event (
+    id integer primary key AUTOINCREMENT,
+    wall text NOT NULL,
+    event text NOT NULL,
+    created datetime NOT NULL
+);
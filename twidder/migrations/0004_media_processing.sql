@@ -0,0 +1,11 @@
+-- downscaled version of images and preview frame of videos, stored as another media
+alter table media add column thumbnail text;
+
+-- media waiting for processing, claimed by worker threads of any worker process
+create table if not exists media_job (
+    id integer primary key AUTOINCREMENT,
+    media text NOT NULL,
+    attempts integer NOT NULL default 0,
+    claimed_until datetime,
+    created datetime NOT NULL
+);
@@ -0,0 +1,27 @@
+-- full-text index of post contents, the contents themselves are read from the post table
+-- the wall owner is indexed too, so searches on a wall don't have to go through all matches
+create virtual table if not exists post_search using fts5(
+    content,
+    user,
+    content='post',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+-- only the content is relevant for ranking
+insert into post_search (post_search, rank) values ('rank', 'bm25(1.0, 0.0)');
+
+-- keep the index in sync with the post table
+create trigger if not exists post_search_insert after insert on post begin
+    insert into post_search (rowid, content, user) values (new.id, new.content, new.user);
+end;
+create trigger if not exists post_search_delete after delete on post begin
+    insert into post_search (post_search, rowid, content, user) values ('delete', old.id, old.content, old.user);
+end;
+create trigger if not exists post_search_update after update of content, user on post begin
+    insert into post_search (post_search, rowid, content, user) values ('delete', old.id, old.content, old.user);
+    insert into post_search (rowid, content, user) values (new.id, new.content, new.user);
+end;
+
+-- index existing posts
+insert into post_search (post_search) values ('rebuild');
@@ -0,0 +1,4 @@
+-- users are looked up by a case-insensitive prefix of their email or name (autocomplete)
+create index if not exists user_email_nocase on user (email collate nocase);
+create index if not exists user_firstname_nocase on user (firstname collate nocase);
+create index if not exists user_lastname_nocase on user (lastname collate nocase);
@@ -0,0 +1,35 @@
+-- users follow other users, their feed shows posts written by the followed users
+create table if not exists follow (
+    follower text NOT NULL,
+    followee text NOT NULL,
+    created datetime NOT NULL,
+    primary key (follower, followee)
+) without rowid;
+-- followers of an author are listed whenever the author creates a post
+create index if not exists follow_followee on follow (followee, follower);
+
+-- feeds materialized on write (fan-out), so a page of a feed is a single range of the primary key
+create table if not exists timeline (
+    user text NOT NULL,
+    post integer NOT NULL,
+    primary key (user, post)
+) without rowid;
+create index if not exists timeline_post on timeline (post);
+
+-- posts of users with too many followers are not fanned out, followers' feeds read them from the post table instead
+alter table user add column fanout_on_read integer NOT NULL default 0;
+
+-- keep follows and feeds in sync with users and posts
+create trigger if not exists timeline_post_delete after delete on post begin
+    delete from timeline where post==old.id;
+end;
+create trigger if not exists follow_user_delete after delete on user begin
+    delete from follow where follower==old.email;
+    delete from follow where followee==old.email;
+    delete from timeline where user==old.email;
+end;
+create trigger if not exists follow_user_update after update of email on user when new.email!=old.email begin
+    update follow set follower=new.email where follower==old.email;
+    update follow set followee=new.email where followee==old.email;
+    update timeline set user=new.email where user==old.email;
+end;
@@ -0,0 +1,11 @@
+-- media uploaded in chunks, received data are kept in a temporary file until the upload is completed
+create table if not exists media_upload (
+    id text primary key,
+    owner text NOT NULL,
+    mimetype text NOT NULL,
+    size integer NOT NULL,
+    received integer NOT NULL default 0,
+    created datetime NOT NULL
+);
+-- abandoned uploads are deleted once they expire
+create index if not exists media_upload_created on media_upload (created);
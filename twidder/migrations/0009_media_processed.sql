@@ -0,0 +1,2 @@
+-- datetime the thumbnail was assigned, pages of posts showing the media change then
+alter table media add column processed datetime;
@@ -0,0 +1,39 @@
+-- version of every wall, bumped whenever a post on the wall is created, edited or deleted, or a thumbnail of its media is generated
+-- pages of a wall are cached by its version, so they are validated by one lookup instead of an aggregate over the whole wall
+-- the row with an empty user is the version of all posts
+create table if not exists wall_version (
+    user text primary key,
+    version integer NOT NULL,
+    updated datetime NOT NULL
+) without rowid;
+
+-- posts showing a media are looked up when its thumbnail is generated
+create index if not exists post_media on post (media) where media is not NULL;
+
+-- keep versions in sync with posts and media
+create trigger if not exists wall_version_post_insert after insert on post begin
+    insert into wall_version (user, version, updated) values (new.user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')), ('', 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now'))
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+end;
+create trigger if not exists wall_version_post_update after update on post begin
+    insert into wall_version (user, version, updated) values (old.user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')), ('', 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now'))
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+    insert into wall_version (user, version, updated) select new.user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') where new.user!=old.user
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+end;
+create trigger if not exists wall_version_post_delete after delete on post begin
+    insert into wall_version (user, version, updated) values (old.user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')), ('', 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now'))
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+end;
+create trigger if not exists wall_version_media_update after update of thumbnail on media when new.thumbnail is not old.thumbnail begin
+    insert into wall_version (user, version, updated) select distinct user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') from post where media==new.id
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+    insert into wall_version (user, version, updated) select '', 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') where exists (select 1 from post where media==new.id)
+        on conflict (user) do update set version=version + 1, updated=excluded.updated;
+end;
+
+-- version existing walls
+insert into wall_version (user, version, updated) select user, 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') from post where true group by user
+    on conflict (user) do nothing;
+insert into wall_version (user, version, updated) values ('', 1, strftime('%Y-%m-%d %H:%M:%f+00:00', 'now'))
+    on conflict (user) do nothing;
@@ -20,3 +20,11 @@ create table if not exists post (
   	foreign key(author) references user(email),
   	foreign key(user) references user(email)
 );
+
+
+create table if not exists media (
+    id text primary key,
+    mimetype text NOT NULL,
+    size integer NOT NULL,
+    created datetime NOT NULL
+);
\ No newline at end of file
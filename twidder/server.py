@@ -1,12 +1,15 @@
 import base64
 import http
 import json
-import time
+import os
+import queue
+import threading
 
-from flask import Flask, send_file
-from flask_sock import Sock
+from flask import Flask, Response, send_file
+from flask_sock import Sock, ConnectionClosed
+from gevent import monkey
 
-from twidder import session_handler
+from twidder import database_handler, event_handler, metrics, session_handler, util
 from twidder.api.api import blueprint as api
 
 app = Flask(__name__, static_folder="static")
@@ -14,9 +17,66 @@ app.register_blueprint(api, url_prefix="/api")
 
 sock = Sock(app)
 
+SOCKET_CLOSE_TIMEOUT = 10.0  # NOTE: it takes some time for the socket to be closed successfully
+MAX_WATCHED_WALLS = 10  # maximum number of walls a client can receive events of
+
 app.config["MIN_PASSWORD_LENGTH"] = 8
+app.config["BCRYPT_ROUNDS"] = 12  # bcrypt work factor, every increment doubles the hashing time
+app.config["PASSWORD_HASHING_WORKERS"] = max(1, os.cpu_count() // int(os.environ.get("WEB_CONCURRENCY", 1)))  # per worker process, workers share the CPU cores
+app.config["PASSWORD_HASHING_QUEUE_SIZE"] = 32  # requests beyond the queue are rejected with 429 Too Many Requests
 app.config["DATABASE_FILE"] = "./database.db"
 app.config["DATABASE_SCHEMA"] = "./twidder/schema.sql"
+app.config["DATABASE_MIGRATIONS"] = "./twidder/migrations"
+app.config["DATABASE_POOL_SIZE"] = 8  # should match the number of worker threads (see run.sh)
+app.config["DATABASE_READ_POOL_SIZE"] = 8  # read-only connections used by functions which only read, should match the number of worker threads too
+app.config["DATABASE_POOL_TIMEOUT"] = 10.0
+app.config["DATABASE_WRITER"] = True  # writes are executed by one thread of every process, which groups concurrent writes into one transaction
+app.config["DATABASE_WRITE_WINDOW"] = 0.0  # number of seconds the writer waits for more writes to group, writes queued during a commit are grouped anyway
+app.config["DATABASE_WRITE_BATCH_SIZE"] = 100  # maximum number of writes grouped into one transaction
+app.config["DATABASE_WRITE_TIMEOUT"] = 30.0  # number of seconds a request waits for its writes, the request fails afterwards
+app.config["DATABASE_CACHE_SIZE"] = -16000  # negative values are in KiB
+app.config["DATABASE_MMAP_SIZE"] = 256 * 1024 * 1024
+app.config["SLOW_QUERY_THRESHOLD_MS"] = 100  # slower queries are logged with their parameter types and query plan, None to log no queries
+app.config["QUERY_LOG_SIZE"] = 200  # number of most expensive query fingerprints kept by every process
+app.config["USER_CACHE_SIZE"] = 0  # users cached by every process, disabled by default as changes made by other workers are visible only after USER_CACHE_TTL
+app.config["USER_CACHE_TTL"] = 5.0
+app.config["SESSION_BACKEND"] = "sqlite"  # "sqlite" shares sessions between worker processes, "memory" keeps them in the current process
+app.config["SESSION_DATABASE_FILE"] = "./sessions.db"
+app.config["SESSION_WATCH_INTERVAL"] = 0.5  # how often sessions changed by other processes are checked
+app.config["WALL_EVENT_POLL_INTERVAL"] = 0.25  # how often new wall events are read from the database
+app.config["WALL_EVENT_RETENTION"] = 60  # number of seconds wall events are kept in the database
+app.config["WALL_EVENT_QUEUE_SIZE"] = 100  # wall events waiting to be sent to one client, further events are dropped until the client catches up
+app.config["SOCK_SERVER_OPTIONS"] = {"ping_interval": 25}  # detect disconnected clients, so their sockets don't wait forever
+app.config["ADMIN_TOKEN"] = os.environ.get("TWIDDER_ADMIN_TOKEN")  # admin API is disabled if not set
+app.config["MEDIA_FOLDER"] = "./media"
+app.config["MEDIA_THUMBNAIL_SIZE"] = 480  # thumbnails fit into a square of this size in pixels
+app.config["MEDIA_WORKERS"] = 2  # media processing threads of every process
+app.config["MEDIA_JOB_POLL_INTERVAL"] = 5.0
+app.config["MEDIA_JOB_TIMEOUT"] = 60  # jobs of crashed workers are processed again after this number of seconds
+app.config["MEDIA_JOB_MAX_ATTEMPTS"] = 3
+app.config["MEDIA_UPLOAD_MAX_SIZE"] = 256 * 1024 * 1024
+app.config["MEDIA_UPLOAD_CHUNK_SIZE"] = 1024 * 1024  # chunk size suggested to clients, chunks are authenticated while they are written to the upload
+app.config["MEDIA_UPLOAD_TTL"] = 24 * 60 * 60  # number of seconds to complete an upload, abandoned uploads are deleted afterwards
+app.config["POSTS_PAGE_SIZE"] = 20
+app.config["POSTS_PAGE_SIZE_MAX"] = 100
+app.config["FEED_FANOUT_LIMIT"] = 10000  # posts of users with more followers are read by followers on their own, instead of being copied to their feeds
+app.config["FEED_BACKFILL_SIZE"] = 100  # number of latest posts of a followed user added to the follower's feed
+app.config["USER_SEARCH_LIMIT"] = 10
+app.config["USER_BATCH_SIZE_MAX"] = 100
+app.config["USER_SEARCH_LIMIT_MAX"] = 50
+app.config["IMPORT_BATCH_SIZE"] = 1000  # imported records written by one transaction
+app.config["COMPRESSION_MIN_SIZE"] = 1024  # smaller JSON responses are sent uncompressed, as the compression wouldn't pay off
+app.config["COMPRESSION_GZIP_LEVEL"] = 6
+app.config["COMPRESSION_BROTLI_QUALITY"] = 5  # higher qualities are too slow to compress responses on the fly
+app.config["METRICS_FOLDER"] = "./metrics"  # worker processes share their metrics through files in this folder, None to serve metrics of the scraped process only
+app.config["METRICS_FLUSH_INTERVAL"] = 1.0  # how often the metrics of a process are written for other processes
+app.config["SEARCH_RANK_WINDOW"] = 2000  # search results are the best matches among this many newest matching posts, ranking costs ~5 us per match
+
+app.teardown_appcontext(database_handler.disconnect_db)
+app.after_request(util.compress_response)
+app.before_request(metrics.start_request)
+app.after_request(metrics.record_response)
+app.teardown_request(metrics.finish_request)
 
 
 @sock.route('/session')
@@ -39,13 +99,113 @@ def session(ws):
     app.logger.info(f"session id verified for {user_email=}")
     ws.send("ok")
 
-    while True:
-        time.sleep(0.5)
-        if session_id != session_handler.get_session(user_email):
-            app.logger.debug(f"session expired: {user_email=}, {session_id=}, closing the socket")
-            ws.close(message="session expired")
-            time.sleep(10.0)  # NOTE: it takes some time for the socket to be closed successfully
-            return
+    # the socket is used by the sender of wall events and by the session subscription, so sending must be serialized
+    send_lock = threading.Lock()
+
+    # wall events are queued by the dispatcher, so a slow client doesn't delay events of other clients
+    # in gevent workers, they are sent by a greenlet of this socket as soon as they are queued
+    # in threaded workers, the socket already holds a request thread (and a reader thread of simple_websocket), so instead of yet another thread,
+    # the request thread sends them between received messages, waking up every 'WALL_EVENT_POLL_INTERVAL'
+    green = monkey.is_module_patched("threading")
+    events: queue.Queue[None | dict] = queue.Queue(maxsize=app.config["WALL_EVENT_QUEUE_SIZE"])
+
+    def queue_event(event: dict):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            app.logger.warning(f"wall events of the socket are full, dropping the event: {user_email=}, {event['type']=}")
+
+    def send_events():
+        # None is queued when the socket is closed
+        while (event := events.get()) is not None:
+            try:
+                with send_lock:
+                    ws.send(json.dumps(event))
+            except ConnectionClosed:
+                return
+
+    def send_queued_events():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            with send_lock:
+                ws.send(json.dumps(event))
+
+    def stop_sending_events():
+        # drop events not sent yet, so the sender stops immediately
+        while True:
+            try:
+                events.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close_socket():
+        app.logger.debug(f"session expired: {user_email=}, {session_id=}, closing the socket")
+        with send_lock:
+            try:
+                ws.close(message="session expired")
+            except ConnectionClosed:
+                pass
+        # stop waiting for the client to confirm the closure eventually, the request thread of threaded workers wakes up on its own
+        if green:
+            timer = threading.Timer(SOCKET_CLOSE_TIMEOUT, ws.event.set)
+            timer.daemon = True
+            timer.start()
+
+    # block until the session is invalidated or the client disconnects, the socket is released once the client confirms the closure (threaded workers don't wait)
+    # in the meantime, the client tells us which walls it shows, and we push events of posts on these walls
+    subscription = session_handler.subscribe(user_email, session_id, close_socket)
+    wall_subscriptions: dict[str, event_handler.WallSubscription] = dict()
+    if green:
+        threading.Thread(target=send_events, name="wall-event-sender", daemon=True).start()
+    metrics.get_metrics().add_websockets(1)
+    try:
+        while True:
+            if green:
+                data = ws.receive()
+            else:
+                data = ws.receive(timeout=app.config["WALL_EVENT_POLL_INTERVAL"])
+                send_queued_events()
+                if data is None:
+                    continue
+            try:
+                message = json.loads(data)
+            except (TypeError, ValueError):
+                message = None
+            if not isinstance(message, dict) or message.get("type") != "watch" or not isinstance(message.get("walls"), list):
+                app.logger.debug(f"unexpected socket message: {user_email=}, {message=}")
+                continue
+
+            walls = set(wall for wall in message["walls"][:MAX_WATCHED_WALLS] if isinstance(wall, str))
+            for wall in set(wall_subscriptions) - walls:
+                event_handler.unsubscribe(wall_subscriptions.pop(wall))
+            for wall in walls - set(wall_subscriptions):
+                wall_subscriptions[wall] = event_handler.subscribe(wall, queue_event)
+    except ConnectionClosed:
+        pass
+    finally:
+        metrics.get_metrics().add_websockets(-1)
+        for wall_subscription in wall_subscriptions.values():
+            event_handler.unsubscribe(wall_subscription)
+        if green:
+            stop_sending_events()
+        session_handler.unsubscribe(subscription)
+
+
+@app.route('/metrics')
+@util.authorize_admin
+def get_metrics():
+    """Get request and database metrics of all worker processes in the Prometheus text format."""
+    gauges = {
+        "twidder_sessions": ("Number of signed in users.", session_handler.get_backend().count()),
+    }
+    return Response(metrics.render(gauges), content_type=metrics.CONTENT_TYPE)
 
 
 @app.route('/', defaults={'path': ''})
@@ -1,9 +1,219 @@
+import abc
 import base64
+import os
+import sqlite3
 import threading
+import time
 import uuid
+from typing import Callable
 
-session_map: dict[str, str] = dict()  # globally shared session map, mapping the user email to the session id
-session_lock: threading.Lock = threading.Lock()
+from flask import current_app
+
+
+class SessionBackend(abc.ABC):
+    """Storage of user sessions, mapping the user email to the session id."""
+
+    @abc.abstractmethod
+    def get(self, email: str) -> None | str:
+        """
+        Retrieve the session id of the given user.
+
+        :param email: user email
+        :return: session id if it exists, None otherwise
+        """
+        pass
+
+    @abc.abstractmethod
+    def set(self, email: str, session_id: str) -> None:
+        """
+        Assign a session id to the given user, replacing the existing one.
+
+        :param email: user email
+        :param session_id: session id
+        :return: None
+        """
+        pass
+
+    @abc.abstractmethod
+    def delete(self, email: str) -> None:
+        """
+        Delete the session of the given user. No action is taken if the session does not exist.
+
+        :param email: user email
+        :return: None
+        """
+        pass
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        """
+        Count existing sessions.
+
+        :return: number of sessions
+        """
+        pass
+
+    def version(self) -> None | int:
+        """
+        Get the version of the sessions shared with other processes, which changes whenever another process modifies them.
+
+        :return: version of the shared sessions, None if sessions are not shared with other processes
+        """
+        return None
+
+
+class MemorySessionBackend(SessionBackend):
+    """Sessions stored in the memory of the current process. Sessions are not shared with other processes, so the application must run in one worker."""
+
+    def __init__(self):
+        self._session_map: dict[str, str] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> None | str:
+        with self._lock:
+            return self._session_map.get(email, None)
+
+    def set(self, email: str, session_id: str) -> None:
+        with self._lock:
+            self._session_map[email] = session_id
+
+    def delete(self, email: str) -> None:
+        with self._lock:
+            if email in self._session_map:
+                del self._session_map[email]
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._session_map)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions stored in an SQLite database file, shared by all processes (e.g. gunicorn workers) on the same machine."""
+
+    def __init__(self, database: str):
+        """
+        :param database: path to the SQLite database file
+        """
+        # one connection shared by all threads of the process, as thread-local connections would be created (and never closed) for every greenlet under gevent
+        # autocommit mode, every statement is a transaction on its own
+        self._connection = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
+        self._execute("create table if not exists session (email text primary key, session_id text NOT NULL)")
+
+    def get(self, email: str) -> None | str:
+        rows = self._execute("select session_id from session where email==?", [email])
+        return rows[0][0] if rows else None
+
+    def set(self, email: str, session_id: str) -> None:
+        self._execute("insert or replace into session (email, session_id) values (?, ?)", [email, session_id])
+
+    def delete(self, email: str) -> None:
+        self._execute("delete from session where email==?", [email])
+
+    def count(self) -> int:
+        return self._execute("select count(*) from session")[0][0]
+
+    def version(self) -> None | int:
+        return self._execute("PRAGMA data_version")[0][0]
+
+    def _execute(self, query: str, params: list | None = None) -> list[tuple]:
+        # rows are fetched while holding the lock, as the cursor belongs to the shared connection
+        with self._lock:
+            return self._connection.execute(query, params or []).fetchall()
+
+
+class Subscription:
+    """Subscription to the invalidation of a user session, i.e. its replacement by a new session or its deletion."""
+
+    def __init__(self, email: str, session_id: str, callback: Callable[[], None]):
+        """
+        :param email: user email the session is assigned to
+        :param session_id: session id
+        :param callback: function called (once) when the session is invalidated
+        """
+        self.email = email
+        self.session_id = session_id
+        self._callback = callback
+        self._notified = False
+        self._lock = threading.Lock()
+
+    def notify(self) -> None:
+        """
+        Notify the subscriber about the session invalidation. Subsequent notifications are ignored.
+
+        :return: None
+        """
+        with self._lock:
+            if self._notified:
+                return
+            self._notified = True
+        self._callback()
+
+
+_backend: None | SessionBackend = None  # session backend of the current process
+_backend_pid: None | int = None
+_backend_lock: threading.Lock = threading.Lock()
+
+
+def get_backend() -> SessionBackend:
+    """
+    Get the session backend of the current process, creating it from the app configuration if necessary.
+
+    :return: session backend
+    """
+    global _backend, _backend_pid
+    with _backend_lock:
+        # connections must not be shared with forked processes, so every process creates its own backend
+        if _backend is None or _backend_pid != os.getpid():
+            match current_app.config["SESSION_BACKEND"]:
+                case "memory":
+                    _backend = MemorySessionBackend()
+                case "sqlite":
+                    _backend = SQLiteSessionBackend(current_app.config["SESSION_DATABASE_FILE"])
+                case backend:
+                    raise ValueError(f"unknown session backend: {backend}")
+            _backend_pid = os.getpid()
+        return _backend
+
+
+_subscriptions: dict[str, set[Subscription]] = dict()  # subscriptions of the current process, mapping the user email to subscriptions of its sessions
+_subscriptions_lock: threading.Lock = threading.Lock()
+_watcher_pid: None | int = None
+
+
+def subscribe(email: str, session_id: str, callback: Callable[[], None]) -> Subscription:
+    """
+    Subscribe to the invalidation of a user session. The callback is called immediately if the session is not valid anymore.
+
+    :param email: user email the session is assigned to
+    :param session_id: session id
+    :param callback: function called (once) when the session is invalidated, it may be called from another thread
+    :return: the subscription, which must be cancelled by unsubscribe() when not needed anymore
+    """
+    subscription = Subscription(email, session_id, callback)
+    with _subscriptions_lock:
+        _subscriptions.setdefault(email, set()).add(subscription)
+    _start_watcher()
+
+    # the session might have been invalidated before the subscription was registered
+    _invalidate_sessions(email, get_session(email))
+    return subscription
+
+
+def unsubscribe(subscription: Subscription) -> None:
+    """
+    Cancel a subscription to the invalidation of a user session.
+
+    :param subscription: subscription returned by subscribe()
+    :return: None
+    """
+    with _subscriptions_lock:
+        subscriptions = _subscriptions.get(subscription.email, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            _subscriptions.pop(subscription.email, None)
 
 
 def create_session(email: str) -> str:
@@ -14,8 +224,8 @@ def create_session(email: str) -> str:
     :return: the newly created session
     """
     session = _generate_session_id()
-    with session_lock:
-        session_map[email] = session
+    get_backend().set(email, session)
+    _invalidate_sessions(email, session)
     return session
 
 
@@ -26,8 +236,7 @@ def get_session(email: str) -> None | str:
     :param email: user email the session is assigned to
     :return: session id if it exists, None otherwise
     """
-    with session_lock:
-        return session_map.get(email, None)
+    return get_backend().get(email)
 
 
 def delete_session(email: str) -> None:
@@ -37,9 +246,62 @@ def delete_session(email: str) -> None:
     :param email: user email the session is assigned to
     :return: None
     """
-    with session_lock:
-        if email in session_map:
-            del session_map[email]
+    get_backend().delete(email)
+    _invalidate_sessions(email, None)
+
+
+def _invalidate_sessions(email: str, session_id: None | str) -> None:
+    """
+    Notify subscribers of all sessions of the given user, which don't match the current session.
+
+    :param email: user email
+    :param session_id: current session id of the user, None if the user has no session
+    :return: None
+    """
+    with _subscriptions_lock:
+        subscriptions = [subscription for subscription in _subscriptions.get(email, ()) if subscription.session_id != session_id]
+    for subscription in subscriptions:
+        subscription.notify()
+
+
+def _start_watcher() -> None:
+    """
+    Start a thread watching changes of sessions made by other processes, unless it is already running in this process.
+    Sessions changed by this process are invalidated immediately, so no thread is needed if sessions are not shared.
+
+    :return: None
+    """
+    global _watcher_pid
+    backend = get_backend()
+    with _subscriptions_lock:
+        if _watcher_pid == os.getpid() or backend.version() is None:
+            return
+        _watcher_pid = os.getpid()
+    watcher = threading.Thread(target=_watch_sessions, args=(backend, current_app.config["SESSION_WATCH_INTERVAL"]), name="session-watcher", daemon=True)
+    watcher.start()
+
+
+def _watch_sessions(backend: SessionBackend, interval: float) -> None:
+    """
+    Periodically check sessions shared with other processes and notify subscribers of sessions invalidated by them.
+    One thread checks all sessions of the process, and only when the shared sessions have changed.
+
+    :param backend: session backend
+    :param interval: number of seconds between checks
+    :return: None
+    """
+    version = backend.version()
+    while True:
+        time.sleep(interval)
+        current_version = backend.version()
+        if current_version == version:
+            continue
+        version = current_version
+
+        with _subscriptions_lock:
+            emails = list(_subscriptions)
+        for email in emails:
+            _invalidate_sessions(email, backend.get(email))
 
 
 def _generate_session_id() -> str:
@@ -1,6 +1,18 @@
 // Constants
 const HOST = "localhost:8080";
 const POPUP_MESSAGE_TIME = 4500
+const WALL_SCROLL_THRESHOLD = 300
+const USER_SUGGESTIONS_DELAY = 150
+const MEDIA_UPLOAD_RETRIES = 3
+
+// Pending request of user suggestions, cancelled when the user keeps typing
+let userSuggestions = {timeout: null, controller: null};
+
+// Pagination state of each wall, mapping wall element id to the wall owner and the cursor of the next page
+let wallPages = {};
+
+// Session socket, also delivering events of posts on the shown walls
+let sessionSocket = null;
 
 // App state management
 
@@ -37,6 +49,7 @@ async function loadApp() {
 
     console.log("Initializing socket connection");
     const socket = new WebSocket('ws://' + HOST + '/session');
+    sessionSocket = socket;
 
     socket.onopen = (event) => {
         console.log("Socket is open");
@@ -55,6 +68,8 @@ async function loadApp() {
             showUserView().then();
         } else if (event.data === "fail") {
             showError("failed to initialize connection");
+        } else if (event.data.startsWith("{")) {
+            applyWallEvent(JSON.parse(event.data));
         } else {
             showError("Unexpected error")
             console.log("unexpected message from the server: " + event.data);
@@ -200,7 +215,7 @@ async function reloadUserData() {
             "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, null),
         },
     });
-    let userPostsRequest = fetch("http://" + HOST + "/api/v1/posts?" + new URLSearchParams({user_email: email}).toString(), {
+    let userPostsRequest = fetch("http://" + HOST + "/api/v1/posts?" + new URLSearchParams({user_email: email, include_authors: true}).toString(), {
         method: "GET",
         cache: "no-cache",
         headers: {
@@ -216,7 +231,8 @@ async function reloadUserData() {
     }
 
     let user = await userDataResponse.json();
-    let posts = (await userPostsResponse.json()).posts;
+    let userPosts = await userPostsResponse.json();
+    let posts = userPosts.posts;
 
     // Home tab
     document.getElementById("home-user-name").innerHTML = user.firstname + " " + user.lastname;
@@ -239,8 +255,11 @@ async function reloadUserData() {
         document.getElementById("home-wall"),
         document.getElementById("home-post-template").innerHTML,
         posts,
-        email
+        email,
+        userPosts.authors
     );
+    wallPages["home-wall"] = {userEmail: email, nextCursor: userPosts.next_cursor, loading: false};
+    watchWalls();
 }
 
 function formSearchUser(form) {
@@ -271,7 +290,7 @@ async function loadBrowseUser(userEmail) {
             "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, null),
         },
     });
-    let userPostsRequest = await fetch("http://" + HOST + "/api/v1/posts?" + new URLSearchParams({user_email: userEmail}).toString(), {
+    let userPostsRequest = await fetch("http://" + HOST + "/api/v1/posts?" + new URLSearchParams({user_email: userEmail, include_authors: true}).toString(), {
         method: "GET", cache: "no-cache", headers: {
             "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, null),
         },
@@ -289,7 +308,8 @@ async function loadBrowseUser(userEmail) {
     }
 
     let userData = await userDataResponse.json();
-    let posts = (await userPostsResponse.json()).posts;
+    let userPosts = await userPostsResponse.json();
+    let posts = userPosts.posts;
 
     document.getElementById("browse-search-button").innerHTML = "Reload";
 
@@ -306,12 +326,109 @@ async function loadBrowseUser(userEmail) {
         document.getElementById("browse-wall"),
         document.getElementById("browse-post-template").innerHTML,
         posts,
-        email
+        email,
+        userPosts.authors
     );
+    wallPages["browse-wall"] = {userEmail: userEmail, nextCursor: userPosts.next_cursor, loading: false};
+    watchWalls();
+}
+
+function watchWalls() {
+    // ask the server for events of posts on all shown walls
+    if (sessionSocket == null || sessionSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    let walls = Object.values(wallPages).map(page => page.userEmail);
+    sessionSocket.send(JSON.stringify({type: "watch", walls: walls}));
+}
+
+function applyWallEvent(event) {
+    console.log("Wall event received: " + event.type + ", wall: " + event.wall);
+
+    let email = localStorage.getItem("email");
+    let walls = [["home-wall", "home-post-template"], ["browse-wall", "browse-post-template"]];
+    for (let i = 0; i < walls.length; i++) {
+        let [wallID, postTemplateID] = walls[i];
+        if (wallPages[wallID] == null || wallPages[wallID].userEmail !== event.wall) {
+            continue;
+        }
+
+        let htmlWall = document.getElementById(wallID);
+        let postID = event.type === "post_deleted" ? event.id : event.post.id;
+        let postHtml = htmlWall.querySelector(".user-post[data-id='" + postID + "']");
+
+        if (event.type === "post_created" && postHtml == null) {
+            // the post might be already shown, if it was created by this client
+            let newPostHtml = createPostElement(document.getElementById(postTemplateID).innerHTML, event.post, email);
+            newPostHtml.style.animation = "post-appear 0.75s";
+            htmlWall.insertBefore(newPostHtml, htmlWall.childNodes[2]);
+        } else if (event.type === "post_updated" && postHtml != null) {
+            postHtml.replaceWith(createPostElement(document.getElementById(postTemplateID).innerHTML, event.post, email));
+        } else if (event.type === "post_deleted" && postHtml != null) {
+            postHtml.remove();
+        }
+    }
+}
+
+async function loadNextWallPage(wallID, postTemplateID) {
+    let page = wallPages[wallID];
+    if (page == null || page.nextCursor == null || page.loading) {
+        return;
+    }
+
+    let token = localStorage.getItem("token");
+    if (token == null) {
+        showError("Error: couldn't load token");
+        return;
+    }
+
+    let email = localStorage.getItem("email");
+    if (email == null) {
+        showError("Error: couldn't load user email");
+        return;
+    }
+
+    console.log("Loading next wall page: " + page.userEmail + ", before post id: " + page.nextCursor);
+    page.loading = true;
+
+    try {
+        const response = await fetch("http://" + HOST + "/api/v1/posts?" + new URLSearchParams({
+            user_email: page.userEmail, before_id: page.nextCursor, include_authors: true,
+        }).toString(), {
+            method: "GET", cache: "no-cache", headers: {
+                "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, null),
+            },
+        });
+
+        // the wall might have been reloaded in the meantime, drop this page then
+        if (wallPages[wallID] !== page) {
+            return;
+        }
+
+        if (response.status !== 200) {
+            showError("Unexpected error");
+            return;
+        }
+
+        let userPosts = await response.json();
+        appendPostsToWall(
+            document.getElementById(wallID),
+            document.getElementById(postTemplateID).innerHTML,
+            userPosts.posts,
+            email,
+            userPosts.authors
+        );
+        page.nextCursor = userPosts.next_cursor;
+    } catch (e) {
+        console.log("Couldn't load next wall page: " + e);
+    } finally {
+        // reset also if the request failed, so scrolling loads the page again
+        page.loading = false;
+    }
 }
 
 
-function reloadWall(htmlWall, postTemplateHtml, posts, email) {
+function reloadWall(htmlWall, postTemplateHtml, posts, email, authors = {}) {
     // remove all old posts
     for (let i = htmlWall.children.length - 1; i >= 0; i--) {
         let element = htmlWall.children[i];
@@ -320,6 +437,10 @@ function reloadWall(htmlWall, postTemplateHtml, posts, email) {
         }
     }
 
+    appendPostsToWall(htmlWall, postTemplateHtml, posts, email, authors);
+}
+
+function appendPostsToWall(htmlWall, postTemplateHtml, posts, email, authors = {}) {
     // sort posts by date
     posts.sort(function(a, b){
       return new Date(b.created) - new Date(a.created);
@@ -327,47 +448,69 @@ function reloadWall(htmlWall, postTemplateHtml, posts, email) {
 
     // add new posts from template
     for (let i = 0; i < posts.length; i++) {
-        const newPostHtml = document.createElement("div");
-        newPostHtml.innerHTML = postTemplateHtml;
-        newPostHtml.classList.add("user-post");
-
-        // general information
-        newPostHtml.setAttribute("data-id", posts[i]["id"]);
-        newPostHtml.getElementsByClassName("time")[0].innerHTML = getDateTimeFormat(new Date(posts[i]["created"]));
-        newPostHtml.getElementsByClassName("author")[0].innerHTML = posts[i]["author"];
-
-        // show media
-        let mediaContainer = newPostHtml.getElementsByClassName("media-content")[0];
-        let mediaData = posts[i]["media"];
-        if (mediaData != null) {
-            let mediaContent = null;
-            if (mediaData.startsWith("data:image")) {
-                mediaContent = mediaContainer.getElementsByTagName("img")[0];
-            } else if (mediaData.startsWith("data:video")) {
-                mediaContent = mediaContainer.getElementsByTagName("video")[0];
-            } else {
-                console.log("unsupported media type")
+        htmlWall.appendChild(createPostElement(postTemplateHtml, posts[i], email, authors[posts[i]["author"]]));
+    }
+}
+
+function createPostElement(postTemplateHtml, post, email, author = null) {
+    const newPostHtml = document.createElement("div");
+    newPostHtml.innerHTML = postTemplateHtml;
+    newPostHtml.classList.add("user-post");
+
+    // general information
+    newPostHtml.setAttribute("data-id", post["id"]);
+    newPostHtml.getElementsByClassName("time")[0].innerHTML = getDateTimeFormat(new Date(post["created"]));
+    newPostHtml.getElementsByClassName("author")[0].innerHTML = post["author"];
+    if (author != null) {
+        // authors are embedded in the page of posts, so they don't need to be requested one by one
+        newPostHtml.getElementsByClassName("author")[0].title = author["firstname"] + " " + author["lastname"];
+    }
+
+    // show media
+    let mediaContainer = newPostHtml.getElementsByClassName("media-content")[0];
+    let mediaData = post["media"];
+    if (mediaData != null) {
+        // media are referenced by URL, posts created before the media store hold inline data URLs
+        let mediaType = post["media_type"] != null ? post["media_type"] : mediaData.replace("data:", "");
+        let mediaContent = null;
+        if (mediaType.startsWith("image")) {
+            mediaContent = mediaContainer.getElementsByTagName("img")[0];
+            mediaContent.loading = "lazy"; // download only images scrolled into view
+        } else if (mediaType.startsWith("video")) {
+            mediaContent = mediaContainer.getElementsByTagName("video")[0];
+            mediaContent.preload = "metadata";
+        } else {
+            console.log("unsupported media type")
+        }
+        if (mediaContent != null) {
+            mediaContent.src = mediaData;
+            mediaContent.style.display = "block";
+            // images are shown as thumbnails, videos get a preview frame until they are played
+            if (mediaType.startsWith("video") && post["media_preview"] != null) {
+                mediaContent.poster = post["media_preview"];
             }
-            if (mediaContent != null) {
-                mediaContent.src = mediaData;
-                mediaContent.style.display = "block";
+            if (mediaType.startsWith("image") && post["media_original"] != null && post["media_original"] !== mediaData) {
+                mediaContent.style.cursor = "zoom-in";
+                mediaContent.onclick = function () {
+                    window.open(post["media_original"], "_blank");
+                };
             }
         }
+    }
 
-        // show content
-        let lines = posts[i]["content"].split("\n");
-        for (let j = 0; j < lines.length; j++) {
-            newPostHtml.getElementsByClassName("content")[0].appendChild(document.createTextNode(lines[j]));
-            newPostHtml.getElementsByClassName("content")[0].appendChild(document.createElement("br"));
-        }
+    // show content
+    let lines = post["content"].split("\n");
+    for (let j = 0; j < lines.length; j++) {
+        newPostHtml.getElementsByClassName("content")[0].appendChild(document.createTextNode(lines[j]));
+        newPostHtml.getElementsByClassName("content")[0].appendChild(document.createElement("br"));
+    }
 
-        // start animation
-        newPostHtml.getElementsByClassName("button-edit")[0].style.display = "none"; // NOTE: hiding edit button until the feature is implemented
-        // newPostHtml.getElementsByClassName("button-edit")[0].style.display = posts[i]["author"] === email || posts[i]["user"] === email ? "block" : "none";
-        newPostHtml.getElementsByClassName("button-delete")[0].style.display = posts[i]["author"] === email ? "block" : "none";
+    // start animation
+    newPostHtml.getElementsByClassName("button-edit")[0].style.display = "none"; // NOTE: hiding edit button until the feature is implemented
+    // newPostHtml.getElementsByClassName("button-edit")[0].style.display = post["author"] === email || post["user"] === email ? "block" : "none";
+    newPostHtml.getElementsByClassName("button-delete")[0].style.display = post["author"] === email ? "block" : "none";
 
-        htmlWall.appendChild(newPostHtml);
-    }
+    return newPostHtml;
 }
 
 async function login(email, password) {
@@ -484,7 +627,7 @@ async function formEditAccountDetails(form) {
     document.getElementById("home-user-location").innerHTML = city + ", " + country;
 
     // update profile picture (only if it is not set yet)
-    if (!document.getElementById("account-user-image").src.startsWith("data:image")) {
+    if (document.getElementById("account-user-image").src.includes("/static/src/user-")) {
         setProfilePicture("home-user-image", null, gender);
         setProfilePicture("account-user-image", null, gender);
     }
@@ -602,6 +745,7 @@ async function addPostHome(form) {
         messageInput.value,
         file != null && file.type.match('image.*') ? imageContent.src : null,
         file != null && file.type.match('video.*') ? videoContent.src : null,
+        file,
     )) {
         messageInput.value = null;
         fileInput.value = null;
@@ -625,6 +769,7 @@ async function addPostBrowse(form) {
         messageInput.value,
         file != null && file.type.match('image.*') ? imageContent.src : null,
         file != null && file.type.match('video.*') ? videoContent.src : null,
+        file,
     )) {
         messageInput.value = null;
         fileInput.value = null;
@@ -634,7 +779,7 @@ async function addPostBrowse(form) {
     }
 }
 
-async function addPostToWall(htmlWall, postTemplateHtml, userEmail, content, image, video) {
+async function addPostToWall(htmlWall, postTemplateHtml, userEmail, content, image, video, file) {
     console.log("Creating a new post: " + userEmail + ", " + content + (", image" ? image != null : "") + (", video" ? video != null : ""));
 
     let token = localStorage.getItem("token");
@@ -649,10 +794,20 @@ async function addPostToWall(htmlWall, postTemplateHtml, userEmail, content, ima
         return false;
     }
 
+    // image and video are data URLs previewing the file, the file itself is uploaded in chunks and referenced by its id
+    let media = null;
+    if (file != null) {
+        media = await uploadMedia(file);
+        if (media == null) {
+            showError("Couldn't upload the media.");
+            return false;
+        }
+    }
+
     let body = {
         email: userEmail,
         message: content,
-        media: image != null ? image : video  // NOTE: here we assume that only image or video or none of those is provided
+        media: media,
     };
     const response = await fetch("http://" + HOST + "/api/v1/posts", {
         method: "POST",
@@ -813,8 +968,13 @@ function userImageUpload(input) {
 
     let reader = new FileReader();
     reader.onloadend = async function () {
+        let image = await uploadMedia(file);
+        if (image == null) {
+            showError("Couldn't upload the image.");
+            return;
+        }
         let body = {
-            image: reader.result,
+            image: image,
         };
 
         fetch("http://" + HOST + "/api/v1/users/" + email, {
@@ -879,6 +1039,51 @@ function postFileUpload(input, imageElementID, videoElementID, removeElementID)
     reader.readAsDataURL(file);
 }
 
+async function uploadMedia(file) {
+    // upload the file in chunks of raw bytes, a failed chunk is resent from the offset received by the server
+    let token = localStorage.getItem("token");
+    let email = localStorage.getItem("email");
+    if (token == null || email == null) return null;
+
+    let body = {mimetype: file.type, size: file.size};
+    let response = await fetch("http://" + HOST + "/api/v1/media/uploads", {
+        method: "POST", cache: "no-cache", headers: {
+            "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, body),
+        }, body: JSON.stringify(body),
+    });
+    if (response.status !== 201) return null;
+    let upload = await response.json();
+    let uploadUrl = "http://" + HOST + "/api/v1/media/uploads/" + upload.id;
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        let chunk = new Uint8Array(await file.slice(offset, offset + upload.chunk_size).arrayBuffer());
+        try {
+            response = await fetch(uploadUrl + "?offset=" + offset, {
+                method: "PUT", cache: "no-cache", headers: {
+                    "Content-Type": "application/octet-stream", "Authorization": await getAuthorizationHeader(email, token, chunk),
+                }, body: chunk,
+            });
+            if (response.status !== 200 && response.status !== 409) throw new Error("unexpected status " + response.status);
+            offset = (await response.json()).offset;
+            retries = 0;
+        } catch (error) {
+            // the connection dropped, resume from the data received by the server
+            if (++retries > MEDIA_UPLOAD_RETRIES) return null;
+            response = await fetch(uploadUrl, {
+                method: "GET", cache: "no-cache", headers: {"Authorization": await getAuthorizationHeader(email, token, null)},
+            }).catch(() => null);
+            if (response != null && response.status === 200) offset = (await response.json()).offset;
+        }
+    }
+
+    response = await fetch(uploadUrl, {
+        method: "POST", cache: "no-cache", headers: {"Authorization": await getAuthorizationHeader(email, token, null)},
+    });
+    return response.status === 201 ? (await response.json()).id : null;
+}
+
 // INTERACTIVE CSS ELEMENTS
 
 function checkSamePasswords(htmlPassword, htmlPassword2) {
@@ -899,6 +1104,41 @@ function checkValidGender(htmlSelect) {
     }
 }
 
+function suggestUsers(prefix) {
+    // only the last keystroke within the delay sends a request, and a newer request cancels the older one
+    clearTimeout(userSuggestions.timeout);
+    if (userSuggestions.controller != null) userSuggestions.controller.abort();
+    prefix = prefix.trim();
+    if (prefix === "") return;
+
+    userSuggestions.timeout = setTimeout(async function () {
+        let token = localStorage.getItem("token");
+        let email = localStorage.getItem("email");
+        if (token == null || email == null) return;
+
+        let controller = userSuggestions.controller = new AbortController();
+        try {
+            let response = await fetch("http://" + HOST + "/api/v1/users?prefix=" + encodeURIComponent(prefix), {
+                method: "GET", signal: controller.signal, headers: {
+                    "Content-Type": "application/json", "Authorization": await getAuthorizationHeader(email, token, null),
+                },
+            });
+            if (!response.ok) return;
+            let users = (await response.json()).users;
+
+            let suggestionsHtml = document.getElementById("user-suggestions");
+            suggestionsHtml.replaceChildren(...users.map(function (user) {
+                let option = document.createElement("option");
+                option.value = user.email;
+                option.label = user.firstname + " " + user.lastname;
+                return option;
+            }));
+        } catch (e) {
+            if (e.name !== "AbortError") console.log("Couldn't load user suggestions: " + e);
+        }
+    }, USER_SUGGESTIONS_DELAY);
+}
+
 function searchButtonUpdate() {
     let searchButtonHtml = document.getElementById("browse-search-button");
     searchButtonHtml.innerHTML = "Search";
@@ -918,6 +1158,17 @@ window.onscroll = function() {
     }
     lastYPos = currentYPos;
 
+    // load next page of the visible wall when getting close to the bottom
+    if (window.innerHeight + currentYPos >= document.documentElement.scrollHeight - WALL_SCROLL_THRESHOLD) {
+        let homeTabHtml = document.getElementById("tab-home");
+        let browseTabHtml = document.getElementById("tab-browse");
+        if (homeTabHtml != null && homeTabHtml.style.display !== "none") {
+            loadNextWallPage("home-wall", "home-post-template").then();
+        } else if (browseTabHtml != null && browseTabHtml.style.display !== "none") {
+            loadNextWallPage("browse-wall", "browse-post-template").then();
+        }
+    }
+
     // show jump button
     let jumpToStartHtml = document.getElementById("jump-to-start");
     if (jumpToStartHtml != null) {
@@ -1048,11 +1299,12 @@ function getDateTimeFormat(date) {
 
 // authorization
 async function getAuthorizationHeader(userEmail, sessionID, payload) {
-    let message = payload != null ? JSON.stringify(payload) : "";
+    // raw binary payloads (e.g. chunks of uploaded media) are signed as they are, other payloads as JSON
+    let message = payload instanceof Uint8Array ? payload : payload != null ? JSON.stringify(payload) : "";
 
     // implementation from https://stackoverflow.com/a/76117805
     const encoder = new TextEncoder();
-    const payload_encode = encoder.encode(message);
+    const payload_encode = message instanceof Uint8Array ? message : encoder.encode(message);
     const sessionID_encode = encoder.encode(sessionID);
 
     // Import the secretKey as a CryptoKey
@@ -1,18 +1,59 @@
+import atexit
 import base64
+import concurrent.futures
+import datetime
+import functools
 import hashlib
 import hmac
 import http
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections.abc import Iterable, Iterator
 
 import bcrypt
 from email_validator import validate_email, EmailNotValidError
-from flask import jsonify, request, current_app
+from flask import jsonify, request, current_app, Response, stream_with_context
+
+try:
+    import brotli  # optional, responses are compressed by gzip only if it is not installed
+except ImportError:
+    brotli = None
 
 from twidder import session_handler
 
+AUTHORIZATION_CACHE_SIZE = 4096  # number of parsed Authorization headers cached by every process
+BODY_CHUNK_SIZE = 64 * 1024  # request body is authenticated by chunks of this size
+BODY_SPOOL_SIZE = 1024 * 1024  # authenticated request bodies larger than this are buffered in a temporary file instead of memory
+STREAM_CHUNK_SIZE = 16 * 1024  # streamed responses are sent by chunks of at least this size
+
 
 def authorize_user(fun):
     """Decorator for user authorization. Makes sure only authorized users are let through. Adds user email to function parameters."""
+    return _authorize_user(fun, stream_body=False)
+
+
+def authorize_user_streaming(fun):
+    """
+    Decorator for user authorization of requests with large bodies (e.g. chunks of uploads), which are authenticated while the request handler reads them,
+    instead of being buffered first. Adds user email and the body (SignedBody) to function parameters. The handler must call SignedBody.verify() before
+    it keeps anything it read from the body, the body is verified after the handler otherwise, and the response is replaced if it isn't authentic.
+    """
+    return _authorize_user(fun, stream_body=True)
+
+
+def _authorize_user(fun, stream_body: bool):
+    """
+    Create a wrapper of a request handler, which authorizes the user by the HMAC of the request body.
+
+    :param fun: request handler
+    :param stream_body: True to pass the body to the handler to be authenticated while it is read, False to authenticate it before the handler is called
+    :return: wrapped request handler
+    """
 
     def wrapper(*args, **kwargs):
         # check if Authorization header is present
@@ -20,27 +61,28 @@ def authorize_user(fun):
             return jsonify({"message": "Authorization header is missing"}), http.HTTPStatus.UNAUTHORIZED
 
         # decode the payload
-        payload = request.headers["Authorization"]
-        data = json.loads(base64.b64decode(payload))
-        body = request.get_data()
+        credentials = _parse_authorization(request.headers["Authorization"])
+        if credentials is None:
+            return jsonify({"message": "invalid token"}), http.HTTPStatus.UNAUTHORIZED
 
-        user_email, user_hash = data["email"], data["hash"]
+        user_email, user_hash = credentials
         current_app.logger.debug(f"authorizing request: {user_email=}, {user_hash=}")
-      
-        # get user session
+
+        # get user session, before the (possibly large) body is read
         session_id = session_handler.get_session(user_email)
         if session_id is None:
             return jsonify({"message": "invalid token"}), http.HTTPStatus.UNAUTHORIZED
 
-        # create server hmac
-        server_hash = hmac.new(
-            session_id.encode("utf-8"),
-            body, 
-            hashlib.sha256
-        ).hexdigest()
-        
+        if stream_body:
+            body = SignedBody(session_id, user_hash)
+            response = fun(user_email, body, *args, **kwargs)
+            if not body.verify():
+                return jsonify({"message": "invalid token"}), http.HTTPStatus.UNAUTHORIZED
+            return response
+
         # verify the hash
-        if user_hash != server_hash:
+        server_hash = _hash_request_body(session_id)
+        if not hmac.compare_digest(user_hash.encode("utf-8"), server_hash.encode("utf-8")):
             return jsonify({"message": "invalid token"}), http.HTTPStatus.UNAUTHORIZED
         return fun(user_email, *args, **kwargs)
 
@@ -49,6 +91,96 @@ def authorize_user(fun):
     return wrapper
 
 
+class SignedBody:
+    """Request body authenticated by its HMAC while it is read, so it doesn't have to be buffered before the request handler reads it."""
+
+    def __init__(self, session_id: str, user_hash: str):
+        """
+        :param session_id: session id of the user, the key of the HMAC
+        :param user_hash: HMAC of the body sent by the user
+        """
+        self._user_hash = user_hash
+        self._hmac = hmac.new(session_id.encode("utf-8"), digestmod=hashlib.sha256)
+        self._verified: None | bool = None
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read data of the body. Data read before the body is verified are not authentic yet.
+
+        :param size: maximum number of bytes to read, the rest of the body if negative
+        :return: data, empty at the end of the body
+        """
+        data = request.stream.read(size)
+        self._hmac.update(data)
+        return data
+
+    def verify(self) -> bool:
+        """
+        Check that the body is authentic. The rest of the body which wasn't read yet is read and discarded, as the HMAC covers the whole body.
+
+        :return: True if the HMAC of the body matches the HMAC sent by the user, False otherwise
+        """
+        if self._verified is None:
+            while self.read(BODY_CHUNK_SIZE):
+                pass
+            self._verified = hmac.compare_digest(self._user_hash.encode("utf-8"), self._hmac.hexdigest().encode("utf-8"))
+        return self._verified
+
+
+@functools.lru_cache(maxsize=AUTHORIZATION_CACHE_SIZE)
+def _parse_authorization(payload: str) -> None | tuple[str, str]:
+    """
+    Decode the Authorization header of a user request. Clients send the same header for every request without body, so decoded headers are cached.
+
+    :param payload: value of the Authorization header, base64 encoded JSON object with 'email' and 'hash' fields
+    :return: tuple of user email and request hash, None if the header is malformed
+    """
+    try:
+        data = json.loads(base64.b64decode(payload))
+        user_email, user_hash = data["email"], data["hash"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(user_email, str) or not isinstance(user_hash, str):
+        return None
+    return user_email, user_hash
+
+
+def _hash_request_body(session_id: str) -> str:
+    """
+    Compute HMAC of the request body keyed by the session id. The body is read by chunks, so it is never held in memory as a whole,
+    and buffered to a temporary file, which replaces the request stream, so the body can still be read by the request handler.
+
+    :param session_id: session id of the user
+    :return: hexadecimal HMAC-SHA256 of the request body
+    """
+    server_hmac = hmac.new(session_id.encode("utf-8"), digestmod=hashlib.sha256)
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+    while chunk := request.stream.read(BODY_CHUNK_SIZE):
+        server_hmac.update(chunk)
+        body.write(chunk)
+    body.seek(0)
+    request.stream = body
+    return server_hmac.hexdigest()
+
+
+def authorize_admin(fun):
+    """Decorator for admin authorization. Makes sure only requests with the admin token (configured by 'ADMIN_TOKEN') are let through."""
+
+    def wrapper(*args, **kwargs):
+        admin_token = current_app.config["ADMIN_TOKEN"]
+        if admin_token is None:
+            return jsonify({"message": "admin API is disabled"}), http.HTTPStatus.FORBIDDEN
+
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or not hmac.compare_digest(authorization.removeprefix("Bearer ").encode("utf-8"), admin_token.encode("utf-8")):
+            return jsonify({"message": "invalid admin token"}), http.HTTPStatus.UNAUTHORIZED
+        return fun(*args, **kwargs)
+
+    # renaming wrapper to function name, so flask doesn't throw exception
+    wrapper.__name__ = fun.__name__
+    return wrapper
+
+
 def post_parameters(*params):
     """Decorator for POST requests. Makes sure all specified fields are provided and are of correct type."""
 
@@ -98,19 +230,332 @@ def patch_parameters(*params):
     return decorator
 
 
+def parse_fields(available: tuple[str, ...], media: tuple[str, ...] = (), required: tuple[str, ...] = ()) -> tuple[str, ...]:
+    """
+    Parse the fields of a resource requested by the query parameters 'fields' (comma separated field names)
+    and 'include_media' ('false' leaves out the given media fields).
+
+    :param available: all fields of the resource, in the order they are returned
+    :param media: fields holding media, which are left out if 'include_media' is false
+    :param required: fields which are always returned (e.g. the resource id)
+    :return: requested fields in the order of available fields
+    :raises ValueError: if an unknown field is requested
+    """
+    requested = set(available)
+    if (fields := request.args.get("fields")) is not None:
+        requested = {field.strip() for field in fields.split(",") if field.strip() != ""}
+        if not requested <= set(available):
+            raise ValueError(f"unknown fields: {', '.join(sorted(requested - set(available)))}")
+    if request.args.get("include_media", "true").lower() in ("false", "0"):
+        requested -= set(media)
+    requested |= set(required)
+    return tuple(field for field in available if field in requested)
+
+
+def make_etag(*values) -> str:
+    """
+    Create a strong entity tag from values identifying a version of a resource.
+
+    :param values: values identifying the resource version (e.g. revision counters, edition times)
+    :return: entity tag
+    """
+    version = "\x1f".join(str(value) for value in values)
+    return hashlib.sha256(version.encode("utf-8")).hexdigest()
+
+
+def is_not_modified(etag: str, last_modified: datetime.datetime | None = None) -> bool:
+    """
+    Check if the client's cached version of the resource is still valid, based on the request's conditional headers.
+
+    :param etag: current entity tag of the resource
+    :param last_modified: datetime of the last resource modification, if known
+    :return: True if the client's version is up to date, False otherwise
+    """
+    if request.if_none_match:
+        # compressed responses have weak entity tags, GET requests compare them weakly anyway
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def not_modified(etag: str, last_modified: datetime.datetime | None = None) -> Response:
+    """
+    Create an empty 304 Not Modified response.
+
+    :param etag: current entity tag of the resource
+    :param last_modified: datetime of the last resource modification, if known
+    :return: 304 response with caching headers
+    """
+    response = current_app.response_class(status=http.HTTPStatus.NOT_MODIFIED)
+    return set_cache_headers(response, etag, last_modified)
+
+
+def set_cache_headers(response: Response, etag: str, last_modified: datetime.datetime | None = None) -> Response:
+    """
+    Set caching headers of a private resource, which the client may cache, but must revalidate before every use.
+
+    :param response: response to update
+    :param etag: current entity tag of the resource
+    :param last_modified: datetime of the last resource modification, if known
+    :return: the updated response
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Authorization")
+    return response
+
+
+def stream_json(document: dict) -> Response:
+    """
+    Create a response streaming a JSON object, so large values are serialized while they are read (e.g. from a database cursor).
+    Iterators are streamed as arrays item by item, callables are called once all preceding values are streamed (e.g. to get a pagination cursor
+    known after the last item), other values are serialized as they are. Values are serialized the same way as by jsonify().
+
+    :param document: object to stream, its values are streamed in order
+    :return: streamed JSON response
+    """
+
+    def generate() -> Iterator[str]:
+        chunk = "{"
+        for index, (key, value) in enumerate(document.items()):
+            chunk += ("," if index > 0 else "") + current_app.json.dumps(key) + ":"
+            if callable(value):
+                value = value()
+            if not isinstance(value, Iterator):
+                chunk += current_app.json.dumps(value)
+                continue
+            chunk += "["
+            for item_index, item in enumerate(value):
+                chunk += ("," if item_index > 0 else "") + current_app.json.dumps(item)
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    yield chunk
+                    chunk = ""
+            chunk += "]"
+        yield chunk + "}"
+
+    return current_app.response_class(stream_with_context(generate()), mimetype="application/json")
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Compress a JSON response by brotli or gzip, whichever the client accepts (brotli is preferred, if it is installed).
+    Responses smaller than 'COMPRESSION_MIN_SIZE' are left as they are, streamed responses are compressed while they are streamed.
+
+    :param response: response to compress
+    :return: the compressed response
+    """
+    if response.mimetype != "application/json" or response.status_code != http.HTTPStatus.OK or "Content-Encoding" in response.headers:
+        return response
+    if response.direct_passthrough or (not response.is_streamed and len(response.get_data()) < current_app.config["COMPRESSION_MIN_SIZE"]):
+        return response
+
+    encodings = request.accept_encodings
+    if brotli is not None and encodings["br"] > 0 and encodings["br"] >= encodings["gzip"]:
+        compressor = brotli.Compressor(quality=current_app.config["COMPRESSION_BROTLI_QUALITY"])
+        encoding, compress, flush = "br", compressor.process, compressor.finish
+    elif encodings["gzip"] > 0:
+        compressor = zlib.compressobj(current_app.config["COMPRESSION_GZIP_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        encoding, compress, flush = "gzip", compressor.compress, compressor.flush
+    else:
+        response.vary.add("Accept-Encoding")
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(), compress, flush)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compress(response.get_data()) + flush())
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+
+    # the compressed representation differs byte by byte, so its entity tag is only weak
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _compress_stream(chunks: Iterable[bytes], compress, flush) -> Iterator[bytes]:
+    """
+    Compress a streamed response body chunk by chunk.
+
+    :param chunks: chunks of the response body
+    :param compress: function compressing a chunk, returning the compressed data available so far
+    :param flush: function returning the rest of the compressed data
+    :return: chunks of the compressed body
+    """
+    for chunk in chunks:
+        if compressed := compress(chunk):
+            yield compressed
+    yield flush()
+
+
+class PasswordHashingBusyError(Exception):
+    """Raised when too many passwords are being hashed at the same time, so the request should be retried later."""
+
+
+class PasswordHasher:
+    """
+    Pool of processes hashing passwords, so that CPU-heavy bcrypt doesn't block request threads (and the GIL).
+    Hashing processes are spawned, they import the main module of the program again, so scripts hashing passwords must guard their code
+    by ``if __name__ == "__main__":`` (or ``"__mp_main__"`` like appserver.py), otherwise every hashing process runs the script again and crashes.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        """
+        :param workers: number of hashing processes
+        :param queue_size: maximum number of passwords waiting for a free process, further requests are rejected
+        """
+        self.pid = os.getpid()
+        self._workers = workers
+        self._queue_size = queue_size
+        # hashing processes are spawned, as forking a process running request, writer and media threads may copy locks held by them
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                                                initializer=_init_hashing_process, initargs=(self.pid,))
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+        atexit.register(self.shutdown)
+
+    def shutdown(self) -> None:
+        """
+        Stop the hashing processes, waiting for passwords being hashed. Called at exit, so the pool isn't left to the interpreter shutdown.
+
+        :return: None
+        """
+        # forked processes inherit exit handlers, but not the pool
+        if self.pid == os.getpid():
+            self._executor.shutdown()
+
+    def run(self, fun, *args):
+        """
+        Run a function in a hashing process and wait for its result.
+
+        :param fun: function to run, it must be defined at the module level
+        :param args: function arguments
+        :return: function result
+        :raises PasswordHashingBusyError: if all processes are busy and the queue is full
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PasswordHashingBusyError()
+
+        with self._lock:
+            self._in_progress += 1
+        start = time.perf_counter()
+        try:
+            return self._executor.submit(fun, *args).result()
+        finally:
+            self._complete(time.perf_counter() - start)
+            self._slots.release()
+
+    def run_all(self, fun, calls: list[tuple]) -> list:
+        """
+        Run a function in hashing processes for many arguments at once and wait for all results, e.g. to hash passwords of imported users.
+        The calls are not limited by the queue size, they keep all processes busy until they are done, so requests wait for them in the queue.
+
+        :param fun: function to run, it must be defined at the module level
+        :param calls: arguments of every call
+        :return: function results in the order of the calls
+        """
+        with self._lock:
+            self._in_progress += len(calls)
+        start = time.perf_counter()
+        futures = [self._executor.submit(fun, *args) for args in calls]
+        results = []
+        try:
+            for future in futures:
+                results.append(future.result())
+                self._complete(time.perf_counter() - start)
+        finally:
+            for future in futures[len(results):]:
+                future.cancel()
+                self._complete(time.perf_counter() - start)
+        return results
+
+    def _complete(self, duration: float) -> None:
+        """
+        Record a completed call.
+
+        :param duration: duration of the call including the time spent waiting in the queue
+        :return: None
+        """
+        with self._lock:
+            self._in_progress -= 1
+            self._completed += 1
+            self._total_time += duration
+            self._max_time = max(self._max_time, duration)
+
+    def stats(self) -> dict:
+        """
+        Get hashing statistics. Durations include the time spent waiting in the queue.
+
+        :return: dictionary of hashing statistics
+        """
+        with self._lock:
+            return {
+                "workers": self._workers,
+                "queue_size": self._queue_size,
+                "in_progress": self._in_progress,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "total_time": self._total_time,
+                "max_time": self._max_time,
+            }
+
+
+_hasher: None | PasswordHasher = None  # password hasher of the current process
+_hasher_lock: threading.Lock = threading.Lock()
+
+
+def get_password_hasher() -> PasswordHasher:
+    """
+    Get the password hasher of the current process, creating it if necessary.
+
+    :return: password hasher
+    """
+    global _hasher
+    with _hasher_lock:
+        # process pools can't be used by forked processes (e.g. gunicorn workers), so every process gets its own
+        if _hasher is None or _hasher.pid != os.getpid():
+            _hasher = PasswordHasher(current_app.config["PASSWORD_HASHING_WORKERS"], current_app.config["PASSWORD_HASHING_QUEUE_SIZE"])
+        return _hasher
+
+
 def hash_password(password: str) -> str:
     """
-    Hash password using bcrypt library.
+    Hash password using bcrypt library. The cost of hashing is configured by 'BCRYPT_ROUNDS'.
 
     :param password: plain text password
     :return: hashed password
+    :raises PasswordHashingBusyError: if too many passwords are being hashed
     """
     password_b = bytes(password, "utf-8")
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password_b, salt)
+    hashed_password = get_password_hasher().run(_bcrypt_hash, password_b, current_app.config["BCRYPT_ROUNDS"])
     return hashed_password.decode('utf-8')
 
 
+def hash_passwords(passwords: list[str]) -> list[str]:
+    """
+    Hash many passwords at once by all hashing processes, e.g. passwords of imported users. Unlike hash_password(), hashing is not limited by the queue size.
+
+    :param passwords: plain text passwords
+    :return: hashed passwords in the order of the plain text passwords
+    """
+    rounds = current_app.config["BCRYPT_ROUNDS"]
+    hashed_passwords = get_password_hasher().run_all(_bcrypt_hash, [(bytes(password, "utf-8"), rounds) for password in passwords])
+    return [hashed_password.decode('utf-8') for hashed_password in hashed_passwords]
+
+
 def check_password(password: str, hashed_password: str) -> bool:
     """
     Check if a given plain text password matches given password hash.
@@ -118,10 +563,48 @@ def check_password(password: str, hashed_password: str) -> bool:
     :param password: plain text password
     :param hashed_password: hashed password
     :return: True if password matches the hash, False otherwise
+    :raises PasswordHashingBusyError: if too many passwords are being hashed
     """
     password_b = bytes(password, "utf-8")
     hashed_password_b = bytes(hashed_password, "utf-8")
-    return bcrypt.checkpw(password_b, hashed_password_b)
+    return get_password_hasher().run(_bcrypt_check, password_b, hashed_password_b)
+
+
+def _init_hashing_process(parent_pid: int) -> None:
+    """
+    Initialize a hashing process. The process exits when its parent dies (e.g. a gunicorn worker killed on timeout), instead of waiting for work forever.
+
+    :param parent_pid: process id of the process owning the hashing pool
+    :return: None
+    """
+    def watch_parent():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, name="hashing-parent-watcher", daemon=True).start()
+
+
+def _bcrypt_hash(password: bytes, rounds: int) -> bytes:
+    """
+    Hash password using bcrypt library. Runs in a hashing process.
+
+    :param password: plain text password
+    :param rounds: bcrypt work factor
+    :return: hashed password
+    """
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _bcrypt_check(password: bytes, hashed_password: bytes) -> bool:
+    """
+    Check if a given plain text password matches given password hash. Runs in a hashing process.
+
+    :param password: plain text password
+    :param hashed_password: hashed password
+    :return: True if password matches the hash, False otherwise
+    """
+    return bcrypt.checkpw(password, hashed_password)
 
 
 def is_email_valid(email: str) -> bool: